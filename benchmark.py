@@ -0,0 +1,402 @@
+# Benchmarks the throughput of program.py against a local stand-in for the
+# OMF endpoint, so that batching, compression and concurrency settings can
+# be tuned and throughput regressions caught without any live services.
+# *************************************************************************************
+
+# ************************************************************************
+# Import necessary packages
+# ************************************************************************
+
+import argparse
+import gzip
+import itertools
+import json
+import os
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import program
+
+# ************************************************************************
+# A local stand-in for the OMF endpoint of CDS, EDS or PI
+# ************************************************************************
+
+
+class FakeOmfServer:
+    '''A local HTTP server that emulates an /omf endpoint, token discovery, latency, 409s and throttling
+
+    Types and containers are remembered, and creating one again with a different definition
+    returns 409. Every throttle_every-th data message is answered with 429 and a Retry-After
+    header. If certfile and keyfile are given, the server uses https so that it can stand in
+    for CDS, including the token discovery and client credentials token endpoints.'''
+
+    def __init__(self, latency_seconds=0, throttle_every=0, retry_after_seconds=0, certfile=None, keyfile=None):
+        self.latency_seconds = latency_seconds
+        self.throttle_every = throttle_every
+        self.retry_after_seconds = retry_after_seconds
+        self.definitions = {}
+        self.lock = threading.Lock()
+        self.reset_counters()
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._create_handler())
+        self.server.daemon_threads = True
+        scheme = 'http'
+        if certfile is not None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+            scheme = 'https'
+        self.url = f'{scheme}://127.0.0.1:{self.server.server_port}'
+        self.thread = None
+
+    def reset_counters(self):
+        '''Resets the counts of received messages, values, bytes and responses'''
+        with self.lock:
+            self.messages = {}
+            self.values = 0
+            self.bytes_received = 0
+            self.throttled = 0
+            self.conflicts = 0
+            self.token_requests = 0
+            self.data_requests = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _create_handler(self):
+        fake_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def reply(self, status, body=b'', headers={}):
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path.endswith('/.well-known/openid-configuration'):
+                    self.reply(200, json.dumps(
+                        {"token_endpoint": f'{fake_server.url}/identity/connect/token'}).encode('utf-8'))
+                else:
+                    self.reply(404)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+                if self.path.endswith('/identity/connect/token'):
+                    with fake_server.lock:
+                        fake_server.token_requests += 1
+                    self.reply(200, json.dumps(
+                        {"access_token": 'fake-token', "expires_in": 3600}).encode('utf-8'))
+                    return
+
+                if not self.path.endswith('/omf'):
+                    self.reply(404)
+                    return
+
+                if fake_server.latency_seconds:
+                    time.sleep(fake_server.latency_seconds)
+
+                status, headers = fake_server.handle_omf_message(
+                    self.headers, body, len(self.requestline) + len(str(self.headers)) + len(body))
+                self.reply(status, headers=headers)
+
+        return Handler
+
+    def handle_omf_message(self, headers, body, request_bytes):
+        '''Records an OMF message and returns the status and headers of the response'''
+
+        message_type = headers.get('messagetype')
+        if headers.get('compression') == 'gzip':
+            body = gzip.decompress(body)
+        omf_messages = json.loads(body)
+        if isinstance(omf_messages, dict):
+            omf_messages = [omf_messages]
+
+        with self.lock:
+            self.bytes_received += request_bytes
+
+            if message_type == 'data':
+                self.data_requests += 1
+                if self.throttle_every and self.data_requests % self.throttle_every == 0:
+                    self.throttled += 1
+                    return 429, {'Retry-After': str(self.retry_after_seconds)}
+                self.values += sum(len(omf_message["values"]) for omf_message in omf_messages)
+
+            elif headers.get('action') == 'delete':
+                for omf_message in omf_messages:
+                    self.definitions.pop((message_type, omf_message["id"]), None)
+
+            else:
+                conflict = False
+                for omf_message in omf_messages:
+                    key = (message_type, omf_message["id"])
+                    if self.definitions.setdefault(key, omf_message) != omf_message:
+                        conflict = True
+                if conflict:
+                    self.conflicts += 1
+                    return 409, {}
+
+            self.messages[message_type] = self.messages.get(message_type, 0) + 1
+
+        return 202, {}
+
+    def get_endpoint_settings(self, endpoint_type='EDS', certfile=None, use_compression=True):
+        '''Returns the appsettings.json configuration of an endpoint that sends to this server'''
+
+        settings = {
+            "Selected": True,
+            "EndpointType": endpoint_type,
+            "Resource": self.url,
+            "ApiVersion": 'v1',
+            "UseCompression": use_compression,
+            "VerifySSL": certfile if certfile is not None else True
+        }
+        if endpoint_type == 'CDS':
+            settings.update({"TenantId": 'tenant', "NamespaceId": 'namespace',
+                             "ClientId": 'client', "ClientSecret": 'secret'})
+        elif endpoint_type == 'PI':
+            settings.update({"Username": 'user', "Password": 'password'})
+
+        return settings
+
+
+# ************************************************************************
+# Runs the send path of program.py against the fake endpoints
+# ************************************************************************
+
+
+def create_containers(container_count, omf_types):
+    '''Returns OMF containers and data message skeletons for a number of containers spread over the types'''
+
+    omf_containers = [{"id": f'BenchmarkContainer{i}', "typeid": omf_types[i % len(omf_types)]["id"]}
+                      for i in range(container_count)]
+    omf_data = [{"containerid": omf_container["id"], "values": []}
+                for omf_container in omf_containers]
+
+    return omf_containers, omf_data
+
+
+def percentile(samples, fraction):
+    '''Returns the given fraction (0 to 1) percentile of the samples'''
+
+    if not samples:
+        return 0.0
+    if len(samples) == 1:
+        return samples[0]
+    return statistics.quantiles(samples, n=100, method='inclusive')[min(98, max(0, int(fraction * 100) - 1))]
+
+
+def run_benchmark(servers, endpoint_type, omf_types, omf_containers, omf_data, cycles,
+                  batch_cycles, use_compression, concurrent, certfile=None):
+    '''Registers the types and containers with every server, sends a number of data cycles and returns the measurements
+
+    A batch_cycles of 0 sends every container in its own message, like the sample did before
+    batching, otherwise the data of that many cycles is gathered into batched messages.'''
+
+    endpoints = program.configure_endpoints(
+        [server.get_endpoint_settings(endpoint_type, certfile, use_compression) for server in servers])
+
+    # record the latency of every request from the sessions of the endpoints
+    latencies = []
+    for endpoint in endpoints:
+        program.get_session(endpoint).hooks["response"].append(
+            lambda response, *args, **kwargs: latencies.append(response.elapsed.total_seconds()))
+
+    concurrent_fan_out = program.concurrent_fan_out
+    program.concurrent_fan_out = concurrent
+    registration_cache_file = program.registration_cache_file
+    program.registration_cache_file = None
+    program.registration_cache = None
+
+    try:
+        program.check_endpoint_errors(program.run_on_all_endpoints(
+            endpoints, program.register_definitions, omf_types, omf_containers))
+
+        for server in servers:
+            server.reset_counters()
+        latencies.clear()
+
+        generator = program.ColumnarDataGenerator(omf_types, omf_containers, omf_data)
+        encoder = program.DataEncoder(omf_types, omf_containers) if program.use_compiled_encoders else None
+        batcher = program.DataBatcher(max(1, batch_cycles), program.max_message_bytes, encoder=encoder)
+
+        start = time.perf_counter()
+        for _ in range(cycles):
+            data_messages = generator.generate()
+            if batch_cycles == 0:
+                if encoder is not None:
+                    # encoding each message on its own makes every message a separate batch
+                    data_messages = [encoder.encode_batches([data_message])[0] for data_message in data_messages]
+                for data_message in data_messages:
+                    program.check_endpoint_errors(program.send_to_all_endpoints(
+                        endpoints, 'data', [data_message]))
+                continue
+
+            for data_message in data_messages:
+                batcher.add(data_message)
+            if batcher.end_cycle():
+                program.check_endpoint_errors(program.send_to_all_endpoints(
+                    endpoints, 'data', batcher.flush()))
+
+        # send any data still gathered in a partial batch
+        if batcher.pending:
+            program.check_endpoint_errors(program.send_to_all_endpoints(
+                endpoints, 'data', batcher.flush()))
+        elapsed = time.perf_counter() - start
+
+    finally:
+        program.shutdown_fan_out()
+        for endpoint in endpoints:
+            program.close_session(endpoint)
+        program.concurrent_fan_out = concurrent_fan_out
+        program.registration_cache_file = registration_cache_file
+        program.registration_cache = None
+
+    messages = sum(server.messages.get('data', 0) for server in servers)
+    values = sum(server.values for server in servers)
+    latencies.sort()
+
+    return {
+        "batch_cycles": batch_cycles,
+        "compression": use_compression,
+        "concurrent": concurrent,
+        "endpoints": len(servers),
+        "seconds": elapsed,
+        "messages_per_second": messages / elapsed,
+        "values_per_second": values / elapsed,
+        "p50_latency_ms": percentile(latencies, 0.50) * 1000,
+        "p99_latency_ms": percentile(latencies, 0.99) * 1000,
+        "bytes_on_wire": sum(server.bytes_received for server in servers),
+        "throttled": sum(server.throttled for server in servers)
+    }
+
+
+# ************************************************************************
+# Measures how long program.py takes to start in a new process
+# ************************************************************************
+
+
+def measure_startup(runs, appsettings_file='appsettings.json'):
+    '''Returns the median and minimum seconds that a new process takes to import program.py and load its settings
+
+    Each process is timed from being started to exiting, for importing program.py only, for also
+    loading the endpoint configurations, types and data without the startup cache, and for loading
+    them from the startup cache. A first untimed run of each writes the bytecode and the cache.'''
+
+    with tempfile.TemporaryDirectory() as directory:
+        settings = 'import program; program.omf_types_file = {types!r}; program.omf_data_file = {data!r}; ' \
+                   'program.startup_cache_file = {cache!r}; program.load_startup_settings()'
+        files = {"types": os.path.abspath(program.omf_types_file), "data": os.path.abspath(program.omf_data_file)}
+        modes = {
+            "import": 'import program',
+            "settings": settings.format(cache=None, **files),
+            "cached_settings": settings.format(cache=os.path.join(directory, 'startup_cache.json'), **files)
+        }
+
+        # the processes run in a directory of their own, with the appsettings.json to load
+        with open(appsettings_file, 'rb') as source, open(os.path.join(directory, 'appsettings.json'), 'wb') as target:
+            target.write(source.read())
+        environment = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            [os.path.dirname(os.path.abspath(program.__file__))] + os.environ.get('PYTHONPATH', '').split(os.pathsep)))
+
+        results = []
+        for mode, code in modes.items():
+            samples = []
+            for run in range(runs + 1):
+                started = time.perf_counter()
+                subprocess.run([sys.executable, '-c', code], cwd=directory, env=environment, check=True,
+                               stdout=subprocess.DEVNULL)
+                if run > 0:
+                    samples.append(time.perf_counter() - started)
+            results.append({"mode": mode, "median_ms": statistics.median(samples) * 1000,
+                            "min_ms": min(samples) * 1000})
+
+    return results
+
+
+def print_results(results, columns=None):
+    '''Prints the measurements of each benchmark run as a table'''
+
+    if columns is None:
+        columns = ['batch_cycles', 'compression', 'concurrent', 'endpoints', 'messages_per_second', 'values_per_second',
+                   'p50_latency_ms', 'p99_latency_ms', 'bytes_on_wire', 'throttled']
+    print(' | '.join(columns))
+    for result in results:
+        print(' | '.join(f'{result[column]:.1f}' if isinstance(result[column], float) else str(result[column])
+                         for column in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the OMF send path against local fake OMF endpoints')
+    parser.add_argument('--containers', type=int, default=1000, help='the number of containers to send')
+    parser.add_argument('--cycles', type=int, default=20, help='the number of data cycles to send')
+    parser.add_argument('--endpoints', type=int, default=3, help='the number of fake endpoints to send to')
+    parser.add_argument('--latency', type=float, default=0.005, help='the seconds each endpoint takes to answer')
+    parser.add_argument('--throttle-every', type=int, default=0,
+                        help='answer every n-th data message with 429, or 0 to never throttle')
+    parser.add_argument('--batch-cycles', type=int, nargs='+', default=[0, 1, 5],
+                        help='the numbers of cycles to batch, where 0 sends one message per container')
+    parser.add_argument('--certfile', help='a certificate, which makes the endpoints https and of type CDS')
+    parser.add_argument('--keyfile', help='the private key of the certificate')
+    parser.add_argument('--output', help='a file to write the results to as json')
+    parser.add_argument('--startup-runs', type=int, default=0,
+                        help='measure how long program.py takes to start over this many runs, instead of the throughput')
+    parser.add_argument('--appsettings', default='appsettings.json',
+                        help='the appsettings.json to load when measuring how long program.py takes to start')
+    args = parser.parse_args()
+
+    if args.startup_runs:
+        results = measure_startup(args.startup_runs, args.appsettings)
+        print_results(results, ['mode', 'median_ms', 'min_ms'])
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        return
+
+    omf_types = program.get_json_file('OMF-Types.json')
+    omf_containers, omf_data = create_containers(args.containers, omf_types)
+    endpoint_type = 'CDS' if args.certfile else 'EDS'
+
+    servers = [FakeOmfServer(args.latency, args.throttle_every, certfile=args.certfile, keyfile=args.keyfile).start()
+               for _ in range(args.endpoints)]
+
+    results = []
+    try:
+        for batch_cycles, use_compression, concurrent in itertools.product(
+                args.batch_cycles, [False, True], [False, True]):
+            results.append(run_benchmark(servers, endpoint_type, omf_types, omf_containers, omf_data, args.cycles,
+                                         batch_cycles, use_compression, concurrent, args.certfile))
+    finally:
+        for server in servers:
+            server.stop()
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,17 +7,74 @@
 # Import necessary packages
 # ************************************************************************
 
+import bisect
 import enum
+import collections
 import json
 import time
-import datetime
-import gzip
+import hashlib
+import importlib.util
+import math
+import mmap
 import random
+import re
+import struct
+import sys
+import zlib
 import requests
-import traceback
+from requests.adapters import HTTPAdapter
 import os
+import ssl
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait as wait_for_futures
 from urllib.parse import urlparse
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Modules that are slow to import and only used by some runs are imported on first use: asyncio by the asyncio
+# versions of the send path, and numpy by the columnar data generator. Modules only used on error paths or by
+# optional features, such as traceback, gzip, csv and http.server, are imported by the functions using them
+
+
+def lazy_import(name):
+    '''Returns a module that is only loaded when one of its attributes is first used'''
+
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+asyncio = lazy_import('asyncio')
+
+# numpy, once import_numpy has been called, or None if it is not installed or has not been imported yet
+numpy = None
+numpy_imported = False
+
+
+def import_numpy():
+    '''Imports numpy on first use and returns it, or None if it is not installed'''
+    global numpy, numpy_imported
+
+    if not numpy_imported:
+        try:
+            import numpy as numpy_module
+            numpy = numpy_module
+        except ImportError:
+            numpy = None
+        numpy_imported = True
+
+    return numpy
+
 # ************************************************************************
 # Global Variables
 # ************************************************************************
@@ -25,12 +82,169 @@ from urllib.parse import urlparse
 # The version of the OMF messages
 omf_version = '1.2'
 
-# The number of seconds to sleep before sending another round of messages
+# The number of seconds between the starts of rounds of messages, however long sending a round takes
 sleep_time = 1
 
+# Whether cycles that were missed because a cycle took longer than sleep_time are sent one after another to catch up,
+# instead of being skipped to keep to the schedule
+catch_up_missed_cycles = False
+
+# The number of data cycles to gather before sending a batched data message, or None to only use the limits below
+batch_cycles = 1
+
+# Limits that send the gathered data as soon as any one of them is reached, or None to not use them: the number of
+# values gathered for any container, the estimated size in bytes of all gathered values, and the number of seconds
+# since the oldest gathered value
+flush_value_count = None
+flush_bytes = None
+flush_latency_seconds = None
+
+# The maximum number of values gathered per container, past which the oldest values of the container are dropped
+max_values_per_container = 100000
+
+# The maximum size in bytes of the serialized body of a single data message
+max_message_bytes = 192 * 1024
+
+# The gzip compression level of compressed messages, from 1 (fastest) to 9 (smallest)
+compression_level = 9
+
+# Whether messages are serialized with the faster orjson package when it is installed
+use_fast_json = True
+
+# Whether data messages are validated against their types and serialized by encoders compiled from OMF-Types.json
+use_compiled_encoders = True
+
+# The files of the OMF types, containers and data. Each is a json array, or an .ndjson/.jsonl file with one item per
+# line, and the containers can also be a .csv file with a column per property. The files are read incrementally
+omf_types_file = 'OMF-Types.json'
+omf_containers_file = 'OMF-Containers.json'
+omf_data_file = 'OMF-Data.json'
+
+# Whether CDS tokens are refreshed in the background before they expire, so that sending never waits on authentication
+background_token_refresh = True
+
+# The number of seconds before a CDS token expires at which it is refreshed in the background
+token_refresh_seconds = 10 * 60
+
+# The number of times a message is retried after a throttled, unavailable or timed out request
+max_retries = 3
+
+# The base and maximum delay in seconds of the exponential backoff between retries
+retry_backoff_seconds = 0.5
+retry_max_backoff_seconds = 30
+
+# The number of consecutive failed messages after which an endpoint is skipped, and for how many seconds
+circuit_breaker_threshold = 5
+circuit_breaker_reset_seconds = 60
+
+# Whether data messages that an endpoint cannot accept are stored on disk and forwarded once it recovers
+use_store_and_forward = False
+
+# The directory holding the store and forward queue of each endpoint
+store_and_forward_directory = 'omf_buffer'
+
+# The maximum size in bytes of each endpoint's store and forward queue, past which the oldest data is evicted
+store_and_forward_max_bytes = 512 * 1024 * 1024
+
+# The size in bytes at which the store and forward queue starts a new segment file
+store_and_forward_segment_bytes = 8 * 1024 * 1024
+
+# Whether the data of all containers of a type is generated at once in columns, instead of one container at a time by get_data
+use_columnar_data = False
+
+# A csv file of historical values to replay with their original timestamps instead of sending live data, or None
+replay_file = None
+
+# How many times faster than real time the values are replayed, or None to replay them as fast as the endpoints accept them
+replay_speed = None
+
+# The maximum number of values read from the replay file and sent at a time
+replay_batch_values = 50000
+
+# The file recording how far the replay file has been sent, so that an interrupted replay resumes from there
+replay_checkpoint_file = 'omf_replay_checkpoint.json'
+
+# Filters that only send the values of a container that changed enough, keyed by container id or type id, where a
+# container's own filter is used over the filter of its type, or None to send every value. Each filter is a dict with a
+# "Mode" of 'change', 'deadband' or 'swinging_door', the "Deviation" by which a numeric property must change for
+# deadband and swinging door, and optionally "MaxIntervalSeconds" after which a value is sent even if it did not change
+value_filters = None
+
+# Whether the columnar data is kept in compact container records, with epoch nanosecond timestamps, until it is encoded
+use_compact_records = True
+
+# Whether all containers in a cycle share a single timestamp, read from the clock once at the start of the cycle
+aligned_timestamps = True
+
+# The file caching the endpoint configurations, OMF types and OMF data read at startup, which short-lived runs reuse
+# while appsettings.json, the types and data files and program.py are unchanged, or None to read them every run.
+# Changes are detected by 'mtime' (modification time and size) or by 'hash' (sha256 of the contents)
+startup_cache_file = None
+startup_cache_validation = 'mtime'
+
+# The file caching a fingerprint of each type and container registered with each endpoint, or None to always send them
+registration_cache_file = 'omf_registration_cache.json'
+
+# The number of worker processes that the containers are sharded across, or 1 to send everything from this process
+worker_processes = 1
+
+# Whether messages are sent to all endpoints concurrently instead of one endpoint after another
+concurrent_fan_out = True
+
+# Whether the data messages of a batch are sent to each endpoint over several concurrent requests, starting at one and
+# adapted to the endpoint: raised by one while requests take at most target_request_seconds, and halved when a request
+# is throttled, fails to connect or takes longer. At most max_concurrent_requests are sent at once
+adaptive_concurrency = True
+max_concurrent_requests = 8
+target_request_seconds = 2
+
+# Whether the program runs on the asyncio event loop instead of blocking requests (requires aiohttp)
+use_asyncio = False
+
+# Where metrics of the send path are published: None to not collect them, 'prometheus' to serve them as text on
+# metrics_port, 'json' to write them to metrics_file, or a function that is called with a snapshot of the metrics
+metrics_sink = None
+metrics_port = 9108
+metrics_file = 'omf_metrics.json'
+
+# The number of seconds between writing the metrics to metrics_file or calling the metrics_sink function
+metrics_interval_seconds = 60
+
+# The names of the settings above, whose values run_sharded passes to its worker processes since they import this
+# program afresh. A metrics_sink function must be defined at module level for a worker process to receive it
+setting_names = (
+    'omf_version', 'sleep_time', 'catch_up_missed_cycles', 'batch_cycles', 'flush_value_count', 'flush_bytes',
+    'flush_latency_seconds', 'max_values_per_container', 'max_message_bytes', 'compression_level', 'use_fast_json',
+    'use_compiled_encoders', 'omf_types_file', 'omf_containers_file', 'omf_data_file', 'background_token_refresh',
+    'token_refresh_seconds', 'max_retries', 'retry_backoff_seconds', 'retry_max_backoff_seconds',
+    'circuit_breaker_threshold', 'circuit_breaker_reset_seconds', 'use_store_and_forward',
+    'store_and_forward_directory', 'store_and_forward_max_bytes', 'store_and_forward_segment_bytes',
+    'use_columnar_data', 'replay_file', 'replay_speed', 'replay_batch_values', 'replay_checkpoint_file',
+    'value_filters', 'use_compact_records', 'aligned_timestamps', 'startup_cache_file', 'startup_cache_validation',
+    'registration_cache_file', 'worker_processes', 'concurrent_fan_out', 'adaptive_concurrency',
+    'max_concurrent_requests', 'target_request_seconds', 'use_asyncio', 'metrics_sink', 'metrics_port',
+    'metrics_file', 'metrics_interval_seconds')
+
 # The configurations of the endpoints to send to
 endpoints = None
 
+# The thread pool used to send messages to all endpoints concurrently
+fan_out_executor = None
+
+# The shard of the containers handled by this process, when running as a worker process
+shard_index = None
+
+# The fingerprints of the types and containers registered with each endpoint, and its lock
+registration_cache = None
+registration_cache_lock = threading.Lock()
+
+# The service reading the clock and formatting timestamps
+timestamp_service = None
+
+# The metrics of the send path, or None when metrics are not collected, and the sink publishing them
+metrics = None
+metrics_publisher = None
+
 # Holders for data message values
 boolean_value_1 = 0
 boolean_value_2 = 1
@@ -43,6 +257,69 @@ class EndpointTypes(enum.Enum):
     EDS = 'EDS'
     PI = 'PI'
 
+# ************************************************************************
+# REQUIRED: creates the pooled keep-alive HTTP session for an endpoint
+# ************************************************************************
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    '''HTTP adapter that applies the endpoint's timeout and certificate verification to every request sent through it'''
+
+    def __init__(self, timeout=None, verify=True, **kwargs):
+        self.timeout = timeout
+        self.verify = verify
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs["timeout"] = self.timeout
+        # requests lets REQUESTS_CA_BUNDLE override a session's verify setting, so it is applied here instead
+        kwargs["verify"] = self.verify
+        return super().send(request, **kwargs)
+
+
+def get_session(endpoint):
+    '''Gets the session for the endpoint, creating it with the endpoint's pool, verify, auth and timeout settings on first use'''
+
+    if 'Session' in endpoint:
+        return endpoint["Session"]
+
+    session = requests.Session()
+
+    # connections are kept alive and reused by the adapter's connection pool
+    adapter = TimeoutHTTPAdapter(
+        timeout=endpoint["WebRequestTimeoutSeconds"],
+        verify=endpoint["VerifySSL"],
+        pool_maxsize=endpoint["PoolSize"])
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    # If the endpoint is PI
+    if endpoint["EndpointType"] == EndpointTypes.PI:
+        session.auth = (endpoint["Username"], endpoint["Password"])
+
+    # cache the session
+    endpoint["Session"] = session
+
+    return session
+
+
+def close_session(endpoint):
+    '''Closes the endpoint's session and its pooled connections, if one was created'''
+
+    timer = endpoint.pop('TokenRefreshTimer', None)
+    if timer is not None:
+        timer.cancel()
+
+    executor = endpoint.pop('RequestExecutor', None)
+    if executor is not None:
+        executor.shutdown()
+
+    session = endpoint.pop('Session', None)
+    if session is not None:
+        session.close()
+
+
 # ************************************************************************
 # REQUIRED: generates a bearer token for authentication
 # ************************************************************************
@@ -56,34 +333,124 @@ def get_token(endpoint):
     if endpoint_type != EndpointTypes.CDS:
         return ''
 
-    if (('expiration' in endpoint) and (endpoint["expiration"] - time.time()) > 5 * 60):
+    if is_token_current(endpoint):
         return endpoint["token"]
 
-    # we can't short circuit it, so we must go retreive it.
+    # we can't short circuit it, so we must go retreive it. Only one caller
+    # refreshes the token while the others wait for it and reuse it
+    with get_token_lock(endpoint):
+        if is_token_current(endpoint):
+            return endpoint["token"]
+
+        return refresh_token(endpoint)
+
+
+def get_token_lock(endpoint):
+    '''Gets the lock that makes concurrent callers share a single token refresh'''
+    return endpoint.setdefault('TokenLock', threading.Lock())
+
+
+def refresh_token(endpoint):
+    '''Requests a new token, caches it and schedules its background refresh'''
+
+    session = get_session(endpoint)
+
+    try:
+        # the token endpoint is only discovered once
+        if 'TokenUrl' not in endpoint:
+            discovery_url = session.get(
+                endpoint["Resource"] + '/identity/.well-known/openid-configuration',
+                headers={'Accept': 'application/json'})
+
+            if discovery_url.status_code < 200 or discovery_url.status_code >= 300:
+                discovery_url.close()
+                raise OmfTokenError(f'Failed to get access token endpoint from discovery URL: {discovery_url.status_code}:{discovery_url.text}',
+                                    discovery_url.status_code, parse_retry_after(discovery_url.headers.get('Retry-After')))
+
+            endpoint["TokenUrl"] = get_token_url(
+                endpoint, json.loads(discovery_url.content))
+
+        token_information = session.post(
+            endpoint["TokenUrl"],
+            data=get_token_request_data(endpoint))
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as ex:
+        raise OmfTokenError(f'Could not reach the identity service of {endpoint["Resource"]}: {ex}') from ex
+
+    if token_information.status_code < 200 or token_information.status_code >= 300:
+        token_information.close()
+        raise OmfTokenError(f'Failed to retrieve Token: {token_information.status_code}:{token_information.text}',
+                            token_information.status_code, parse_retry_after(token_information.headers.get('Retry-After')))
+
+    token = cache_token(endpoint, json.loads(token_information.content))
 
-    discovery_url = requests.get(
-        endpoint["Resource"] + '/identity/.well-known/openid-configuration',
-        headers={'Accept': 'application/json'},
-        verify=endpoint["VerifySSL"])
+    if metrics is not None:
+        metrics.increment('omf_token_refreshes_total', get_metric_labels(endpoint))
 
-    if discovery_url.status_code < 200 or discovery_url.status_code >= 300:
-        discovery_url.close()
-        raise Exception(f'Failed to get access token endpoint from discovery URL: {discovery_url.status_code}:{discovery_url.text}')
+    if background_token_refresh:
+        schedule_token_refresh(endpoint, get_token_refresh_delay(endpoint))
 
-    token_endpoint = json.loads(discovery_url.content)["token_endpoint"]
+    return token
+
+
+def get_token_refresh_delay(endpoint):
+    '''Returns the number of seconds until the cached token should be refreshed in the background'''
+    remaining = endpoint["expiration"] - time.time()
+    return max(remaining - token_refresh_seconds, remaining / 2, 0)
+
+
+def schedule_token_refresh(endpoint, delay):
+    '''Schedules a refresh of the endpoint's token on a background thread'''
+
+    previous_timer = endpoint.get('TokenRefreshTimer')
+    if previous_timer is not None:
+        previous_timer.cancel()
+
+    timer = threading.Timer(delay, refresh_token_in_background, args=(endpoint,))
+    timer.daemon = True
+    timer.start()
+    endpoint["TokenRefreshTimer"] = timer
+
+
+def refresh_token_in_background(endpoint):
+    '''Refreshes the endpoint's token, trying again shortly if the refresh fails'''
+
+    try:
+        with get_token_lock(endpoint):
+            refresh_token(endpoint)
+    except Exception as ex:
+        # callers still refresh the token themselves once it is about to expire
+        print(f'Background token refresh for {endpoint["Resource"]} failed: {ex}')
+        if metrics is not None:
+            metrics.increment('omf_token_refresh_failures_total', get_metric_labels(endpoint))
+        schedule_token_refresh(endpoint, 30)
+
+
+def is_token_current(endpoint):
+    '''Returns whether the endpoint has a cached token that is not about to expire'''
+    return ('expiration' in endpoint) and (endpoint["expiration"] - time.time()) > 5 * 60
+
+
+def get_token_url(endpoint, discovery_document):
+    '''Returns the validated token endpoint URL from the OpenID discovery document'''
+
+    token_endpoint = discovery_document["token_endpoint"]
     token_url = urlparse(token_endpoint)
     # Validate URL
     assert token_url.scheme == 'https'
     assert token_url.geturl().startswith(endpoint["Resource"])
 
-    token_information = requests.post(
-        token_url.geturl(),
-        data={'client_id': endpoint["ClientId"],
-              'client_secret': endpoint["ClientSecret"],
-              'grant_type': 'client_credentials'},
-        verify=endpoint["VerifySSL"])
+    return token_url.geturl()
+
+
+def get_token_request_data(endpoint):
+    '''Returns the form data of the client credentials token request'''
+    return {'client_id': endpoint["ClientId"],
+            'client_secret': endpoint["ClientSecret"],
+            'grant_type': 'client_credentials'}
+
 
-    token = json.loads(token_information.content)
+def cache_token(endpoint, token):
+    '''Caches the token and its expiration in the endpoint configuration'''
 
     if token is None:
         raise Exception('Failed to retrieve Token')
@@ -103,63 +470,1469 @@ def get_token(endpoint):
 # ************************************************************************
 
 
+class OmfSendError(Exception):
+    '''Raised when an OMF message could not be delivered. status_code is None if no response was received'''
+
+    def __init__(self, message, status_code=None, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    def is_endpoint_unavailable(self):
+        '''Returns whether the endpoint could not accept the message right now, rather than rejecting the message itself'''
+        return self.status_code is None or self.status_code in {408, 429} or self.status_code >= 500
+
+    def is_retriable(self):
+        '''Returns whether the request was throttled, timed out or hit a temporarily unavailable endpoint'''
+        return self.status_code is None or self.status_code in {408, 429, 502, 503, 504}
+
+
+class CircuitOpenError(OmfSendError):
+    '''Raised instead of sending to an endpoint whose circuit breaker is open'''
+
+
+class OmfTokenError(OmfSendError):
+    '''Raised when a token for the endpoint could not be discovered or retrieved'''
+
+    def is_endpoint_unavailable(self):
+        '''Returns True, since the message cannot be sent without a token however valid it is'''
+        return True
+
+
 def send_message_to_omf_endpoint(endpoint, message_type, message_omf_json, action='create'):
     '''Sends the request out to the preconfigured endpoint'''
 
+    message = get_omf_message(message_omf_json)
+    circuit_breaker = get_circuit_breaker(endpoint)
+    trial = circuit_breaker.check(endpoint)
+
+    try:
+        attempt = 0
+        while True:
+            try:
+                post_message_to_omf_endpoint(
+                    endpoint, message_type, message, action)
+            except OmfSendError as ex:
+                if not ex.is_retriable() or attempt >= max_retries:
+                    if ex.is_endpoint_unavailable():
+                        circuit_breaker.record_failure(endpoint)
+                    else:
+                        # a rejected message shows that the endpoint is reachable
+                        circuit_breaker.record_success()
+                        forget_definitions_of_rejected_data(endpoint, message_type, ex)
+                    if metrics is not None:
+                        metrics.increment('omf_failed_messages_total', get_metric_labels(endpoint, message_type))
+                    raise
+                if metrics is not None:
+                    metrics.increment('omf_retries_total', get_metric_labels(endpoint, message_type))
+                time.sleep(get_retry_delay(attempt, ex.retry_after))
+                attempt += 1
+            else:
+                circuit_breaker.record_success()
+                return
+    finally:
+        # any other error ends the trial too, so that the endpoint is not skipped for good
+        if trial:
+            circuit_breaker.end_trial()
+
+
+def post_message_to_omf_endpoint(endpoint, message_type, message, action):
+    '''Makes a single attempt at posting the message to the endpoint'''
+
     # Compress json omf payload, if specified
-    compression = 'none'
-    if endpoint["UseCompression"]:
-        msg_body = gzip.compress(bytes(json.dumps(message_omf_json), 'utf-8'))
-        compression = 'gzip'
-    else:
-        msg_body = json.dumps(message_omf_json)
+    msg_body, compression = encode_message(endpoint, message)
 
     # Collect the message headers
     msg_headers = get_headers(endpoint, compression, message_type, action)
 
-    # Send message to OMF endpoint
-    endpoints_type = endpoint["EndpointType"]
-    response = {}
-    # If the endpoint is CDS
-    if endpoints_type == EndpointTypes.CDS:
-        response = requests.post(
-            endpoint["OmfEndpoint"],
-            headers=msg_headers,
-            data=msg_body,
-            verify=endpoint["VerifySSL"],
-            timeout=endpoint["WebRequestTimeoutSeconds"]
-        )
-    # If the endpoint is EDS
-    elif endpoints_type == EndpointTypes.EDS:
-        response = requests.post(
-            endpoint["OmfEndpoint"],
-            headers=msg_headers,
-            data=msg_body,
-            timeout=endpoint["WebRequestTimeoutSeconds"]
-        )
-    # If the endpoint is PI
-    elif endpoints_type == EndpointTypes.PI:
-        response = requests.post(
+    # Send message to OMF endpoint over the endpoint's pooled session, which
+    # already carries the verify, auth and timeout settings of the endpoint
+    started = time.perf_counter()
+    try:
+        response = get_session(endpoint).post(
             endpoint["OmfEndpoint"],
             headers=msg_headers,
-            data=msg_body,
-            verify=endpoint["VerifySSL"],
-            timeout=endpoint["WebRequestTimeoutSeconds"],
-            auth=(endpoint["Username"], endpoint["Password"])
+            data=msg_body
         )
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as ex:
+        record_request_concurrency(endpoint, started, 'error')
+        if metrics is not None:
+            record_request_metrics(endpoint, message_type, 'error', started, len(msg_body))
+        raise OmfSendError(f'Could not reach {endpoint["OmfEndpoint"]}: {ex}') from ex
+
+    record_request_concurrency(endpoint, started, response.status_code)
+    if metrics is not None:
+        record_request_metrics(endpoint, message_type, response.status_code, started, len(msg_body))
+
+    # response code in 200s if the request was successful!
+    if not is_response_successful(response.status_code):
+        response.close()
+        report_unsuccessful_response(
+            message_type, message, msg_headers, response.status_code, response.text,
+            response.headers.get('Retry-After'))
+
+
+def encode_message(endpoint, message):
+    '''Returns the body of the message, compressed if the endpoint uses compression, and the compression used'''
+
+    if endpoint["UseCompression"]:
+        return message.gzip_bytes(), 'gzip'
+
+    return message.json_bytes(), 'none'
+
+
+def is_response_successful(status_code):
+    '''Returns whether the status code of an OMF response indicates success'''
 
     # Check for 409, which indicates that a type with the specified ID and version already exists.
-    if response.status_code == 409:
+    if status_code == 409:
+        return True
+
+    return 200 <= status_code < 300
+
+
+def report_unsuccessful_response(message_type, message, msg_headers, status_code, text, retry_after=None):
+    '''Raises an exception for an unsuccessful OMF response, printing the details if the message was rejected'''
+
+    error = OmfSendError(f'OMF message was unsuccessful, {message_type}. {status_code}:{text}',
+                         status_code, parse_retry_after(retry_after))
+
+    # throttled and unavailable responses are retried, so only print the message when it was rejected
+    if not error.is_endpoint_unavailable():
+        print({key: value for key, value in msg_headers.items() if key != 'Authorization'})
+        print(
+            f'Response from relay was bad. {message_type} message: {status_code} {text}.  Message holdings: {describe_message(message)}')
+        print()
+
+    raise error
+
+
+def describe_message(message, max_length=1000):
+    '''Returns the start of the serialized message and its size, so that rejected messages can be logged without flooding the log'''
+
+    json_bytes = message.json_bytes()
+    if len(json_bytes) <= max_length:
+        return json_bytes.decode('utf-8', 'replace')
+
+    return f'{json_bytes[:max_length].decode("utf-8", "replace")}... ({len(json_bytes)} bytes)'
+
+
+# ************************************************************************
+# Retries throttled and failed requests with backoff, and skips endpoints
+# that keep failing
+# ************************************************************************
+
+
+def parse_retry_after(retry_after):
+    '''Returns the number of seconds to wait from a Retry-After header given in seconds or as an HTTP date'''
+
+    if not retry_after:
+        return None
+
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+
+    import email.utils
+    try:
+        retry_date = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_date.timestamp() - time.time())
+
+
+def get_retry_delay(attempt, retry_after=None):
+    '''Returns the seconds to wait before a retry, honoring Retry-After or else using exponential backoff with full jitter'''
+
+    if retry_after is not None:
+        return min(retry_after, retry_max_backoff_seconds)
+
+    return random.uniform(0, min(retry_max_backoff_seconds, retry_backoff_seconds * 2 ** attempt))
+
+
+class CircuitBreaker:
+    '''Opens after consecutive failures so that a failing endpoint is skipped, then lets a trial request through after a while'''
+
+    def __init__(self, threshold=None, reset_seconds=None):
+        self.threshold = threshold if threshold is not None else circuit_breaker_threshold
+        self.reset_seconds = reset_seconds if reset_seconds is not None else circuit_breaker_reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def check(self, endpoint):
+        '''Raises CircuitOpenError if requests to the endpoint should be skipped right now, and returns whether this is the trial request'''
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            if time.monotonic() - self.opened_at >= self.reset_seconds and not self.trial_in_flight:
+                # half open: let a single trial request through
+                self.trial_in_flight = True
+                return True
+        raise CircuitOpenError(
+            f'Skipping {endpoint["OmfEndpoint"]} after {self.failures} consecutive failures')
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self, endpoint):
+        with self.lock:
+            self.failures += 1
+            if self.trial_in_flight or (self.opened_at is None and self.failures >= self.threshold):
+                if self.opened_at is None:
+                    print(f'Opening the circuit breaker of {endpoint["OmfEndpoint"]} for {self.reset_seconds} seconds')
+                self.opened_at = time.monotonic()
+                self.trial_in_flight = False
+
+    def end_trial(self):
+        '''Lets another trial request through once a trial ended without a success or failure being recorded'''
+        with self.lock:
+            self.trial_in_flight = False
+
+
+def get_circuit_breaker(endpoint):
+    '''Gets the circuit breaker of the endpoint, creating it on first use'''
+
+    if 'CircuitBreaker' not in endpoint:
+        endpoint["CircuitBreaker"] = CircuitBreaker()
+
+    return endpoint["CircuitBreaker"]
+
+
+class ConcurrencyLimiter:
+    '''Adapts the number of concurrent requests to an endpoint by additive increase and multiplicative decrease
+
+    The limit grows by one for every limit's worth of requests that take at most the target time,
+    and halves when a request is throttled, fails to connect or takes longer. It halves at most once
+    per round trip, so that the requests in flight during one slowdown only count once.'''
+
+    def __init__(self, max_limit=None, target_seconds=None):
+        self.max_limit = max_limit if max_limit is not None else max_concurrent_requests
+        self.target_seconds = target_seconds if target_seconds is not None else target_request_seconds
+        self.limit = 1.0
+        self.decreased_at = None
+        self.lock = threading.Lock()
+
+    def current(self):
+        '''Returns the number of requests that may be in flight at once'''
+        return int(self.limit)
+
+    def record(self, seconds, throttled):
+        '''Adapts the limit to a request that took the given seconds and was throttled or not, and returns the new limit'''
+        with self.lock:
+            if throttled or seconds > self.target_seconds:
+                now = time.monotonic()
+                if self.decreased_at is None or now - self.decreased_at >= seconds:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.decreased_at = now
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            return int(self.limit)
+
+
+def get_concurrency_limiter(endpoint):
+    '''Gets the concurrency limiter of the endpoint, creating it on first use'''
+
+    if 'ConcurrencyLimiter' not in endpoint:
+        # more concurrent requests than pooled connections would open connections that are not kept alive
+        endpoint["ConcurrencyLimiter"] = ConcurrencyLimiter(
+            min(max_concurrent_requests, endpoint.get('PoolSize') or max_concurrent_requests))
+
+    return endpoint["ConcurrencyLimiter"]
+
+
+def record_request_concurrency(endpoint, started, status):
+    '''Adapts the concurrency limit of the endpoint to a request that started at the given perf_counter'''
+
+    limit = get_concurrency_limiter(endpoint).record(
+        time.perf_counter() - started, status == 'error' or status in {408, 429, 503})
+    if metrics is not None:
+        metrics.set_gauge('omf_concurrency_limit', get_metric_labels(endpoint), limit)
+
+
+# ************************************************************************
+# Collects counters, gauges and histograms of the send path and publishes
+# them to a Prometheus text endpoint, a json file or a custom function
+# ************************************************************************
+
+# The upper bounds of the histogram buckets of durations in seconds and of compression ratios
+seconds_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+ratio_buckets = (1, 1.5, 2, 3, 5, 10, 20, 50)
+
+
+class Histogram:
+    '''Counts observations in buckets by upper bound, along with their count and sum'''
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        '''Returns (upper bound, number of observations up to it) for every bucket, ending with +Inf'''
+        total = 0
+        counts = []
+        for upper_bound, count in zip(self.buckets + ('+Inf',), self.bucket_counts):
+            total += count
+            counts.append((upper_bound, total))
+        return counts
+
+
+class Metrics:
+    '''Thread-safe counters, gauges and histograms, each identified by a name and a tuple of (label, value) pairs'''
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name, labels=(), value=1):
+        with self.lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, labels, value):
+        with self.lock:
+            self.gauges[(name, labels)] = value
+
+    def observe(self, name, labels, value, buckets=seconds_buckets):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = Histogram(buckets)
+            histogram.observe(value)
+
+    def snapshot(self):
+        '''Returns the current metrics as json objects'''
+
+        with self.lock:
+            return {
+                "Timestamp": format_timestamp_ns(time.time_ns()),
+                "Counters": [{"Name": name, "Labels": dict(labels), "Value": value}
+                             for (name, labels), value in self.counters.items()],
+                "Gauges": [{"Name": name, "Labels": dict(labels), "Value": value}
+                           for (name, labels), value in self.gauges.items()],
+                "Histograms": [{"Name": name, "Labels": dict(labels), "Count": histogram.count, "Sum": histogram.sum,
+                                "Buckets": {str(upper_bound): count for upper_bound, count in histogram.cumulative_counts()}}
+                               for (name, labels), histogram in self.histograms.items()]
+            }
+
+    def to_prometheus_text(self):
+        '''Returns the current metrics in the Prometheus text exposition format'''
+
+        lines = []
+        with self.lock:
+            for metric_type, values in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f'# TYPE {name} {metric_type}')
+                    for (metric_name, labels), value in values.items():
+                        if metric_name == name:
+                            lines.append(f'{name}{format_labels(labels)} {value}')
+
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f'# TYPE {name} histogram')
+                for (metric_name, labels), histogram in self.histograms.items():
+                    if metric_name != name:
+                        continue
+                    for upper_bound, count in histogram.cumulative_counts():
+                        lines.append(f'{name}_bucket{format_labels(labels + (("le", upper_bound),))} {count}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+                    lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    '''Formats (label, value) pairs as a Prometheus label set'''
+
+    if not labels:
+        return ''
+
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    return '{' + ','.join(f'{label}="{escape(value)}"' for label, value in labels) + '}'
+
+
+def get_metric_labels(endpoint, message_type=None):
+    '''Returns the labels identifying the endpoint, and the message type if given, of a metric'''
+
+    if message_type is None:
+        return (('endpoint', endpoint["OmfEndpoint"]),)
+
+    return (('endpoint', endpoint["OmfEndpoint"]), ('message_type', message_type))
+
+
+def record_request_metrics(endpoint, message_type, status, started, body_bytes):
+    '''Records the latency, outcome and size of a request started at the given perf_counter time'''
+
+    labels = get_metric_labels(endpoint, message_type)
+    metrics.observe('omf_request_seconds', labels, time.perf_counter() - started)
+    metrics.increment('omf_requests_total', labels + (('status', str(status)),))
+    metrics.increment('omf_sent_bytes_total', labels, body_bytes)
+
+
+class PeriodicMetricsPublisher:
+    '''Calls a function with a snapshot of the metrics every interval on a background thread, and once more when stopped'''
+
+    def __init__(self, metrics, publish, interval_seconds):
+        self.metrics = metrics
+        self.publish = publish
+        self.interval_seconds = interval_seconds
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='omf-metrics', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self._publish()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval_seconds):
+            self._publish()
+
+    def _publish(self):
+        try:
+            self.publish(self.metrics.snapshot())
+        except Exception as ex:
+            print(f'Publishing metrics failed: {ex}')
+
+
+class PrometheusMetricsServer:
+    '''Serves the metrics in the Prometheus text format on /metrics from a background thread'''
+
+    def __init__(self, metrics, port):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.to_prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('', port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='omf-metrics', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def write_metrics_file(snapshot):
+    '''Replaces the metrics file with the snapshot, so that readers never see a partly written file'''
+
+    temporary_file = get_shard_path(metrics_file) + '.tmp'
+    with open(temporary_file, 'w') as f:
+        json.dump(snapshot, f, indent=2)
+    os.replace(temporary_file, get_shard_path(metrics_file))
+
+
+def start_metrics():
+    '''Starts collecting metrics and publishing them to the metrics sink, unless metrics_sink is None'''
+    global metrics, metrics_publisher
+
+    if metrics_sink is None or metrics_publisher is not None:
+        return
+
+    metrics = Metrics()
+    if metrics_sink == 'prometheus':
+        # each worker process serves its own shard on the following ports
+        port = metrics_port if shard_index is None else metrics_port + shard_index + 1
+        metrics_publisher = PrometheusMetricsServer(metrics, port)
+    elif metrics_sink == 'json':
+        metrics_publisher = PeriodicMetricsPublisher(metrics, write_metrics_file, metrics_interval_seconds)
+    elif callable(metrics_sink):
+        metrics_publisher = PeriodicMetricsPublisher(metrics, metrics_sink, metrics_interval_seconds)
+    else:
+        raise ValueError('Invalid metrics sink')
+
+    metrics_publisher.start()
+
+
+def stop_metrics():
+    '''Publishes the metrics a last time and stops collecting them'''
+    global metrics, metrics_publisher
+
+    if metrics_publisher is not None:
+        metrics_publisher.stop()
+
+    metrics = None
+    metrics_publisher = None
+
+
+# ************************************************************************
+# Serializes and compresses a message once so that the same bytes can be
+# sent to every endpoint
+# ************************************************************************
+
+
+def dumps_json(obj):
+    '''Serializes an object to JSON bytes, using orjson when it is installed and enabled'''
+
+    if use_fast_json and orjson is not None:
+        return orjson.dumps(obj)
+
+    return json.dumps(obj).encode('utf-8')
+
+
+class OmfMessage:
+    '''An OMF message whose JSON and gzip bytes are each encoded at most once and then reused'''
+
+    def __init__(self, message_omf_json=None, json_bytes=None, containerids=None):
+        self.message_omf_json = message_omf_json
+        self._json_bytes = json_bytes
+        self._gzip_bytes = None
+        self._lock = threading.Lock()
+        # the ids of the containers whose data the message holds, when known
+        self.containerids = containerids
+
+    def get_containerids(self):
+        '''Returns the ids of the containers whose data the message holds, or None if they are not known'''
+        if self.containerids is None and isinstance(self.message_omf_json, list):
+            self.containerids = frozenset(data["containerid"] for data in self.message_omf_json)
+        elif self.containerids is None and isinstance(self.message_omf_json, dict):
+            self.containerids = frozenset((self.message_omf_json["containerid"],))
+        return self.containerids
+
+    def get_json(self):
+        '''Returns the message as json objects, parsing it if it was created from serialized bytes'''
+        if self.message_omf_json is None:
+            self.message_omf_json = json.loads(self._json_bytes)
+        return self.message_omf_json
+
+    def json_bytes(self):
+        '''Returns the serialized JSON bytes of the message'''
+        if self._json_bytes is None:
+            with self._lock:
+                if self._json_bytes is None:
+                    started = time.perf_counter()
+                    self._json_bytes = dumps_json(self.message_omf_json)
+                    if metrics is not None:
+                        metrics.observe('omf_encode_seconds', (('encoding', 'json'),),
+                                        time.perf_counter() - started)
+        return self._json_bytes
+
+    def gzip_bytes(self):
+        '''Returns the gzip compressed JSON bytes of the message'''
+        if self._gzip_bytes is None:
+            json_bytes = self.json_bytes()
+            with self._lock:
+                if self._gzip_bytes is None:
+                    import gzip
+                    started = time.perf_counter()
+                    self._gzip_bytes = gzip.compress(
+                        json_bytes, compresslevel=compression_level)
+                    if metrics is not None:
+                        metrics.observe('omf_encode_seconds', (('encoding', 'gzip'),),
+                                        time.perf_counter() - started)
+                        metrics.observe('omf_compression_ratio', (),
+                                        len(json_bytes) / len(self._gzip_bytes), ratio_buckets)
+        return self._gzip_bytes
+
+
+def get_omf_message(message_omf_json):
+    '''Wraps the message in an OmfMessage, unless it is one already'''
+
+    if isinstance(message_omf_json, OmfMessage):
+        return message_omf_json
+
+    return OmfMessage(message_omf_json)
+
+
+# ************************************************************************
+# Stores the data messages an endpoint cannot accept on disk and forwards
+# them in bulk once the endpoint recovers
+# ************************************************************************
+
+
+class StoreAndForwardQueue:
+    '''A size-bounded on-disk queue of serialized data messages, kept in append-only segment files
+
+    Each record is a 4 byte big endian length followed by the message bytes. The position of the
+    oldest unsent record is kept in a cursor file, so that the backlog survives a restart.'''
+
+    record_header = struct.Struct('>I')
+
+    def __init__(self, directory, max_bytes=None, segment_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes if max_bytes is not None else store_and_forward_max_bytes
+        self.segment_bytes = segment_bytes if segment_bytes is not None else store_and_forward_segment_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        # the index and size of each segment file, oldest first
+        self.segments = {}
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith('.seg'):
+                index = int(filename[:-4])
+                self.segments[index] = self._recover_segment(index)
+
+        self.cursor = self._read_cursor()
+
+    def _segment_path(self, index):
+        return os.path.join(self.directory, f'{index:010d}.seg')
+
+    def _cursor_path(self):
+        return os.path.join(self.directory, 'cursor')
+
+    def _recover_segment(self, index):
+        '''Truncates a record left incomplete by an interrupted write and returns the segment size'''
+        path = self._segment_path(index)
+        size = os.path.getsize(path)
+        offset = 0
+        with open(path, 'rb') as f:
+            while offset + self.record_header.size <= size:
+                f.seek(offset)
+                (length,) = self.record_header.unpack(
+                    f.read(self.record_header.size))
+                if offset + self.record_header.size + length > size:
+                    break
+                offset += self.record_header.size + length
+        if offset != size:
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+        return offset
+
+    def _read_cursor(self):
+        try:
+            with open(self._cursor_path(), 'r') as f:
+                index, offset = (int(part) for part in f.read().split())
+        except (OSError, ValueError):
+            index, offset = (min(self.segments) if self.segments else 0), 0
+
+        # the segment the cursor points into may have been evicted
+        if self.segments and index < min(self.segments):
+            index, offset = min(self.segments), 0
+        return (index, offset)
+
+    def _write_cursor(self, cursor):
+        temporary_path = self._cursor_path() + '.tmp'
+        with open(temporary_path, 'w') as f:
+            f.write(f'{cursor[0]} {cursor[1]}')
+        os.replace(temporary_path, self._cursor_path())
+        self.cursor = cursor
+
+    def size(self):
+        '''Returns the number of bytes of unsent records in the queue'''
+        index, offset = self.cursor
+        return sum(size for segment, size in self.segments.items() if segment >= index) - offset
+
+    def is_empty(self):
+        return self.size() <= 0
+
+    def append(self, record):
+        '''Appends a record to the newest segment, evicting the oldest segments if the queue is full'''
+
+        index = max(self.segments) if self.segments else self.cursor[0]
+        if index in self.segments and self.segments[index] + self.record_header.size + len(record) > self.segment_bytes:
+            index += 1
+
+        with open(self._segment_path(index), 'ab') as f:
+            f.write(self.record_header.pack(len(record)))
+            f.write(record)
+        self.segments[index] = self.segments.get(
+            index, 0) + self.record_header.size + len(record)
+
+        self._evict()
+
+    def _evict(self):
+        evicted_bytes = 0
+        while len(self.segments) > 1 and sum(self.segments.values()) > self.max_bytes:
+            oldest = min(self.segments)
+            evicted_bytes += self.segments.pop(oldest)
+            os.remove(self._segment_path(oldest))
+            if self.cursor[0] <= oldest:
+                self._write_cursor((min(self.segments), 0))
+
+        if evicted_bytes:
+            print(f'Store and forward queue {self.directory} is full, evicted the oldest {evicted_bytes} bytes of data')
+
+    def read(self, max_bytes):
+        '''Returns the oldest unsent records up to max_bytes in total (at least one record) and the position after them'''
+
+        records = []
+        total_bytes = 0
+        index, offset = self.cursor
+        for segment in sorted(segment for segment in self.segments if segment >= index):
+            if segment != index:
+                offset = 0
+            size = self.segments[segment]
+            if offset >= size:
+                continue
+
+            with open(self._segment_path(segment), 'rb') as f, \
+                    mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mapped:
+                while offset < size:
+                    (length,) = self.record_header.unpack_from(mapped, offset)
+                    if records and total_bytes + length > max_bytes:
+                        return records, (segment, offset)
+                    start = offset + self.record_header.size
+                    records.append(mapped[start:start + length])
+                    total_bytes += length
+                    offset = start + length
+
+            index = segment
+
+        return records, (index, offset)
+
+    def commit(self, position):
+        '''Marks the records before position as sent and deletes the segments that are fully sent'''
+
+        for segment in [segment for segment in self.segments if segment < position[0]]:
+            del self.segments[segment]
+            os.remove(self._segment_path(segment))
+        self._write_cursor(position)
+
+
+def get_endpoint_key(endpoint):
+    '''Returns a short stable key identifying the endpoint, for naming files kept per endpoint'''
+    return hashlib.sha256(endpoint["OmfEndpoint"].encode('utf-8')).hexdigest()[:16]
+
+
+def get_store_and_forward_queue(endpoint):
+    '''Gets the store and forward queue of the endpoint, opening it on first use'''
+
+    if 'StoreAndForwardQueue' not in endpoint:
+        endpoint["StoreAndForwardQueue"] = StoreAndForwardQueue(
+            get_shard_path(os.path.join(store_and_forward_directory, get_endpoint_key(endpoint))))
+
+    return endpoint["StoreAndForwardQueue"]
+
+
+def merge_data_messages(records):
+    '''Merges serialized data messages, each a json array, into the bytes of a single data message'''
+    return b'[' + b','.join(record[1:-1].strip() for record in records if record[1:-1].strip()) + b']'
+
+
+def is_endpoint_unavailable(error):
+    '''Returns whether the error means the endpoint could not accept a message right now'''
+    return isinstance(error, OmfSendError) and error.is_endpoint_unavailable()
+
+
+def is_message_rejected(error):
+    '''Returns whether the endpoint rejected the message itself, so that sending it again would not help'''
+    return isinstance(error, OmfSendError) and not error.is_endpoint_unavailable()
+
+
+def store_messages(endpoint, queue, messages, error):
+    '''Stores the messages in the endpoint's queue after the endpoint failed to accept them'''
+
+    print(f'{endpoint["OmfEndpoint"]} is unavailable, storing data to forward later: {error}')
+    for message in messages:
+        queue.append(message.json_bytes())
+
+    if metrics is not None:
+        metrics.set_gauge('omf_store_and_forward_bytes', get_metric_labels(endpoint), queue.size())
+
+
+def forward_stored_messages(endpoint, queue):
+    '''Sends the backlog of the endpoint's queue in bulk and returns whether the backlog was fully drained'''
+
+    while not queue.is_empty():
+        records, position = queue.read(max_message_bytes)
+        try:
+            send_message_to_omf_endpoint(endpoint, 'data', OmfMessage(
+                json_bytes=merge_data_messages(records)))
+        except Exception as ex:
+            if not is_message_rejected(ex):
+                return False
+            # a rejected message would otherwise block the queue forever
+            print(f'Dropping stored data rejected by {endpoint["OmfEndpoint"]}: {ex}')
+        queue.commit(position)
+        if metrics is not None:
+            metrics.set_gauge('omf_store_and_forward_bytes', get_metric_labels(endpoint), queue.size())
+
+    return True
+
+
+def send_data_with_store_and_forward(endpoint, messages):
+    '''Sends data messages once the endpoint's backlog has drained, storing them if the endpoint is unavailable'''
+
+    queue = get_store_and_forward_queue(endpoint)
+
+    # new data is only sent after all the stored data, to keep the data in order
+    if not forward_stored_messages(endpoint, queue):
+        store_messages(endpoint, queue, messages,
+                       'stored data has not been forwarded yet')
         return
 
-    # response code in 200s if the request was successful!
-    if response.status_code < 200 or response.status_code >= 300:
-        print(msg_headers)
-        response.close()
-        print(
-            f'Response from relay was bad. {message_type} message: {response.status_code} {response.text}.  Message holdings: {message_omf_json}')
-        print()
-        raise Exception(f'OMF message was unsuccessful, {message_type}. {response.status_code}:{response.text}')
+    for i, message in enumerate(messages):
+        try:
+            send_message_to_omf_endpoint(endpoint, 'data', message)
+        except Exception as ex:
+            if is_message_rejected(ex):
+                raise
+            store_messages(endpoint, queue, messages[i:], ex)
+            return
+
+
+# ************************************************************************
+# Sends the same messages to all endpoints concurrently
+# ************************************************************************
+
+
+def send_messages_to_endpoint(endpoint, message_type, messages, action='create'):
+    '''Sends the messages to the endpoint in order, except for data messages sent over adaptive concurrent requests'''
+
+    if use_store_and_forward and message_type == 'data' and action == 'create':
+        send_data_with_store_and_forward(endpoint, messages)
+        return
+
+    if adaptive_concurrency and message_type == 'data' and action == 'create' and len(messages) > 1:
+        send_data_concurrently(endpoint, messages)
+        return
+
+    for message in messages:
+        send_message_to_omf_endpoint(endpoint, message_type, message, action)
+
+
+def get_request_executor(endpoint):
+    '''Gets the thread pool sending concurrent requests to the endpoint, creating it on first use'''
+
+    if 'RequestExecutor' not in endpoint:
+        endpoint["RequestExecutor"] = ThreadPoolExecutor(
+            max_workers=get_concurrency_limiter(endpoint).max_limit, thread_name_prefix='omf-request')
+
+    return endpoint["RequestExecutor"]
+
+
+def get_first_error(done, error=None):
+    '''Returns the error if there already is one, or else the exception of the first finished future that failed'''
+
+    for future in done:
+        # every exception is retrieved, so that none of them is reported as unhandled
+        exception = future.exception()
+        if error is None:
+            error = exception
+
+    return error
+
+
+def holds_containers_in_flight(containerids, pending):
+    '''Returns whether a message holds data of a container that a request in flight also holds, which is assumed
+    when the containers of either are not known'''
+
+    for containerids_in_flight in pending.values():
+        if containerids is None or containerids_in_flight is None or not containerids.isdisjoint(containerids_in_flight):
+            return True
+
+    return False
+
+
+def send_data_concurrently(endpoint, messages):
+    '''Sends the data messages to the endpoint over as many concurrent requests as its concurrency limiter allows
+
+    A message is only started once no request in flight holds data of the same containers, so the
+    values of each container, which a batch may split over several messages, arrive in order. Once
+    a message fails, no more messages are started and the error is raised after the requests in
+    flight have finished.'''
+
+    limiter = get_concurrency_limiter(endpoint)
+    executor = get_request_executor(endpoint)
+    # the ids of the containers held by each request in flight
+    pending = {}
+    error = None
+
+    for message in messages:
+        message = get_omf_message(message)
+        containerids = message.get_containerids()
+        while pending and error is None and (
+                len(pending) >= limiter.current() or holds_containers_in_flight(containerids, pending)):
+            done, _ = wait_for_futures(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                del pending[future]
+            error = get_first_error(done, error)
+        if error is not None:
+            break
+        pending[executor.submit(send_message_to_omf_endpoint, endpoint, 'data', message)] = containerids
+
+    error = get_first_error(wait_for_futures(pending).done, error)
+    if error is not None:
+        raise error
+
+
+def send_to_all_endpoints(endpoints, message_type, messages, action='create'):
+    '''Sends the messages to every endpoint and returns a list of (endpoint, error) for the endpoints that failed'''
+
+    # encode each message once for all endpoints
+    messages = [get_omf_message(message) for message in messages]
+
+    return run_on_all_endpoints(endpoints, send_messages_to_endpoint, message_type, messages, action)
+
+
+def run_on_all_endpoints(endpoints, function, *args):
+    '''Calls function(endpoint, *args) for every endpoint and returns a list of (endpoint, error) for the endpoints that failed'''
+    global fan_out_executor
+
+    errors = []
+
+    # run in the calling thread when there is nothing to run concurrently
+    if not concurrent_fan_out or len(endpoints) < 2:
+        for endpoint in endpoints:
+            try:
+                function(endpoint, *args)
+            except Exception as ex:
+                errors.append((endpoint, ex))
+        return errors
+
+    if fan_out_executor is None:
+        fan_out_executor = ThreadPoolExecutor(
+            max_workers=len(endpoints), thread_name_prefix='omf-fan-out')
+
+    # one task per endpoint keeps each endpoint's messages in order, while a
+    # slow or failing endpoint does not hold up or stop the other endpoints
+    futures = [(endpoint, fan_out_executor.submit(function, endpoint, *args))
+               for endpoint in endpoints]
+
+    for endpoint, future in futures:
+        error = future.exception()
+        if error is not None:
+            errors.append((endpoint, error))
+
+    return errors
+
+
+def check_endpoint_errors(errors, tolerate_unavailable=False):
+    '''Reports the error of each endpoint that failed and raises the first one, unless unavailable endpoints are tolerated'''
+
+    for endpoint, error in errors:
+        print(f'Sending to {endpoint["OmfEndpoint"]} failed: {error}')
+
+    if tolerate_unavailable:
+        # an unavailable endpoint is skipped so that the other endpoints keep receiving data
+        errors = [(endpoint, error)
+                  for endpoint, error in errors if not is_endpoint_unavailable(error)]
+
+    if errors:
+        raise errors[0][1]
+
+
+def shutdown_fan_out():
+    '''Shuts down the thread pool used to send messages to all endpoints'''
+    global fan_out_executor
+
+    if fan_out_executor is not None:
+        fan_out_executor.shutdown()
+        fan_out_executor = None
+
+
+# ************************************************************************
+# Registers types and containers in a few batched messages, skipping the
+# definitions that each endpoint already has
+# ************************************************************************
+
+
+def get_definition_fingerprint(definition):
+    '''Returns a hash of the content of a type or container definition'''
+    return hashlib.sha256(json.dumps(definition, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+def get_registration_cache():
+    '''Gets the fingerprints of the definitions registered with each endpoint, loading them from disk on first use'''
+    global registration_cache
+
+    if registration_cache is None:
+        registration_cache = {}
+        if registration_cache_file is not None and os.path.exists(get_shard_path(registration_cache_file)):
+            try:
+                with open(get_shard_path(registration_cache_file), 'r') as f:
+                    registration_cache = json.load(f)
+            except (OSError, ValueError) as error:
+                print(f'Ignoring unreadable registration cache {get_shard_path(registration_cache_file)}: {error}')
+
+    return registration_cache
+
+
+def save_registration_cache():
+    '''Writes the registration cache to disk'''
+
+    if registration_cache_file is None or registration_cache is None:
+        return
+
+    with registration_cache_lock:
+        temporary_file = get_shard_path(registration_cache_file) + '.tmp'
+        with open(temporary_file, 'w') as f:
+            json.dump(registration_cache, f)
+        os.replace(temporary_file, get_shard_path(registration_cache_file))
+
+
+def get_unregistered_definitions(endpoint, message_type, definitions):
+    '''Returns a list of (definition, fingerprint) for the definitions the endpoint does not have in their current form'''
+
+    with registration_cache_lock:
+        registered = get_registration_cache().get(
+            get_endpoint_key(endpoint), {}).get(message_type, {})
+
+    unregistered = []
+    for definition in definitions:
+        fingerprint = get_definition_fingerprint(definition)
+        if registered.get(definition["id"]) != fingerprint:
+            unregistered.append((definition, fingerprint))
+
+    return unregistered
+
+
+def record_registered_definitions(endpoint, message_type, registered):
+    '''Records the fingerprints of definitions that the endpoint accepted'''
+
+    with registration_cache_lock:
+        fingerprints = get_registration_cache().setdefault(
+            get_endpoint_key(endpoint), {}).setdefault(message_type, {})
+        for definition, fingerprint in registered:
+            fingerprints[definition["id"]] = fingerprint
+
+
+def forget_registered_definitions(endpoint):
+    '''Removes the endpoint from the registration cache, for example after its types and containers were deleted'''
+
+    with registration_cache_lock:
+        forgotten = get_registration_cache().pop(get_endpoint_key(endpoint), None)
+    if forgotten is not None:
+        save_registration_cache()
+
+    # the types are registered by the main process and cached in its own file, which a worker process deletes, since
+    # several workers could not update it safely. The main process then sends all types again on the next start
+    if shard_index is not None and registration_cache_file is not None:
+        try:
+            os.remove(registration_cache_file)
+        except FileNotFoundError:
+            pass
+
+
+def forget_definitions_of_rejected_data(endpoint, message_type, error):
+    '''Removes the endpoint from the registration cache when it rejects data or containers as not found or bad, since
+    its types or containers may have been deleted, so that they are all registered again on the next start'''
+
+    if message_type in ('data', 'container') and error.status_code in (400, 404):
+        forget_registered_definitions(endpoint)
+
+
+def register_definitions(endpoint, omf_types, omf_containers, save_cache=True):
+    '''Sends the types and then the containers that the endpoint does not have yet, in size-bounded batches'''
+
+    for message_type, definitions in (('type', omf_types), ('container', omf_containers)):
+        pending = get_unregistered_definitions(endpoint, message_type, definitions)
+        try:
+            for batch in batch_messages([definition for definition, _ in pending]):
+                send_message_to_omf_endpoint(endpoint, message_type, batch)
+                record_registered_definitions(
+                    endpoint, message_type, pending[:len(batch)])
+                pending = pending[len(batch):]
+        finally:
+            if save_cache:
+                save_registration_cache()
+
+
+def read_container_ids(omf_containers, container_ids):
+    '''Yields the containers while keeping only their id and type id in container_ids, for sending their data later'''
+
+    # share one string per type id between the containers of a type
+    typeids = {}
+    for omf_container in omf_containers:
+        typeid = typeids.setdefault(omf_container["typeid"], omf_container["typeid"])
+        container_ids.append({"id": omf_container["id"], "typeid": typeid})
+        yield omf_container
+
+
+def register_streamed_definitions(endpoints, omf_types, omf_containers):
+    '''Registers the types with all endpoints, then the containers batch by batch as they are read, and returns the id and type id of each container'''
+
+    container_ids = []
+    try:
+        check_endpoint_errors(run_on_all_endpoints(
+            endpoints, register_definitions, omf_types, [], False))
+        for batch in iter_batches(read_container_ids(omf_containers, container_ids)):
+            check_endpoint_errors(run_on_all_endpoints(
+                endpoints, register_definitions, [], batch, False))
+    finally:
+        # the cache is saved once instead of after every batch
+        save_registration_cache()
+
+    return container_ids
+
+
+# ************************************************************************
+# Asyncio versions of the send path, for running many messages on one
+# event loop. These require the aiohttp package.
+# ************************************************************************
+
+
+def get_async_session(endpoint):
+    '''Gets the aiohttp session for the endpoint, creating it with the endpoint's pool, verify, auth and timeout settings on first use'''
+
+    if 'AsyncSession' in endpoint:
+        return endpoint["AsyncSession"]
+
+    import aiohttp
+
+    # VerifySSL may be a boolean or the path to a .pem certificate file
+    verify = endpoint["VerifySSL"]
+    if isinstance(verify, str):
+        ssl_setting = ssl.create_default_context(cafile=verify)
+    elif verify:
+        ssl_setting = True
+    else:
+        ssl_setting = False
+
+    auth = None
+    # If the endpoint is PI
+    if endpoint["EndpointType"] == EndpointTypes.PI:
+        auth = aiohttp.BasicAuth(endpoint["Username"], endpoint["Password"])
+
+    session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=endpoint["PoolSize"], ssl=ssl_setting),
+        timeout=aiohttp.ClientTimeout(
+            total=endpoint["WebRequestTimeoutSeconds"]),
+        auth=auth)
+
+    # cache the session
+    endpoint["AsyncSession"] = session
+
+    return session
+
+
+async def close_session_async(endpoint):
+    '''Closes the endpoint's aiohttp session, if one was created'''
+
+    task = endpoint.pop('AsyncTokenRefreshTask', None)
+    if task is not None:
+        task.cancel()
+
+    session = endpoint.pop('AsyncSession', None)
+    if session is not None:
+        await session.close()
+
+
+async def get_token_async(endpoint):
+    '''Gets the token for the omfendpoint, sharing a single refresh between concurrent callers'''
+
+    endpoint_type = endpoint["EndpointType"]
+    # return an empty string if the endpoint is not an CDS type
+    if endpoint_type != EndpointTypes.CDS:
+        return ''
+
+    if is_token_current(endpoint):
+        return endpoint["token"]
+
+    if 'AsyncTokenLock' not in endpoint:
+        endpoint["AsyncTokenLock"] = asyncio.Lock()
+
+    async with endpoint["AsyncTokenLock"]:
+        # another caller may have refreshed the token while this one waited
+        if is_token_current(endpoint):
+            return endpoint["token"]
+
+        return await refresh_token_async(endpoint)
+
+
+async def refresh_token_async(endpoint):
+    '''Requests a new token, caches it and schedules its background refresh'''
+
+    session = get_async_session(endpoint)
+
+    import aiohttp
+
+    try:
+        # the token endpoint is only discovered once
+        if 'TokenUrl' not in endpoint:
+            async with session.get(
+                    endpoint["Resource"] +
+                    '/identity/.well-known/openid-configuration',
+                    headers={'Accept': 'application/json'}) as discovery_url:
+                if discovery_url.status < 200 or discovery_url.status >= 300:
+                    raise OmfTokenError(f'Failed to get access token endpoint from discovery URL: {discovery_url.status}:{await discovery_url.text()}',
+                                        discovery_url.status, parse_retry_after(discovery_url.headers.get('Retry-After')))
+                endpoint["TokenUrl"] = get_token_url(
+                    endpoint, json.loads(await discovery_url.read()))
+
+        async with session.post(
+                endpoint["TokenUrl"],
+                data=get_token_request_data(endpoint)) as token_information:
+            if token_information.status < 200 or token_information.status >= 300:
+                raise OmfTokenError(f'Failed to retrieve Token: {token_information.status}:{await token_information.text()}',
+                                    token_information.status, parse_retry_after(token_information.headers.get('Retry-After')))
+            token = cache_token(endpoint, json.loads(await token_information.read()))
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as ex:
+        raise OmfTokenError(f'Could not reach the identity service of {endpoint["Resource"]}: {ex}') from ex
+
+    if metrics is not None:
+        metrics.increment('omf_token_refreshes_total', get_metric_labels(endpoint))
+
+    if background_token_refresh:
+        schedule_token_refresh_async(
+            endpoint, get_token_refresh_delay(endpoint))
+
+    return token
+
+
+def schedule_token_refresh_async(endpoint, delay):
+    '''Schedules a refresh of the endpoint's token as a task on the running event loop'''
+
+    previous_task = endpoint.get('AsyncTokenRefreshTask')
+    if previous_task is not None and previous_task is not asyncio.current_task():
+        previous_task.cancel()
+
+    endpoint["AsyncTokenRefreshTask"] = asyncio.create_task(
+        refresh_token_in_background_async(endpoint, delay))
+
+
+async def refresh_token_in_background_async(endpoint, delay):
+    '''Waits for the delay, then refreshes the endpoint's token, trying again shortly if the refresh fails'''
+
+    await asyncio.sleep(delay)
+
+    if 'AsyncTokenLock' not in endpoint:
+        endpoint["AsyncTokenLock"] = asyncio.Lock()
+
+    try:
+        async with endpoint["AsyncTokenLock"]:
+            await refresh_token_async(endpoint)
+    except Exception as ex:
+        # callers still refresh the token themselves once it is about to expire
+        print(f'Background token refresh for {endpoint["Resource"]} failed: {ex}')
+        if metrics is not None:
+            metrics.increment('omf_token_refresh_failures_total', get_metric_labels(endpoint))
+        schedule_token_refresh_async(endpoint, 30)
+
+
+async def send_message_to_omf_endpoint_async(endpoint, message_type, message_omf_json, action='create'):
+    '''Sends the request out to the preconfigured endpoint without blocking the event loop'''
+
+    message = get_omf_message(message_omf_json)
+    circuit_breaker = get_circuit_breaker(endpoint)
+    trial = circuit_breaker.check(endpoint)
+
+    try:
+        attempt = 0
+        while True:
+            try:
+                await post_message_to_omf_endpoint_async(
+                    endpoint, message_type, message, action)
+            except OmfSendError as ex:
+                if not ex.is_retriable() or attempt >= max_retries:
+                    if ex.is_endpoint_unavailable():
+                        circuit_breaker.record_failure(endpoint)
+                    else:
+                        # a rejected message shows that the endpoint is reachable
+                        circuit_breaker.record_success()
+                        forget_definitions_of_rejected_data(endpoint, message_type, ex)
+                    if metrics is not None:
+                        metrics.increment('omf_failed_messages_total', get_metric_labels(endpoint, message_type))
+                    raise
+                if metrics is not None:
+                    metrics.increment('omf_retries_total', get_metric_labels(endpoint, message_type))
+                await asyncio.sleep(get_retry_delay(attempt, ex.retry_after))
+                attempt += 1
+            else:
+                circuit_breaker.record_success()
+                return
+    finally:
+        # any other error ends the trial too, so that the endpoint is not skipped for good
+        if trial:
+            circuit_breaker.end_trial()
+
+
+async def post_message_to_omf_endpoint_async(endpoint, message_type, message, action):
+    '''Makes a single attempt at posting the message to the endpoint'''
+
+    # Compress json omf payload, if specified
+    msg_body, compression = encode_message(endpoint, message)
+
+    # Collect the message headers
+    msg_headers = get_headers(endpoint, compression, message_type, action,
+                              token=await get_token_async(endpoint))
+
+    import aiohttp
+
+    started = time.perf_counter()
+    try:
+        async with get_async_session(endpoint).post(
+                endpoint["OmfEndpoint"],
+                headers=msg_headers,
+                data=msg_body) as response:
+            status = response.status
+            text = await response.text()
+            retry_after = response.headers.get('Retry-After')
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as ex:
+        record_request_concurrency(endpoint, started, 'error')
+        if metrics is not None:
+            record_request_metrics(endpoint, message_type, 'error', started, len(msg_body))
+        raise OmfSendError(f'Could not reach {endpoint["OmfEndpoint"]}: {ex}') from ex
+
+    record_request_concurrency(endpoint, started, status)
+    if metrics is not None:
+        record_request_metrics(endpoint, message_type, status, started, len(msg_body))
+
+    # response code in 200s if the request was successful!
+    if not is_response_successful(status):
+        report_unsuccessful_response(
+            message_type, message, msg_headers, status, text, retry_after)
+
+
+async def forward_stored_messages_async(endpoint, queue):
+    '''Sends the backlog of the endpoint's queue in bulk and returns whether the backlog was fully drained'''
+
+    while not queue.is_empty():
+        records, position = queue.read(max_message_bytes)
+        try:
+            await send_message_to_omf_endpoint_async(endpoint, 'data', OmfMessage(
+                json_bytes=merge_data_messages(records)))
+        except Exception as ex:
+            if not is_message_rejected(ex):
+                return False
+            # a rejected message would otherwise block the queue forever
+            print(f'Dropping stored data rejected by {endpoint["OmfEndpoint"]}: {ex}')
+        queue.commit(position)
+        if metrics is not None:
+            metrics.set_gauge('omf_store_and_forward_bytes', get_metric_labels(endpoint), queue.size())
+
+    return True
+
+
+async def send_data_with_store_and_forward_async(endpoint, messages):
+    '''Sends data messages once the endpoint's backlog has drained, storing them if the endpoint is unavailable'''
+
+    queue = get_store_and_forward_queue(endpoint)
+
+    # new data is only sent after all the stored data, to keep the data in order
+    if not await forward_stored_messages_async(endpoint, queue):
+        store_messages(endpoint, queue, messages,
+                       'stored data has not been forwarded yet')
+        return
+
+    for i, message in enumerate(messages):
+        try:
+            await send_message_to_omf_endpoint_async(endpoint, 'data', message)
+        except Exception as ex:
+            if is_message_rejected(ex):
+                raise
+            store_messages(endpoint, queue, messages[i:], ex)
+            return
+
+
+async def send_messages_to_endpoint_async(endpoint, message_type, messages, action='create'):
+    '''Sends the messages to the endpoint in order, except for data messages sent over adaptive concurrent requests'''
+
+    if use_store_and_forward and message_type == 'data' and action == 'create':
+        await send_data_with_store_and_forward_async(endpoint, messages)
+        return
+
+    if adaptive_concurrency and message_type == 'data' and action == 'create' and len(messages) > 1:
+        await send_data_concurrently_async(endpoint, messages)
+        return
+
+    for message in messages:
+        await send_message_to_omf_endpoint_async(endpoint, message_type, message, action)
+
+
+async def send_data_concurrently_async(endpoint, messages):
+    '''Sends the data messages to the endpoint over as many concurrent requests as its concurrency limiter allows,
+    keeping the values of each container in order'''
+
+    limiter = get_concurrency_limiter(endpoint)
+    # the ids of the containers held by each request in flight
+    pending = {}
+    error = None
+
+    for message in messages:
+        message = get_omf_message(message)
+        containerids = message.get_containerids()
+        while pending and error is None and (
+                len(pending) >= limiter.current() or holds_containers_in_flight(containerids, pending)):
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                del pending[future]
+            error = get_first_error(done, error)
+        if error is not None:
+            break
+        pending[asyncio.ensure_future(send_message_to_omf_endpoint_async(endpoint, 'data', message))] = containerids
+
+    if pending:
+        done, _ = await asyncio.wait(pending)
+        error = get_first_error(done, error)
+    if error is not None:
+        raise error
+
+
+async def send_to_all_endpoints_async(endpoints, message_type, messages, action='create'):
+    '''Sends the messages to every endpoint concurrently and returns a list of (endpoint, error) for the endpoints that failed'''
+
+    # encode each message once for all endpoints
+    messages = [get_omf_message(message) for message in messages]
+
+    return await run_on_all_endpoints_async(endpoints, send_messages_to_endpoint_async, message_type, messages, action)
+
+
+async def run_on_all_endpoints_async(endpoints, function, *args):
+    '''Awaits function(endpoint, *args) for every endpoint concurrently and returns a list of (endpoint, error) for the endpoints that failed'''
+
+    results = await asyncio.gather(
+        *[function(endpoint, *args) for endpoint in endpoints],
+        return_exceptions=True)
+
+    return [(endpoint, result) for endpoint, result in zip(endpoints, results)
+            if isinstance(result, Exception)]
+
+
+async def register_definitions_async(endpoint, omf_types, omf_containers, save_cache=True):
+    '''Sends the types and then the containers that the endpoint does not have yet, in size-bounded batches'''
+
+    for message_type, definitions in (('type', omf_types), ('container', omf_containers)):
+        pending = get_unregistered_definitions(endpoint, message_type, definitions)
+        try:
+            for batch in batch_messages([definition for definition, _ in pending]):
+                await send_message_to_omf_endpoint_async(endpoint, message_type, batch)
+                record_registered_definitions(
+                    endpoint, message_type, pending[:len(batch)])
+                pending = pending[len(batch):]
+        finally:
+            if save_cache:
+                save_registration_cache()
+
+
+async def register_streamed_definitions_async(endpoints, omf_types, omf_containers):
+    '''Registers the types with all endpoints, then the containers batch by batch as they are read, and returns the id and type id of each container'''
+
+    container_ids = []
+    try:
+        check_endpoint_errors(await run_on_all_endpoints_async(
+            endpoints, register_definitions_async, omf_types, [], False))
+        for batch in iter_batches(read_container_ids(omf_containers, container_ids)):
+            check_endpoint_errors(await run_on_all_endpoints_async(
+                endpoints, register_definitions_async, [], batch, False))
+    finally:
+        # the cache is saved once instead of after every batch
+        save_registration_cache()
+
+    return container_ids
 
 
 # ************************************************************************
@@ -167,7 +1940,7 @@ def send_message_to_omf_endpoint(endpoint, message_type, message_omf_json, actio
 # ************************************************************************
 
 
-def get_headers(endpoint, compression='', message_type='', action=''):
+def get_headers(endpoint, compression='', message_type='', action='', token=None):
     '''Assemble headers for sending to the endpoint's OMF endpoint'''
 
     endpoint_type = endpoint["EndpointType"]
@@ -184,7 +1957,9 @@ def get_headers(endpoint, compression='', message_type='', action=''):
 
     # If the endpoint is CDS
     if endpoint_type == EndpointTypes.CDS:
-        msg_headers["Authorization"] = f'Bearer {get_token(endpoint)}'
+        if token is None:
+            token = get_token(endpoint)
+        msg_headers["Authorization"] = f'Bearer {token}'
     # If the endpoint is PI
     elif endpoint_type == EndpointTypes.PI:
         msg_headers["x-requested-with"] = 'xmlhttprequest'
@@ -231,9 +2006,1023 @@ def get_data(data):
     return data
 
 
+# ************************************************************************
+# Batches data messages so that each endpoint receives one request per
+# batch instead of one request per container
+# ************************************************************************
+
+
+def batch_messages(omf_messages, max_bytes=None):
+    '''Splits a list of OMF type, container or data messages into batches whose serialized size stays under max_bytes'''
+    return list(iter_batches(omf_messages, max_bytes))
+
+
+def get_value_chunks(value_sizes, overhead, max_bytes):
+    '''Returns the (start, end) slices of values that fit in messages of max_bytes, given the serialized size of each
+    value with its separator and of a message without values, with at least one value in each slice'''
+
+    if overhead + sum(value_sizes) <= max_bytes:
+        return [(0, len(value_sizes))]
+
+    chunks = []
+    start = 0
+    size = overhead
+    for end, value_size in enumerate(value_sizes):
+        if end > start and size + value_size > max_bytes:
+            chunks.append((start, end))
+            start = end
+            size = overhead
+        size += value_size
+    chunks.append((start, len(value_sizes)))
+    return chunks
+
+
+def split_data_message(omf_message, message_size, max_bytes):
+    '''Returns a list of (message, size) holding the message, or its values split by their serialized size when it
+    is a data message too large for a single message'''
+
+    values = omf_message.get('values') if type(omf_message) is dict else None
+    if message_size <= max_bytes or values is None or len(values) < 2:
+        return [(omf_message, message_size)]
+
+    # the separator between values is ', ' for json and ',' for orjson
+    separator_size = len(dumps_json([0, 0])) - 4
+    value_sizes = [len(dumps_json(value)) + separator_size for value in values]
+    # allow for the separator between array items
+    overhead = len(dumps_json(dict(omf_message, values=[]))) + 2
+    return [(dict(omf_message, values=values[start:end]), overhead + sum(value_sizes[start:end]))
+            for start, end in get_value_chunks(value_sizes, overhead, max_bytes)]
+
+
+def iter_batches(omf_messages, max_bytes=None):
+    '''Yields batches of OMF messages whose serialized size stays under max_bytes, reading the messages as the batches are used
+
+    The values of a data message that does not fit in a single message are split over several messages.'''
+
+    if max_bytes is None:
+        max_bytes = max_message_bytes
+
+    batch = []
+    # account for the enclosing brackets of the json array
+    batch_size = 2
+    for omf_message in omf_messages:
+        # account for the separator between array items
+        message_size = len(dumps_json(omf_message)) + 2
+        for omf_message, message_size in split_data_message(omf_message, message_size, max_bytes - 2):
+            if batch and batch_size + message_size > max_bytes:
+                yield batch
+                batch = []
+                batch_size = 2
+            batch.append(omf_message)
+            batch_size += message_size
+
+    if batch:
+        yield batch
+
+
+class DataBatcher:
+    '''Gathers the values of each container over one or more cycles into size-bounded, multi-value OMF data messages
+
+    The gathered data is due to be sent after a number of cycles, or as soon as any container has
+    a number of values, the values take up a number of bytes, or the oldest value has waited a
+    number of seconds, whichever comes first. The values of each container are kept in a bounded
+    ring buffer that drops the oldest values once it is full.'''
+
+    def __init__(self, cycles=1, max_bytes=192 * 1024, value_count=None, pending_bytes=None, latency_seconds=None, max_values=100000,
+                 encoder=None):
+        self.cycles = cycles
+        self.max_bytes = max_bytes
+        # the data encoder that validates and serializes the batches, or None to send them as json objects
+        self.encoder = encoder
+        self.value_count = value_count
+        self.pending_bytes_limit = pending_bytes
+        self.latency_seconds = latency_seconds
+        self.max_values = max_values
+        # the estimated serialized size of one value of each container
+        self.value_sizes = {}
+        # the type encoders of the containers added as container records, whose values are kept as rows
+        self.row_encoders = {}
+        self.dropped_values = 0
+        self._reset()
+
+    def _reset(self):
+        self.pending = {}
+        self.pending_bytes = 0
+        self.cycle_count = 0
+        self.oldest_added_at = None
+        self.due = False
+
+    def add(self, data):
+        '''Adds a copy of the values of a data message or container record, merging values that target the same container'''
+
+        if type(data) is ContainerRecord:
+            containerid = data.containerid
+            # a record's value is kept as a compact row of its timestamp and property values
+            new_values = [data.to_row()]
+            if containerid not in self.value_sizes:
+                try:
+                    self.value_sizes[containerid] = len(data.encoder.encode_row(new_values[0])) + 1
+                except OmfValueError as ex:
+                    # the value is dropped here as the data encoder would drop it, so that it does not end the send loop
+                    print(f'Dropping a value of container {containerid}: {ex}')
+                    count_invalid_values(1)
+                    return
+                self.row_encoders[containerid] = data.encoder
+        else:
+            containerid = data["containerid"]
+            new_values = [dict(value) for value in data["values"]]
+            if containerid not in self.value_sizes and new_values:
+                self.value_sizes[containerid] = len(dumps_json(new_values[0])) + 1
+
+        values = self.pending.get(containerid)
+        if values is None:
+            values = self.pending[containerid] = []
+
+        for value in new_values:
+            if len(values) == self.max_values:
+                # a plain list is smaller, so it only becomes a ring buffer once the container is full
+                if type(values) is list:
+                    values = self.pending[containerid] = collections.deque(values, maxlen=self.max_values)
+                self.dropped_values += 1
+            else:
+                self.pending_bytes += self.value_sizes[containerid]
+            values.append(value)
+
+        if self.oldest_added_at is None:
+            self.oldest_added_at = time.monotonic()
+        if self.value_count is not None and len(values) >= self.value_count:
+            self.due = True
+        if self.pending_bytes_limit is not None and self.pending_bytes >= self.pending_bytes_limit:
+            self.due = True
+
+    def end_cycle(self):
+        '''Marks the end of a data cycle and returns whether the gathered data should now be sent'''
+        self.cycle_count += 1
+        return self.is_due()
+
+    def is_due(self):
+        '''Returns whether any of the limits for sending the gathered data has been reached'''
+        if not self.pending:
+            return False
+        if self.due or (self.cycles is not None and self.cycle_count >= self.cycles):
+            return True
+        return self.latency_seconds is not None and time.monotonic() - self.oldest_added_at >= self.latency_seconds
+
+    def flush(self):
+        '''Returns the gathered data as a list of data messages and resets the batcher'''
+        data_messages = []
+        for containerid, values in self.pending.items():
+            values = list(values)
+            if self.encoder is not None:
+                # the encoder splits the values of a container by their encoded size
+                data_messages.append({"containerid": containerid, "values": values})
+                continue
+            if containerid in self.row_encoders:
+                values = [self.row_encoders[containerid].row_to_value(row) for row in values]
+            # split the values of a container that would not fit in a single message by the estimated size of a value,
+            # allowing for the brackets and the containerid around the values. batch_messages splits the messages that
+            # still do not fit by the serialized size of their values
+            values_per_message = max(
+                1, (self.max_bytes - len(containerid) - 40) // self.value_sizes.get(containerid, 1))
+            for start in range(0, len(values), values_per_message):
+                data_messages.append({"containerid": containerid,
+                                      "values": values[start:start + values_per_message]})
+        self._reset()
+        if self.encoder is not None:
+            return self.encoder.encode_batches(data_messages, self.max_bytes)
+        return batch_messages(data_messages, self.max_bytes)
+
+
+def get_data_batcher(omf_types=None, omf_containers=None):
+    '''Creates a data batcher with the batching settings of the global variables, encoding the data of the containers if enabled'''
+
+    encoder = None
+    if use_compiled_encoders and omf_types is not None:
+        encoder = DataEncoder(omf_types, omf_containers)
+
+    return DataBatcher(batch_cycles, max_message_bytes, flush_value_count, flush_bytes,
+                       flush_latency_seconds, max_values_per_container, encoder)
+
+
+# ************************************************************************
+# Compiles each OMF type into an encoder that validates data values against
+# the type and serializes them straight into a reusable byte buffer
+# ************************************************************************
+
+
+class OmfValueError(ValueError):
+    '''Raised when a data value does not match the type of its container'''
+
+
+def count_invalid_values(count):
+    '''Records data values that were dropped because they do not match the type of their container'''
+    if metrics is not None:
+        metrics.increment('omf_invalid_values_total', value=count)
+
+
+# The ranges of the integer formats of OMF
+integer_ranges = {
+    'int16': (-2 ** 15, 2 ** 15 - 1),
+    'int32': (-2 ** 31, 2 ** 31 - 1),
+    'int64': (-2 ** 63, 2 ** 63 - 1),
+    'uint16': (0, 2 ** 16 - 1),
+    'uint32': (0, 2 ** 32 - 1),
+    'uint64': (0, 2 ** 64 - 1)
+}
+
+# An ISO 8601 date-time, which contains no characters that need escaping in json
+date_time_pattern = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?(Z|[+-]\d{2}:\d{2})?')
+
+
+def get_property_encoder(name, definition):
+    '''Returns a function that validates a value of the property and returns its json text'''
+
+    property_type = definition.get('type')
+    nullable = False
+    if isinstance(property_type, list):
+        nullable = 'null' in property_type
+        property_type = next((t for t in property_type if t != 'null'), None)
+    property_format = definition.get('format')
+
+    def invalid(value, reason):
+        return OmfValueError(f'{name} must be {reason}, not {value!r}')
+
+    if 'enum' in definition:
+        # the json of every enum value is known up front, and looking it up also validates it
+        encoded_values = {(type(value), value): json.dumps(value) for value in definition["enum"]}
+
+        def encode(value):
+            encoded = encoded_values.get((type(value), value))
+            if encoded is None:
+                raise invalid(value, f'one of {definition["enum"]}')
+            return encoded
+
+    elif property_type == 'integer':
+        minimum, maximum = integer_ranges.get(property_format, integer_ranges['int64'])
+
+        def encode(value):
+            if type(value) is not int or not minimum <= value <= maximum:
+                raise invalid(value, f'an integer from {minimum} to {maximum}')
+            return str(value)
+
+    elif property_type == 'number':
+        maximum = 3.4028234663852886e38 if property_format == 'float32' else math.inf
+
+        def encode(value):
+            if type(value) is int:
+                try:
+                    value = float(value)
+                except OverflowError:
+                    raise invalid(value, 'a finite number') from None
+            elif type(value) is not float:
+                raise invalid(value, 'a number')
+            if not -maximum <= value <= maximum or math.isinf(value):
+                raise invalid(value, f'a finite {property_format or "number"}')
+            return repr(value)
+
+    elif property_type == 'boolean':
+        def encode(value):
+            if value is True:
+                return 'true'
+            if value is False:
+                return 'false'
+            raise invalid(value, 'a boolean')
+
+    elif property_type == 'string' and property_format == 'date-time':
+        def encode(value):
+            if type(value) is not str or date_time_pattern.fullmatch(value) is None:
+                raise invalid(value, 'an ISO 8601 date-time string')
+            return '"' + value + '"'
+
+    elif property_type == 'string':
+        def encode(value):
+            if type(value) is not str:
+                raise invalid(value, 'a string')
+            return json.dumps(value)
+
+    else:
+        # types without a fast path, such as arrays and nested objects, are serialized generically
+        def encode(value):
+            return json.dumps(value)
+
+    if not nullable:
+        return encode
+
+    def encode_nullable(value):
+        return 'null' if value is None else encode(value)
+
+    return encode_nullable
+
+
+class TypeEncoder:
+    '''Validates the values of one OMF type and serializes them as json, in the property order of the type
+
+    A value with every property of the type is formatted with a single precomputed template.
+    Values that leave out some properties take a slower path that only writes the ones present.'''
+
+    def __init__(self, omf_type):
+        self.typeid = omf_type["id"]
+        self.index_property = next((name for name, definition in omf_type["properties"].items()
+                                    if definition.get('isindex')), None)
+        self.properties = [(name, get_property_encoder(name, definition))
+                           for name, definition in omf_type["properties"].items()]
+        self.keys = {name: json.dumps(name) + ':' for name in omf_type["properties"]}
+        self.template = '{' + ','.join(self.keys[name].replace('%', '%%') + '%s'
+                                       for name, _ in self.properties) + '}'
+
+        # container records keep the index as epoch nanoseconds, followed by the other properties in type order
+        self.value_properties = [(name, encode) for name, encode in self.properties if name != self.index_property]
+        self.row_encoders = [format_timestamp_json] + [encode for _, encode in self.value_properties]
+        self.row_template = None
+        if self.index_property is not None:
+            self.row_template = '{' + ','.join(self.keys[name].replace('%', '%%') + '%s'
+                                               for name in [self.index_property] + [name for name, _ in self.value_properties]) + '}'
+
+    def encode(self, value):
+        '''Returns the json of a value, raising OmfValueError if it does not match the type'''
+
+        try:
+            if len(value) == len(self.properties):
+                try:
+                    return self.template % tuple([encode(value[name]) for name, encode in self.properties])
+                except KeyError:
+                    pass
+            return self._encode_partial(value)
+        except OmfValueError as ex:
+            raise OmfValueError(f'Invalid value for type {self.typeid}: {ex}') from None
+
+    def _encode_partial(self, value):
+        if self.index_property is not None and self.index_property not in value:
+            raise OmfValueError(f'the index property {self.index_property} is missing')
+
+        unknown = [name for name in value if name not in self.keys]
+        if unknown:
+            raise OmfValueError(f'the type has no properties {unknown}')
+
+        return '{' + ','.join(self.keys[name] + encode(value[name])
+                              for name, encode in self.properties if name in value) + '}'
+
+    def encode_row(self, row):
+        '''Returns the json of a container record row, formatting its epoch nanosecond timestamp'''
+
+        try:
+            return self.row_template % tuple([encode(value) for encode, value in zip(self.row_encoders, row)])
+        except OmfValueError as ex:
+            raise OmfValueError(f'Invalid value for type {self.typeid}: {ex}') from None
+
+    def row_to_value(self, row):
+        '''Returns a container record row as an OMF value'''
+
+        value = {self.index_property: format_timestamp_ns(row[0])}
+        value.update(zip([name for name, _ in self.value_properties], row[1:]))
+        return value
+
+
+class ContainerRecord:
+    '''The latest value of a container: its timestamp as epoch nanoseconds and its other property values in type order
+
+    A record is created once per container, with its type encoder resolved up front, and is
+    updated in place every cycle, so that no json objects are created until it is encoded.'''
+
+    __slots__ = ('containerid', 'encoder', 'timestamp_ns', 'values')
+
+    def __init__(self, containerid, encoder, timestamp_ns=0, values=()):
+        self.containerid = containerid
+        self.encoder = encoder
+        self.timestamp_ns = timestamp_ns
+        self.values = values
+
+    def to_row(self):
+        '''Returns a tuple of the timestamp followed by the property values'''
+        return (self.timestamp_ns,) + self.values
+
+    def to_data_message(self):
+        '''Returns the record as an OMF data message'''
+        return {"containerid": self.containerid, "values": [self.encoder.row_to_value(self.to_row())]}
+
+
+def compile_type_encoders(omf_types):
+    '''Compiles an encoder for each dynamic type, keyed by the type id'''
+    return {omf_type["id"]: TypeEncoder(omf_type) for omf_type in omf_types
+            if omf_type.get('classification') == 'dynamic'}
+
+
+class DataEncoder:
+    '''Encodes OMF data messages with the compiled encoder of each container's type into a reusable batch buffer'''
+
+    def __init__(self, omf_types, omf_containers):
+        type_encoders = compile_type_encoders(omf_types)
+        self.containers = {}
+        for omf_container in omf_containers:
+            if omf_container["typeid"] in type_encoders:
+                prefix = '{"containerid":' + json.dumps(omf_container["id"]) + ',"values":['
+                self.containers[omf_container["id"]] = (prefix, type_encoders[omf_container["typeid"]])
+        self.batch_buffer = bytearray()
+
+    def encode_values(self, data_message):
+        '''Returns the json prefix of the container of a data message and the json of each of its values, raising
+        OmfValueError if a value does not match its type'''
+
+        container = self.containers.get(data_message["containerid"])
+        if container is None:
+            raise OmfValueError(f'Container {data_message["containerid"]} does not have a known dynamic type')
+        prefix, type_encoder = container
+
+        try:
+            return prefix, [type_encoder.encode_row(value) if type(value) is tuple else type_encoder.encode(value)
+                            for value in data_message["values"]]
+        except OmfValueError as ex:
+            raise OmfValueError(f'Container {data_message["containerid"]}: {ex}') from None
+
+    def encode(self, data_message):
+        '''Returns the json bytes of a data message, raising OmfValueError if a value does not match its type'''
+        prefix, values = self.encode_values(data_message)
+        return (prefix + ','.join(values) + ']}').encode('utf-8')
+
+    def encode_valid_values(self, data_message):
+        '''Returns the json prefix of the container of a data message and the json of each of its values that match
+        its type, logging and dropping the others, or None if no values are left'''
+
+        containerid = data_message["containerid"]
+        container = self.containers.get(containerid)
+        if container is None:
+            print(f'Dropping {len(data_message["values"])} values of container {containerid}, which does not have a '
+                  'known dynamic type')
+            count_invalid_values(len(data_message["values"]))
+            return None
+        prefix, type_encoder = container
+
+        values = []
+        for value in data_message["values"]:
+            try:
+                values.append(type_encoder.encode_row(value) if type(value) is tuple else type_encoder.encode(value))
+            except OmfValueError as ex:
+                print(f'Dropping a value of container {containerid}: {ex}')
+                count_invalid_values(1)
+
+        if not values:
+            return None
+
+        return prefix, values
+
+    def encode_batches(self, data_messages, max_bytes=None):
+        '''Encodes data messages into OmfMessages holding json arrays whose size stays under max_bytes
+
+        The values of a container that do not fit in one message are split over several messages by
+        their encoded size. Values that do not match the type of their container are logged and
+        dropped, so that they do not hold back the other values of the batch.'''
+
+        if max_bytes is None:
+            max_bytes = max_message_bytes
+
+        started = time.perf_counter()
+        batches = []
+        batch_buffer = self.batch_buffer
+        del batch_buffer[:]
+        containerids = set()
+        for data_message in data_messages:
+            try:
+                prefix, values = self.encode_values(data_message)
+            except OmfValueError:
+                encoded = self.encode_valid_values(data_message)
+                if encoded is None:
+                    continue
+                prefix, values = encoded
+
+            # allow for the closing brackets of the message and the brackets of the json array
+            for start, end in get_value_chunks([len(value) + 1 for value in values], len(prefix) + 4, max_bytes):
+                message_bytes = (prefix + ','.join(values[start:end]) + ']}').encode('utf-8')
+                # account for the separator and the closing bracket of the json array
+                if batch_buffer and len(batch_buffer) + len(message_bytes) + 2 > max_bytes:
+                    batch_buffer += b']'
+                    batches.append(OmfMessage(json_bytes=bytes(batch_buffer), containerids=frozenset(containerids)))
+                    del batch_buffer[:]
+                    containerids.clear()
+                batch_buffer += b',' if batch_buffer else b'['
+                batch_buffer += message_bytes
+                containerids.add(data_message["containerid"])
+
+        if batch_buffer:
+            batch_buffer += b']'
+            batches.append(OmfMessage(json_bytes=bytes(batch_buffer), containerids=frozenset(containerids)))
+            del batch_buffer[:]
+
+        if metrics is not None:
+            metrics.observe('omf_encode_seconds', (('encoding', 'compiled'),), time.perf_counter() - started)
+
+        return batches
+
+
+# ************************************************************************
+# Generates the data of large numbers of containers in columns, one type
+# at a time, instead of one container at a time
+# ************************************************************************
+
+
+class ColumnarDataGenerator:
+    '''Keeps the values of all containers of a type in one column per property and fills a whole cycle at once
+
+    Integer and number properties get random values and enum properties step through their
+    values, like get_data does. numpy is used for the columns when it is installed.'''
+
+    def __init__(self, omf_types, omf_containers, omf_data):
+        types_by_id = {omf_type["id"]: omf_type for omf_type in omf_types}
+        typeids = {omf_container["id"]: omf_container["typeid"]
+                   for omf_container in omf_containers}
+
+        self.groups = {}
+        for omf_datum in omf_data:
+            typeid = typeids[omf_datum["containerid"]]
+            if typeid not in self.groups:
+                self.groups[typeid] = ColumnGroup(types_by_id[typeid])
+            self.groups[typeid].containerids.append(omf_datum["containerid"])
+
+        for group in self.groups.values():
+            group.create_columns()
+
+    def generate(self, timestamp=None):
+        '''Fills the columns with the values of a new cycle and returns them as OMF data messages'''
+
+        if timestamp is None:
+            timestamp = get_current_time()
+
+        data_messages = []
+        for group in self.groups.values():
+            group.fill()
+            data_messages.extend(group.to_data_messages(timestamp))
+
+        return data_messages
+
+    def generate_records(self, timestamp_ns=None):
+        '''Fills the columns with the values of a new cycle and returns them as container records, which are updated in place'''
+
+        if timestamp_ns is None:
+            timestamp_ns = get_timestamp_service().now_ns()
+
+        records = []
+        for group in self.groups.values():
+            group.fill()
+            records.extend(group.to_records(timestamp_ns))
+
+        return records
+
+
+def get_column_kind(typeid, name, definition):
+    '''Returns the kind of values generated for a property, raising ValueError if values of its type cannot be generated'''
+
+    if 'enum' in definition:
+        return 'enum'
+
+    property_type = definition.get('type')
+    if isinstance(property_type, list):
+        property_type = next((t for t in property_type if t != 'null'), None)
+    if property_type == 'string' and definition.get('format') == 'date-time':
+        return 'date-time'
+    if property_type in ('integer', 'number', 'boolean', 'string'):
+        return property_type
+
+    raise ValueError(f'Cannot generate columnar data for property {name} of type {typeid}, whose type is '
+                     f'{definition.get("type")}')
+
+
+class ColumnGroup:
+    '''The columns of the values of all containers of one type'''
+
+    def __init__(self, omf_type):
+        self.omf_type = omf_type
+        self.containerids = []
+        self.records = None
+        self.index_property = next(name for name, definition in omf_type["properties"].items()
+                                   if definition.get('isindex'))
+        self.properties = [(name, definition) for name, definition in omf_type["properties"].items()
+                           if name != self.index_property]
+        self.kinds = {name: get_column_kind(omf_type["id"], name, definition) for name, definition in self.properties}
+        self.columns = {}
+
+    def create_columns(self):
+        '''Creates an enum position column for each enum property, starting before the first enum value'''
+        import_numpy()
+        count = len(self.containerids)
+        for name, definition in self.properties:
+            if 'enum' in definition:
+                self.columns[name] = numpy.full(count, -1) if numpy is not None else [-1] * count
+
+    def fill(self):
+        '''Generates the values of every property for every container in a few column operations'''
+        count = len(self.containerids)
+        for name, definition in self.properties:
+            kind = self.kinds[name]
+            if kind == 'enum':
+                size = len(definition["enum"])
+                if numpy is not None:
+                    self.columns[name] = (self.columns[name] + 1) % size
+                else:
+                    self.columns[name] = [(position + 1) % size for position in self.columns[name]]
+            elif kind == 'integer':
+                if numpy is not None:
+                    self.columns[name] = (numpy.random.random(count) * 100).astype(numpy.int64)
+                else:
+                    self.columns[name] = [int(100*random.random()) for _ in range(count)]
+            elif kind == 'number':
+                if numpy is not None:
+                    self.columns[name] = numpy.random.random(count) * 100
+                else:
+                    self.columns[name] = [100*random.random() for _ in range(count)]
+            elif kind == 'boolean':
+                if numpy is not None:
+                    self.columns[name] = numpy.random.random(count) < 0.5
+                else:
+                    self.columns[name] = [random.random() < 0.5 for _ in range(count)]
+            elif kind == 'date-time':
+                self.columns[name] = [get_current_time()] * count
+            else:
+                self.columns[name] = [str(int(100*random.random())) for _ in range(count)]
+
+    def get_value_columns(self):
+        '''Returns the columns as lists of property values, in the order of the properties'''
+
+        columns = []
+        for name, definition in self.properties:
+            column = self.columns[name]
+            if type(column) is not list:
+                column = column.tolist()
+            if 'enum' in definition:
+                column = [definition["enum"][position] for position in column]
+            columns.append(column)
+
+        return columns
+
+    def to_data_messages(self, timestamp):
+        '''Turns the columns into OMF data messages with one value per container'''
+
+        names = [self.index_property] + [name for name, _ in self.properties]
+        columns = [[timestamp] * len(self.containerids)] + self.get_value_columns()
+
+        return [{"containerid": containerid, "values": [dict(zip(names, row))]}
+                for containerid, *row in zip(self.containerids, *columns)]
+
+    def to_records(self, timestamp_ns):
+        '''Updates the container record of each container with the columns and returns the records'''
+
+        if self.records is None:
+            encoder = TypeEncoder(self.omf_type)
+            self.records = [ContainerRecord(containerid, encoder) for containerid in self.containerids]
+
+        columns = self.get_value_columns()
+        rows = zip(*columns) if columns else [()] * len(self.records)
+        for record, values in zip(self.records, rows):
+            record.timestamp_ns = timestamp_ns
+            record.values = values
+
+        return self.records
+
+
+def get_cycle_data(omf_data, data_generator=None):
+    '''Returns the data messages of one cycle, from the columnar data generator if one is used or else from get_data'''
+
+    if data_generator is not None:
+        if use_compact_records:
+            return data_generator.generate_records()
+        return data_generator.generate()
+
+    return [get_data(omf_datum) for omf_datum in omf_data]
+
+
+# ************************************************************************
+# Filters out the values that did not change enough to be sent, by
+# send-on-change, deadband or swinging door compression
+# ************************************************************************
+
+value_filter_modes = ('change', 'deadband', 'swinging_door')
+
+
+class FilterSettings:
+    '''The filter of a container: its mode, deviation, heartbeat interval and the properties of its type'''
+
+    __slots__ = ('mode', 'deviation', 'max_interval', 'index_property', 'value_names', 'numeric')
+
+    def __init__(self, settings, omf_type):
+        self.mode = settings.get('Mode', 'change')
+        if self.mode not in value_filter_modes:
+            raise ValueError(f'Invalid value filter mode {self.mode}, expected one of {", ".join(value_filter_modes)}')
+        self.deviation = 0 if self.mode == 'change' else settings.get('Deviation', 0)
+        self.max_interval = settings.get('MaxIntervalSeconds')
+
+        properties = omf_type["properties"]
+        self.index_property = next((name for name, definition in properties.items() if definition.get('isindex')), None)
+        # the properties of a value in type order, as in the rows of container records
+        self.value_names = tuple(name for name in properties if name != self.index_property)
+        self.numeric = tuple(i for i, name in enumerate(self.value_names)
+                             if 'enum' not in properties[name] and get_value_parser(properties[name]) in (int, float))
+
+
+class FilterState:
+    '''The last sent value of a container and, for swinging door compression, the value held back and the slopes of the door'''
+
+    __slots__ = ('sent_time', 'sent', 'held', 'upper', 'lower')
+
+    def __init__(self, sent_time, sent):
+        self.reset(sent_time, sent)
+
+    def reset(self, sent_time, sent):
+        self.sent_time = sent_time
+        self.sent = sent
+        self.held = None
+        self.upper = None
+        self.lower = None
+
+
+class ValueFilter:
+    '''Decides which values of each container are sent, by the filter of the container or of its type
+
+    Values are given as data messages or container records and are returned in the same form. A
+    swinging door filter holds the latest value back and sends it, with its original timestamp,
+    once a later value no longer fits the door, so that the values in between can be interpolated.'''
+
+    def __init__(self, omf_types, omf_containers, filters=None):
+        filters = filters if filters is not None else value_filters
+        types = {omf_type["id"]: omf_type for omf_type in omf_types}
+        shared_settings = {}
+        self.settings = {}
+        self.states = {}
+        for omf_container in omf_containers:
+            key = omf_container["id"] if omf_container["id"] in filters else omf_container["typeid"]
+            if key not in filters or omf_container["typeid"] not in types:
+                continue
+            # containers filtered by the filter of their type share its settings
+            if (key, omf_container["typeid"]) not in shared_settings:
+                shared_settings[(key, omf_container["typeid"])] = FilterSettings(filters[key], types[omf_container["typeid"]])
+            self.settings[omf_container["id"]] = shared_settings[(key, omf_container["typeid"])]
+
+    def filter(self, data):
+        '''Returns the data messages or container records to send for a data message or container record'''
+
+        if type(data) is ContainerRecord:
+            settings = self.settings.get(data.containerid)
+            if settings is None:
+                return [data]
+            return self._filter(data.containerid, settings, data.timestamp_ns / 1000000000, data.values,
+                                ContainerRecord(data.containerid, data.encoder, data.timestamp_ns, data.values))
+
+        settings = self.settings.get(data["containerid"])
+        if settings is None:
+            return [data]
+
+        values = []
+        for value in data["values"]:
+            timestamp = value.get(settings.index_property)
+            values.extend(self._filter(
+                data["containerid"], settings, parse_timestamp(timestamp) if timestamp else time.time(),
+                tuple(value.get(name) for name in settings.value_names), dict(value)))
+        return [{"containerid": data["containerid"], "values": values}] if values else []
+
+    def flush(self):
+        '''Returns the data messages or container records of the values that are still held back'''
+
+        data = []
+        for containerid, state in self.states.items():
+            if state.held is not None:
+                held_time, held_values, held_item = state.held
+                state.reset(held_time, held_values)
+                data.append(held_item if type(held_item) is ContainerRecord
+                            else {"containerid": containerid, "values": [held_item]})
+        return data
+
+    def _filter(self, containerid, settings, timestamp, values, item):
+        '''Returns the held and current items to send for a new value of the container'''
+
+        state = self.states.get(containerid)
+        if state is None:
+            self.states[containerid] = FilterState(timestamp, values)
+            return [item]
+
+        if settings.max_interval is not None and timestamp - state.sent_time >= settings.max_interval:
+            return self._send(state, timestamp, values, item)
+
+        if settings.mode == 'swinging_door':
+            return self._swinging_door(settings, state, timestamp, values, item)
+
+        if self._exceeds_deviation(settings, state.sent, values):
+            return self._send(state, timestamp, values, item)
+        return []
+
+    def _exceeds_deviation(self, settings, sent, values):
+        '''Returns whether a numeric property changed by more than the deviation or any other property changed'''
+
+        for i, (sent_value, value) in enumerate(zip(sent, values)):
+            if i in settings.numeric and sent_value is not None and value is not None:
+                if abs(value - sent_value) > settings.deviation:
+                    return True
+            elif value != sent_value:
+                return True
+        return False
+
+    def _send(self, state, timestamp, values, item):
+        '''Sends the held value, if there is one, and the new value, which becomes the last sent value'''
+
+        items = [state.held[2], item] if state.held is not None else [item]
+        state.reset(timestamp, values)
+        return items
+
+    def _swinging_door(self, settings, state, timestamp, values, item):
+        '''Holds the new value back while every numeric property stays within the door opened from the last sent value'''
+
+        if timestamp <= state.sent_time:
+            # values out of order are sent as they are
+            return self._send(state, timestamp, values, item)
+
+        # changes of other properties, and of numeric properties from or to a missing value, are sent as they are
+        latest = state.held[1] if state.held is not None else state.sent
+        for i, value in enumerate(values):
+            if (i not in settings.numeric or value is None or state.sent[i] is None) and value != latest[i]:
+                return self._send(state, timestamp, values, item)
+
+        elapsed = timestamp - state.sent_time
+        upper = []
+        lower = []
+        for k, i in enumerate(settings.numeric):
+            if values[i] is None or state.sent[i] is None:
+                upper.append(math.inf)
+                lower.append(-math.inf)
+                continue
+            upper_slope = (values[i] + settings.deviation - state.sent[i]) / elapsed
+            lower_slope = (values[i] - settings.deviation - state.sent[i]) / elapsed
+            if state.upper is not None:
+                upper_slope = min(upper_slope, state.upper[k])
+                lower_slope = max(lower_slope, state.lower[k])
+            if lower_slope > upper_slope:
+                break
+            upper.append(upper_slope)
+            lower.append(lower_slope)
+        else:
+            state.upper = upper
+            state.lower = lower
+            state.held = (timestamp, values, item)
+            return []
+
+        # the door closed, so the held value is sent and a new door opens from it through the new value
+        if state.held is None:
+            return self._send(state, timestamp, values, item)
+        held_time, held_values, held_item = state.held
+        state.reset(held_time, held_values)
+        return [held_item] + self._swinging_door(settings, state, timestamp, values, item)
+
+
+def get_value_filter(omf_types, omf_containers):
+    '''Returns the value filter of the containers, or None if no value filters are configured'''
+
+    if not value_filters:
+        return None
+
+    return ValueFilter(omf_types, omf_containers)
+
+
+def filter_cycle_data(value_filter, cycle_data):
+    '''Returns the data messages or container records of a cycle that pass the value filter'''
+
+    if value_filter is None:
+        return cycle_data
+
+    return [filtered for data in cycle_data for filtered in value_filter.filter(data)]
+
+
+# ************************************************************************
+# Formats timestamps from one clock read per cycle, reusing the formatted
+# date and time up to the second
+# ************************************************************************
+
+
+class TimestampService:
+    '''Reads the clock and formats ISO 8601 UTC timestamps, caching the formatted prefix of the current second
+
+    In aligned mode the clock is read once per cycle, when start_cycle is called, and every
+    container in the cycle gets that same instant, which also makes batches compress better.'''
+
+    def __init__(self, aligned=None):
+        self.aligned = aligned if aligned is not None else aligned_timestamps
+        # the second and the formatted prefix of the last formatted timestamp, replaced together
+        self._prefix = (None, None)
+        # recently formatted json timestamps, which rows of aligned cycles share
+        self._json_timestamps = {}
+        self.cycle_timestamp_ns = None
+        self.cycle_timestamp = None
+
+    def start_cycle(self, timestamp_ns=None):
+        '''Reads the clock for a new cycle, or uses the given time, which is the timestamp of the whole cycle in aligned mode'''
+        if self.aligned:
+            if timestamp_ns is None:
+                timestamp_ns = time.time_ns()
+            self.cycle_timestamp = self.format(timestamp_ns)
+            self.cycle_timestamp_ns = timestamp_ns
+
+    def now_ns(self):
+        '''Returns the timestamp of the current cycle in aligned mode, or else the current time, as epoch nanoseconds'''
+        if self.aligned and self.cycle_timestamp_ns is not None:
+            return self.cycle_timestamp_ns
+        return time.time_ns()
+
+    def now(self):
+        '''Returns the timestamp of the current cycle in aligned mode, or else the current time, as an ISO 8601 string'''
+        if self.aligned and self.cycle_timestamp is not None:
+            return self.cycle_timestamp
+        return self.format(time.time_ns())
+
+    def format(self, timestamp_ns):
+        '''Formats epoch nanoseconds as an ISO 8601 UTC timestamp with microseconds'''
+        seconds, nanoseconds = divmod(timestamp_ns, 1000000000)
+        prefix_seconds, prefix = self._prefix
+        if seconds != prefix_seconds:
+            prefix = time.strftime('%Y-%m-%dT%H:%M:%S.', time.gmtime(seconds))
+            self._prefix = (seconds, prefix)
+        return f'{prefix}{nanoseconds // 1000:06d}Z'
+
+    def format_json(self, timestamp_ns):
+        '''Formats epoch nanoseconds as a json string, reusing the text of recently formatted timestamps'''
+        formatted = self._json_timestamps.get(timestamp_ns)
+        if formatted is None:
+            if len(self._json_timestamps) >= 1024:
+                self._json_timestamps.clear()
+            formatted = self._json_timestamps[timestamp_ns] = '"' + self.format(timestamp_ns) + '"'
+        return formatted
+
+
+def get_timestamp_service():
+    '''Gets the timestamp service, creating it on first use'''
+    global timestamp_service
+
+    if timestamp_service is None:
+        timestamp_service = TimestampService()
+
+    return timestamp_service
+
+
+def format_timestamp_ns(timestamp_ns):
+    '''Formats epoch nanoseconds as an ISO 8601 UTC timestamp with microseconds'''
+    return get_timestamp_service().format(timestamp_ns)
+
+
+def format_timestamp_json(timestamp_ns):
+    '''Formats epoch nanoseconds as a json string'''
+    return get_timestamp_service().format_json(timestamp_ns)
+
+
 def get_current_time():
-    ''' Returns the current time'''
-    return datetime.datetime.utcnow().isoformat() + 'Z'
+    ''' Returns the current time, or the time of the current cycle when timestamps are aligned'''
+    return get_timestamp_service().now()
+
+
+# ************************************************************************
+# Schedules the data cycles at a fixed rate on the monotonic clock
+# ************************************************************************
+
+
+class CycleScheduler:
+    '''Runs cycles at a fixed rate on the monotonic clock, so that the time spent sending does not stretch the period
+
+    Each tick is due a whole number of periods after the first one. When a cycle overruns one or
+    more ticks, the missed ticks are either skipped to keep to the schedule, or run one after
+    another without waiting to catch up.'''
+
+    def __init__(self, period=None, catch_up=None, clock=time.monotonic):
+        self.period = period if period is not None else sleep_time
+        self.catch_up = catch_up if catch_up is not None else catch_up_missed_cycles
+        # the monotonic clock in seconds
+        self.clock = clock
+        self.started = clock()
+        self.tick = 0
+
+    def get_due(self):
+        '''Returns the monotonic time at which the current tick is due'''
+        return self.started + self.tick * self.period
+
+    def get_tick_time_ns(self):
+        '''Returns the wall clock time at which the current tick was due, as epoch nanoseconds'''
+        # measured back from the current wall clock time, so that it follows adjustments of the system clock
+        return time.time_ns() - round((self.clock() - self.get_due()) * 1000000000)
+
+    def advance(self):
+        '''Moves on to the next tick to run and returns the number of seconds until it is due'''
+        self.tick += 1
+        if self.period <= 0:
+            return 0
+
+        now = self.clock()
+        if now > self.get_due() and not self.catch_up:
+            # skip to the next tick that is still in the future
+            next_tick = int((now - self.started) / self.period) + 1
+            if metrics is not None:
+                metrics.increment('omf_skipped_cycles_total', value=next_tick - self.tick)
+            self.tick = next_tick
+
+        return max(0, self.get_due() - now)
+
+    def wait(self):
+        '''Sleeps until the next tick to run is due'''
+        time.sleep(self.advance())
+
+    async def wait_async(self):
+        '''Waits until the next tick to run is due without blocking the event loop'''
+        await asyncio.sleep(self.advance())
 
 
 def get_json_file(filename):
@@ -254,12 +3043,400 @@ def get_json_file(filename):
     return loaded_json
 
 
+# ************************************************************************
+# Reads OMF types, containers and data one item at a time, so that large
+# files are never loaded into memory as a whole
+# ************************************************************************
+
+
+def iter_omf_items(filename):
+    '''Yields the items of a json array, ndjson (.ndjson or .jsonl) or csv file as they are read'''
+
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in ('.ndjson', '.jsonl'):
+        return iter_ndjson_items(filename)
+    if extension == '.csv':
+        return iter_csv_items(filename)
+    return iter_json_array_items(filename)
+
+
+def iter_json_array_items(filename, chunk_size=1024 * 1024):
+    '''Yields the items of a file holding a json array, decoding one item at a time from chunks of the file'''
+
+    decoder = json.JSONDecoder()
+    with open(filename, 'r', encoding='utf-8') as f:
+        buffer = ''
+        offset = 0
+        # the number of characters dropped from the front of the buffer, for error positions
+        consumed = 0
+        end_of_file = False
+        # what is expected next: the opening bracket, the first item, an item, or a separator
+        state = 'start'
+
+        while True:
+            while offset < len(buffer) and buffer[offset] in ' \t\r\n':
+                offset += 1
+
+            if offset < len(buffer):
+                char = buffer[offset]
+                if state == 'start':
+                    if char != '[':
+                        raise ValueError(f'{filename} does not hold a json array')
+                    state = 'first'
+                    offset += 1
+                    continue
+
+                if state == 'separator' or (state == 'first' and char == ']'):
+                    if char == ']':
+                        return
+                    if char != ',':
+                        raise ValueError(f'Invalid json in {filename} at character {consumed + offset}: Expecting \',\' delimiter')
+                    state = 'item'
+                    offset += 1
+                    continue
+
+                try:
+                    item, end = decoder.raw_decode(buffer, offset)
+                except json.JSONDecodeError as error:
+                    if end_of_file:
+                        raise ValueError(f'Invalid json in {filename} at character {consumed + error.pos}: {error.msg}') from None
+                else:
+                    # a number is only complete once the character after it has been read
+                    if end_of_file or not isinstance(item, (int, float)) or \
+                            (end < len(buffer) and buffer[end] in ' \t\r\n,]'):
+                        yield item
+                        state = 'separator'
+                        offset = end
+                        continue
+
+            if end_of_file:
+                raise ValueError(f'{filename} ends before its json array is closed')
+
+            # keep the unread part of the buffer and read the next chunk
+            consumed += offset
+            chunk = f.read(chunk_size)
+            end_of_file = not chunk
+            buffer = buffer[offset:] + chunk
+            offset = 0
+
+
+def iter_ndjson_items(filename):
+    '''Yields the item on each non-empty line of a newline delimited json file'''
+
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as error:
+                    raise ValueError(f'Invalid json in {filename} on line {line_number}: {error.msg}') from None
+
+
+def iter_csv_items(filename):
+    '''Yields each row of a csv file with a header row as an object, leaving out empty cells'''
+
+    import csv
+
+    with open(filename, 'r', encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f):
+            yield {name: value for name, value in row.items() if name and value not in (None, '')}
+
+
+# ************************************************************************
+# Replays historical values from a csv file with their original timestamps,
+# recording its progress so that an interrupted replay resumes
+# ************************************************************************
+
+
+def get_value_parser(definition):
+    '''Returns a function that converts the text of a csv cell to a value of the property'''
+
+    property_type = definition.get('type')
+    if isinstance(property_type, list):
+        property_type = next((t for t in property_type if t != 'null'), None)
+
+    if property_type == 'integer':
+        return int
+    if property_type == 'number':
+        return float
+    if property_type == 'boolean':
+        return lambda text: text.strip().lower() == 'true'
+    if property_type in ('array', 'object'):
+        return json.loads
+    return str
+
+
+def parse_timestamp(text):
+    '''Returns an ISO 8601 timestamp as epoch seconds, assuming UTC if it has no offset'''
+
+    import datetime
+
+    timestamp = datetime.datetime.fromisoformat(text.replace('Z', '+00:00'))
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return timestamp.timestamp()
+
+
+class ReplayReader:
+    '''Reads the values of a replay csv file through a memory map, from any byte offset
+
+    The header row names a containerid column and the property columns. Each following row holds
+    one value of one container, with its original timestamp in the index property of the type.
+    Empty cells are left out of the value. Each row is on one line, and the rows of a container are
+    in time order. Rows read with max_seconds, to be paced at a replay speed, must be in time order
+    across all containers.'''
+
+    def __init__(self, filename, omf_types, omf_containers):
+        import csv
+
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.mapped = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+
+        header_end = self._find_line_end(0)
+        self.columns = next(csv.reader([self.mapped[:header_end].decode('utf-8')]))
+        if 'containerid' not in self.columns:
+            raise ValueError(f'{filename} has no containerid column')
+        self.containerid_column = self.columns.index('containerid')
+        self.data_offset = min(header_end + 1, self.size)
+
+        # the index, name and parser of each column used by the type of each container
+        types = {omf_type["id"]: omf_type for omf_type in omf_types}
+        column_parsers = {}
+        self.containers = {}
+        for omf_container in omf_containers:
+            typeid = omf_container["typeid"]
+            if typeid not in column_parsers and typeid in types:
+                properties = types[typeid]["properties"]
+                index_property = next((name for name, definition in properties.items() if definition.get('isindex')), None)
+                column_parsers[typeid] = (
+                    [(i, name, get_value_parser(properties[name])) for i, name in enumerate(self.columns) if name in properties],
+                    self.columns.index(index_property) if index_property in self.columns else None)
+            if typeid in column_parsers:
+                self.containers[omf_container["id"]] = column_parsers[typeid]
+
+    def close(self):
+        if self.size:
+            self.mapped.close()
+        self.file.close()
+
+    def _find_line_end(self, offset):
+        line_end = self.mapped.find(b'\n', offset)
+        return self.size if line_end < 0 else line_end
+
+    def read(self, offset, max_values, max_seconds=None, shard=None):
+        '''Returns the data messages of the rows from offset, the offset after them and the epoch seconds of the first and last rows
+
+        At most max_values rows are read. If max_seconds is given, reading also stops before a row
+        more than max_seconds after the first one, and a row earlier than the row before it raises
+        OmfValueError. If a shard is given as (index, count), the rows of containers in other shards
+        are skipped.'''
+
+        line_starts = []
+        lines = []
+        while offset < self.size and len(lines) < max_values:
+            line_end = self._find_line_end(offset)
+            line = self.mapped[offset:line_end].rstrip(b'\r')
+            if line:
+                line_starts.append(offset)
+                lines.append(line.decode('utf-8'))
+            offset = min(line_end + 1, self.size)
+
+        import csv
+
+        data_messages = {}
+        first_time = last_time = None
+        for row_number, row in enumerate(csv.reader(lines)):
+            if len(row) != len(self.columns):
+                raise OmfValueError(f'Row at byte {line_starts[row_number]} of {self.filename} has {len(row)} cells, '
+                                    f'the header has {len(self.columns)}')
+            containerid = row[self.containerid_column]
+            if shard is not None and get_shard(containerid, shard[1]) != shard[0]:
+                continue
+            container = self.containers.get(containerid)
+            if container is None:
+                raise OmfValueError(f'Container {containerid} in {self.filename} does not have a known dynamic type')
+            parsers, index_column = container
+
+            if max_seconds is not None and index_column is not None:
+                row_time = parse_timestamp(row[index_column])
+                if last_time is not None and row_time < last_time:
+                    raise OmfValueError(f'Row at byte {line_starts[row_number]} of {self.filename} is earlier than the '
+                                        'row before it, and replaying at a replay speed requires the rows in time order')
+                if first_time is None:
+                    first_time = row_time
+                elif row_time - first_time > max_seconds:
+                    # leave this row for the next read
+                    offset = line_starts[row_number]
+                    break
+                last_time = row_time
+
+            try:
+                value = {name: parse(row[i]) for i, name, parse in parsers if row[i] != ''}
+            except ValueError as error:
+                raise OmfValueError(f'Invalid value of {containerid} in {self.filename}: {error}') from None
+            values = data_messages.get(containerid)
+            if values is None:
+                values = data_messages[containerid] = []
+            values.append(value)
+
+        return ([{"containerid": containerid, "values": values} for containerid, values in data_messages.items()],
+                offset, (first_time, last_time))
+
+
+def read_replay_checkpoint(reader):
+    '''Returns the offset in the replay file to resume from, or the first row if the file has not been replayed before'''
+
+    path = get_shard_path(replay_checkpoint_file)
+    if replay_checkpoint_file is None or not os.path.exists(path):
+        return reader.data_offset
+
+    try:
+        with open(path, 'r') as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError) as error:
+        print(f'Ignoring unreadable replay checkpoint {path}: {error}')
+        return reader.data_offset
+
+    if checkpoint.get('ReplayFile') != os.path.abspath(reader.filename) or checkpoint["Offset"] > reader.size:
+        print(f'The replay checkpoint {path} is for another file, replaying {reader.filename} from the start')
+        return reader.data_offset
+
+    return max(checkpoint["Offset"], reader.data_offset)
+
+
+def write_replay_checkpoint(reader, offset):
+    '''Records that the replay file has been sent up to offset, replacing the checkpoint file so that it is never partly written'''
+
+    if replay_checkpoint_file is None:
+        return
+
+    path = get_shard_path(replay_checkpoint_file)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({"ReplayFile": os.path.abspath(reader.filename), "Offset": offset}, f)
+    os.replace(path + '.tmp', path)
+
+
+class ReplayPacer:
+    '''Spaces the replayed values out so that they are sent at speed times the rate at which they were recorded'''
+
+    def __init__(self, speed):
+        self.speed = speed
+        self.first_time = None
+        self.last_time = None
+        self.started = None
+
+    def get_delay(self, data_times):
+        '''Returns the number of seconds to wait before sending values from and to the given epoch seconds, raising
+        OmfValueError if they start before the values sent last'''
+        first_time, last_time = data_times
+        if last_time is None:
+            return 0
+        if self.last_time is not None and first_time < self.last_time:
+            raise OmfValueError('The replayed values go back in time, and replaying at a replay speed requires the '
+                                'rows in time order')
+        if self.first_time is None:
+            self.first_time = first_time
+            self.started = time.monotonic()
+        self.last_time = last_time
+        return max(0, self.started + (last_time - self.first_time) / self.speed - time.monotonic())
+
+
+def get_replay_shard():
+    '''Returns the shard of the containers replayed by this process as (index, count), or None if it replays all of them'''
+    return None if shard_index is None else (shard_index, worker_processes)
+
+
+def encode_replay_batches(encoder, data_messages):
+    '''Returns the replayed data messages in size-bounded batches, encoded by the data encoder if there is one'''
+
+    if encoder is not None:
+        return encoder.encode_batches(data_messages)
+
+    return batch_messages(data_messages)
+
+
+def iter_replay_batches(omf_types, omf_containers):
+    '''Reads the replay file from its checkpoint and yields (delay, batches, value count) for each chunk of it: the
+    seconds to wait before sending it at replay_speed, its encoded batches and the number of values in them
+
+    The checkpoint of a chunk is written when the next chunk is requested, that is once its batches
+    were sent. The values still held back by the value filter are yielded last.'''
+
+    reader = ReplayReader(replay_file, omf_types, omf_containers)
+    encoder = DataEncoder(omf_types, omf_containers) if use_compiled_encoders else None
+    value_filter = get_value_filter(omf_types, omf_containers)
+    pacer = ReplayPacer(replay_speed) if replay_speed else None
+    # at a replay speed, each read spans about sleep_time seconds of real time
+    max_seconds = replay_speed * sleep_time if replay_speed else None
+
+    try:
+        offset = read_replay_checkpoint(reader)
+        while offset < reader.size:
+            data_messages, offset_after, data_times = reader.read(
+                offset, replay_batch_values, max_seconds, get_replay_shard())
+            delay = pacer.get_delay(data_times) if pacer is not None else 0
+            data_messages = filter_cycle_data(value_filter, data_messages)
+            yield (delay, encode_replay_batches(encoder, data_messages) if data_messages else [],
+                   sum(len(data_message["values"]) for data_message in data_messages))
+            offset = offset_after
+            write_replay_checkpoint(reader, offset)
+
+        if value_filter is not None:
+            data_messages = value_filter.flush()
+            if data_messages:
+                yield 0, encode_replay_batches(encoder, data_messages), len(data_messages)
+    finally:
+        reader.close()
+
+
+def replay_data(endpoints, omf_types, omf_containers):
+    '''Sends the values of the replay file with their original timestamps, as fast as the endpoints accept them or at replay_speed'''
+
+    replayed_values = 0
+    replay = iter_replay_batches(omf_types, omf_containers)
+    try:
+        for delay, batches, value_count in replay:
+            time.sleep(delay)
+            if batches:
+                check_endpoint_errors(send_to_all_endpoints(endpoints, 'data', batches))
+            replayed_values += value_count
+    finally:
+        replay.close()
+
+    print(f'Replayed {replayed_values} values from {replay_file}')
+    return replayed_values
+
+
+async def replay_data_async(endpoints, omf_types, omf_containers):
+    '''Sends the values of the replay file with their original timestamps, as fast as the endpoints accept them or at replay_speed'''
+
+    replayed_values = 0
+    replay = iter_replay_batches(omf_types, omf_containers)
+    try:
+        for delay, batches, value_count in replay:
+            await asyncio.sleep(delay)
+            if batches:
+                check_endpoint_errors(await send_to_all_endpoints_async(endpoints, 'data', batches))
+            replayed_values += value_count
+    finally:
+        replay.close()
+
+    print(f'Replayed {replayed_values} values from {replay_file}')
+    return replayed_values
+
+
 def get_appsettings():
     ''' Return the appsettings.json as a json object, while also populating base_endpoint, omf_endpoint, and default values'''
 
     # Try to open the configuration file
-    endpoints = get_json_file('appsettings.json')["Endpoints"]
-    
+    return configure_endpoints(get_json_file('appsettings.json')["Endpoints"])
+
+
+def configure_endpoints(endpoints):
+    '''Return the selected endpoint configurations, populating base_endpoint, omf_endpoint, and default values'''
+
     filtered_endpoints = []
     for endpoint in endpoints:
         if endpoint["Selected"]:
@@ -269,6 +3446,7 @@ def get_appsettings():
     for endpoint in filtered_endpoints:
         if endpoint["EndpointType"] == 'OCS':
             print('OCS endpoint type is deprecated as OSIsoft Cloud Services has now been migrated to CONNECT data services, using CDS type instead.')
+            endpoint["EndpointType"] = EndpointTypes.CDS
             endpoint_type = EndpointTypes.CDS
         else:
             endpoint["EndpointType"] = EndpointTypes(endpoint["EndpointType"])
@@ -307,81 +3485,434 @@ def get_appsettings():
         if 'WebRequestTimeoutSeconds' not in endpoint or endpoint["WebRequestTimeoutSeconds"] == None:
             endpoint["WebRequestTimeoutSeconds"] = 30
 
+        if 'PoolSize' not in endpoint or endpoint["PoolSize"] == None:
+            endpoint["PoolSize"] = 10
+
     return filtered_endpoints
 
 
+# ************************************************************************
+# Caches the endpoint configurations, types and data read at startup, so
+# that short-lived runs skip reading and validating them again while their
+# files are unchanged
+# ************************************************************************
+
+
+def get_startup_files():
+    '''Returns the files that the startup cache is built from, including program.py whose defaults it depends on'''
+    return ['appsettings.json', omf_types_file, omf_data_file, os.path.abspath(__file__)]
+
+
+def get_file_stamp(filename):
+    '''Returns what identifies the version of a file: its modification time and size, or the sha256 of its contents'''
+
+    if startup_cache_validation == 'hash':
+        with open(filename, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    stat = os.stat(filename)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def get_endpoint_snapshot(endpoint):
+    '''Returns the configuration of an endpoint as plain json values, leaving out the sessions, locks and other running state'''
+
+    snapshot = {}
+    for key, value in endpoint.items():
+        if isinstance(value, EndpointTypes):
+            snapshot[key] = value.value
+        elif value is None or isinstance(value, (str, int, float, bool, list, dict)):
+            snapshot[key] = value
+
+    return snapshot
+
+
+def read_startup_cache(stamps):
+    '''Returns the cached endpoint configurations, types and data if they were built from the same file versions, or else None'''
+
+    if not os.path.exists(startup_cache_file):
+        return None
+
+    try:
+        with open(startup_cache_file, 'rb') as f:
+            snapshot = orjson.loads(f.read()) if orjson is not None else json.load(f)
+        if snapshot["Files"] != stamps:
+            return None
+        endpoints = snapshot["Endpoints"]
+        for endpoint in endpoints:
+            endpoint["EndpointType"] = EndpointTypes(endpoint["EndpointType"])
+        return endpoints, snapshot["Types"], snapshot["Data"]
+    except (OSError, ValueError, KeyError, TypeError) as error:
+        print(f'Ignoring unreadable startup cache {startup_cache_file}: {error}')
+        return None
+
+
+def write_startup_cache(stamps, endpoints, omf_types, omf_data):
+    '''Writes the startup cache readable only by its owner, since the endpoint configurations hold credentials'''
+
+    snapshot = {
+        "Files": stamps,
+        "Endpoints": [get_endpoint_snapshot(endpoint) for endpoint in endpoints],
+        "Types": omf_types,
+        "Data": omf_data
+    }
+
+    temporary_file = startup_cache_file + '.tmp'
+    with os.fdopen(os.open(temporary_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+        f.write(dumps_json(snapshot))
+    os.replace(temporary_file, startup_cache_file)
+
+
+def load_startup_settings():
+    '''Returns the endpoint configurations, OMF types and OMF data, from the startup cache while their files are unchanged'''
+
+    if startup_cache_file is None:
+        return get_appsettings(), list(iter_omf_items(omf_types_file)), list(iter_omf_items(omf_data_file))
+
+    # the files are stamped before they are read, so that a file changed in between is read again by the next run
+    stamps = {filename: get_file_stamp(filename) for filename in get_startup_files()}
+    cached = read_startup_cache(stamps)
+    if cached is not None:
+        return cached
+
+    endpoints = get_appsettings()
+    omf_types = list(iter_omf_items(omf_types_file))
+    omf_data = list(iter_omf_items(omf_data_file))
+    write_startup_cache(stamps, endpoints, omf_types, omf_data)
+
+    return endpoints, omf_types, omf_data
+
+
+# ************************************************************************
+# Shards the containers across worker processes, so that generating and
+# encoding the data is spread over several cores
+# ************************************************************************
+
+
+def get_shard(containerid, shard_count):
+    '''Returns the shard of a container, from a hash of its id that is stable across processes'''
+    return zlib.crc32(containerid.encode('utf-8')) % shard_count
+
+
+def get_shard_path(path):
+    '''Returns the path of a file or directory kept per process, which is suffixed with the shard in worker processes'''
+
+    if shard_index is None:
+        return path
+
+    return f'{path}.shard{shard_index}'
+
+
+def get_settings():
+    '''Returns the current values of the settings, to pass to worker processes'''
+    return {name: globals()[name] for name in setting_names}
+
+
+def apply_settings(settings):
+    '''Applies settings returned by get_settings in another process'''
+    globals().update(settings)
+
+
+def run_sharded(endpoints, omf_types, omf_data, test=False, last_sent_values={}):
+    '''Registers the types once, then runs a worker process per shard that registers and sends the containers of its shard'''
+
+    success = True
+
+    try:
+        for endpoint in endpoints:
+
+            if not endpoint["VerifySSL"]:
+                print('You are not verifying the certificate of the end point.  This is not advised for any system as there are security issues with doing this.')
+
+        # Step 5 - Send OMF Types that are not registered yet
+        check_endpoint_errors(run_on_all_endpoints(
+            endpoints, register_definitions, omf_types, []))
+
+    except Exception as ex:
+        print(f'Encountered Error: {ex}')
+        import traceback
+        traceback.print_exc()
+        if test:
+            raise ex
+        return False
+
+    finally:
+        shutdown_fan_out()
+        for endpoint in endpoints:
+            close_session(endpoint)
+
+    # Steps 6 and 7 - each worker has its own endpoint sessions, buffers and caches
+    import multiprocessing
+    import queue
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    settings = get_settings()
+    workers = [context.Process(target=run_shard_worker, args=(shard, worker_processes, test, results, settings),
+                               name=f'omf-shard-{shard}')
+               for shard in range(worker_processes)]
+    for worker in workers:
+        worker.start()
+
+    try:
+        reported_shards = set()
+        while len(reported_shards) < len(workers):
+            # a worker reports before it exits, so one that had exited before this wait and still did not report was
+            # killed, for example for running out of memory, and its shard failed
+            exited_shards = {shard for shard, worker in enumerate(workers) if worker.exitcode is not None}
+            try:
+                shard, worker_success, worker_sent_values = results.get(timeout=1)
+            except queue.Empty:
+                for shard in exited_shards - reported_shards:
+                    print(f'The worker process of shard {shard} exited with code {workers[shard].exitcode} '
+                          'without reporting')
+                    success = False
+                    reported_shards.add(shard)
+                continue
+
+            success = success and worker_success
+            last_sent_values.update(worker_sent_values)
+            reported_shards.add(shard)
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+    if test and not success:
+        raise Exception('A worker process failed to send its shard')
+
+    print('Done')
+    return success
+
+
+def run_shard_worker(shard, shard_count, test, results, settings):
+    '''Registers the containers of one shard and sends their data, then reports the outcome to the coordinator'''
+    global endpoints, shard_index
+
+    shard_index = shard
+    success = False
+    sent_values = {}
+
+    try:
+        apply_settings(settings)
+        endpoints, omf_types, omf_data = load_startup_settings()
+        omf_containers = (omf_container for omf_container in iter_omf_items(omf_containers_file)
+                          if get_shard(omf_container["id"], shard_count) == shard)
+        omf_data = [omf_datum for omf_datum in omf_data
+                    if get_shard(omf_datum["containerid"], shard_count) == shard]
+
+        start_metrics()
+
+        # Step 6 - Send the OMF Containers of this shard that are not registered yet, as they are read
+        omf_containers = register_streamed_definitions(
+            endpoints, [], omf_containers)
+
+        # Step 7 - Send the OMF Data of this shard, or replay the historical data of this shard
+        if replay_file is not None:
+            replay_data(endpoints, omf_types, omf_containers)
+        elif omf_data:
+            send_data(endpoints, omf_types, omf_containers,
+                      omf_data, test, sent_values)
+        success = True
+
+    except Exception as ex:
+        print(f'Encountered Error in shard {shard}: {ex}')
+        import traceback
+        traceback.print_exc()
+
+    finally:
+        shutdown_fan_out()
+        for endpoint in endpoints or []:
+            close_session(endpoint)
+        stop_metrics()
+        results.put((shard, success, sent_values))
+
+
+def iter_cycle_batches(omf_types, omf_containers, omf_data, scheduler, test=False, last_sent_values={}):
+    '''Generates the data of the containers every cycle of the scheduler and yields (batches, last) at the end of each
+    cycle, forever if this is not a test
+
+    The batches are the data due to be sent, or None while it is still being gathered. After the
+    cycles of a test, the data still gathered and the values held back by the value filter are
+    yielded last.'''
+
+    batcher = get_data_batcher(omf_types, omf_containers)
+    data_generator = None
+    if use_columnar_data:
+        data_generator = ColumnarDataGenerator(
+            omf_types, omf_containers, omf_data)
+    value_filter = get_value_filter(omf_types, omf_containers)
+    count = 0
+    while not test or count < 2:
+
+        '''This is where custom loop logic should go. 
+        The get_data call should also be customized to populate omf_data with relevant data.'''
+
+        get_timestamp_service().start_cycle(scheduler.get_tick_time_ns())
+        for data_to_send in filter_cycle_data(value_filter, get_cycle_data(omf_data, data_generator)):
+            batcher.add(data_to_send)
+
+            # record the values sent if this is a test
+            if test and count == 1:
+                if type(data_to_send) is ContainerRecord:
+                    data_to_send = data_to_send.to_data_message()
+                last_sent_values.update(
+                    {data_to_send["containerid"]: data_to_send})
+
+        # send the batched data once enough cycles have been gathered
+        yield (batcher.flush() if batcher.end_cycle() else None), False
+        count = count + 1
+
+    # send any data still gathered in a partial batch, with the values still held back by the value filter
+    if value_filter is not None:
+        for data_to_send in value_filter.flush():
+            batcher.add(data_to_send)
+    yield batcher.flush(), True
+
+
+def send_data(endpoints, omf_types, omf_containers, omf_data, test=False, last_sent_values={}):
+    '''Generates the data of the containers every cycle and sends it to all endpoints, forever if this is not a test'''
+
+    scheduler = CycleScheduler()
+    # send data to all endpoints forever if this is not a test
+    for batches, last in iter_cycle_batches(omf_types, omf_containers, omf_data, scheduler, test, last_sent_values):
+        if batches:
+            # an unavailable endpoint is skipped while sending forever, so that the other endpoints keep receiving data
+            check_endpoint_errors(send_to_all_endpoints(
+                endpoints, 'data', batches), tolerate_unavailable=not (test or last))
+        if not last:
+            scheduler.wait()
+
+
 def main(test=False, last_sent_values={}):
     # Main program.  Seperated out so that we can add a test function and call this easily
     global endpoints
 
     success = True
 
-    # Step 1 - Read endpoint configurations from appsettings.json
-    endpoints = get_appsettings()
-
-    # Step 2 - Get OMF Types
-    omf_types = get_json_file('OMF-Types.json')
+    # Steps 1, 2 and 4 - Read endpoint configurations from appsettings.json, and get OMF Types and Data, from the
+    # startup cache if they are unchanged
+    endpoints, omf_types, omf_data = load_startup_settings()
 
-    # Step 3 - Get OMF Containers
-    omf_containers = get_json_file('OMF-Containers.json')
+    # Step 3 - Get OMF Containers, which are read as they are registered in step 6
+    omf_containers = iter_omf_items(omf_containers_file)
 
-    # Step 4 - Get OMF Data
-    omf_data = get_json_file('OMF-Data.json')
+    # Steps 5 to 7 are shared between worker processes when the containers are sharded
+    if worker_processes > 1:
+        return run_sharded(endpoints, omf_types, omf_data, test, last_sent_values)
 
     # Send messages and check for each endpoint in appsettings.json
 
     try:
+        start_metrics()
+
         # Send out the messages that only need to be sent once
         for endpoint in endpoints:
 
             if not endpoint["VerifySSL"]:
                 print('You are not verifying the certificate of the end point.  This is not advised for any system as there are security issues with doing this.')
 
-            # Step 5 - Send OMF Types
-            for omf_type in omf_types:
-                send_message_to_omf_endpoint(endpoint, 'type', [omf_type])
+        # Step 5 and 6 - Send OMF Types and Containers that are not registered yet
+        omf_containers = register_streamed_definitions(
+            endpoints, omf_types, omf_containers)
+
+        # Step 7 - Send OMF Data, or replay historical data
+        if replay_file is not None:
+            replay_data(endpoints, omf_types, omf_containers)
+        else:
+            send_data(endpoints, omf_types, omf_containers,
+                      omf_data, test, last_sent_values)
+
+    except Exception as ex:
+        print(f'Encountered Error: {ex}')
+        print
+        import traceback
+        traceback.print_exc()
+        print
+        success = False
+        if test:
+            raise ex
+
+    finally:
+        shutdown_fan_out()
+        for endpoint in endpoints:
+            close_session(endpoint)
+        stop_metrics()
+
+    print('Done')
+    return success
+
+
+async def send_data_async(endpoints, omf_types, omf_containers, omf_data, test=False, last_sent_values={}):
+    '''Generates the data of the containers every cycle and sends it to all endpoints, forever if this is not a test'''
+
+    scheduler = CycleScheduler()
+    # send data to all endpoints forever if this is not a test
+    for batches, last in iter_cycle_batches(omf_types, omf_containers, omf_data, scheduler, test, last_sent_values):
+        if batches:
+            # an unavailable endpoint is skipped while sending forever, so that the other endpoints keep receiving data
+            check_endpoint_errors(await send_to_all_endpoints_async(
+                endpoints, 'data', batches), tolerate_unavailable=not (test or last))
+        if not last:
+            await scheduler.wait_async()
+
+
+async def main_async(test=False, last_sent_values={}):
+    # Asyncio version of the main program, which can be run with asyncio.run or awaited from an existing event loop
+    global endpoints
+
+    success = True
+
+    # Steps 1, 2 and 4 - Read endpoint configurations from appsettings.json, and get OMF Types and Data, from the
+    # startup cache if they are unchanged
+    endpoints, omf_types, omf_data = load_startup_settings()
 
-            # Step 6 - Send OMF Containers
-            for omf_container in omf_containers:
-                send_message_to_omf_endpoint(
-                    endpoint, 'container', [omf_container])
+    # Step 3 - Get OMF Containers, which are read as they are registered in step 6
+    omf_containers = iter_omf_items(omf_containers_file)
 
-        # Step 7 - Send OMF Data
-        count = 0
-        # send data to all endpoints forever if this is not a test
-        while not test or count < 2:
+    # Send messages and check for each endpoint in appsettings.json
 
-            '''This is where custom loop logic should go. 
-            The get_data call should also be customized to populate omf_data with relevant data.'''
+    try:
+        start_metrics()
 
-            for omf_datum in omf_data:
-                data_to_send = get_data(omf_datum)
-                for endpoint in endpoints:
+        # Send out the messages that only need to be sent once
+        for endpoint in endpoints:
 
-                    # send the data
-                    send_message_to_omf_endpoint(
-                        endpoint, 'data', [data_to_send])
+            if not endpoint["VerifySSL"]:
+                print('You are not verifying the certificate of the end point.  This is not advised for any system as there are security issues with doing this.')
 
-                # record the values sent if this is a test
-                if test and count == 1:
-                    last_sent_values.update(
-                        {omf_datum["containerid"]: data_to_send})
+        # Step 5 and 6 - Send OMF Types and Containers that are not registered yet
+        omf_containers = await register_streamed_definitions_async(
+            endpoints, omf_types, omf_containers)
 
-            time.sleep(sleep_time)
-            count = count + 1
+        # Step 7 - Send OMF Data, or replay historical data
+        if replay_file is not None:
+            await replay_data_async(endpoints, omf_types, omf_containers)
+        else:
+            await send_data_async(endpoints, omf_types, omf_containers,
+                                  omf_data, test, last_sent_values)
 
     except Exception as ex:
         print(f'Encountered Error: {ex}')
-        print
+        import traceback
         traceback.print_exc()
-        print
         success = False
         if test:
             raise ex
 
+    finally:
+        for endpoint in endpoints:
+            await close_session_async(endpoint)
+        stop_metrics()
+
     print('Done')
     return success
 
 
 if __name__ == '__main__':
-    main()
+    if use_asyncio:
+        asyncio.run(main_async())
+    else:
+        main()
@@ -1,11 +1,24 @@
 import unittest
+import program
 import traceback
 import requests
 import json
+import gzip
 import os
-from urllib.parse import urlparse
+import queue
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from urllib.parse import urlparse, quote
 from program import main, get_headers, endpoints, EndpointTypes,\
-    get_json_file, send_message_to_omf_endpoint, get_appsettings
+    get_json_file, send_message_to_omf_endpoint, get_appsettings, get_session, DataBatcher,\
+    OmfMessage, dumps_json, StoreAndForwardQueue, merge_data_messages,\
+    CircuitBreaker, CircuitOpenError, parse_retry_after, forget_registered_definitions
+
+# The number of containers checked per PI Web API batch request, and the number of SDS types or streams listed per page
+verification_batch_size = 500
 
 
 class ProgramTestCase(unittest.TestCase):
@@ -19,6 +32,723 @@ class ProgramTestCase(unittest.TestCase):
         self.assertTrue(cleanup(self))
 
 
+class BatchingTestCase(unittest.TestCase):
+    def test_batches_are_size_bounded_and_merge_cycles(self):
+        batcher = DataBatcher(cycles=2, max_bytes=200)
+        for cycle in range(2):
+            for containerid in ['FirstContainer', 'SecondContainer', 'ThirdContainer']:
+                batcher.add({"containerid": containerid, "values": [
+                            {"Timestamp": f'2025-01-01T00:00:0{cycle}Z', "IntegerProperty": cycle}]})
+            ready = batcher.end_cycle()
+        self.assertTrue(ready)
+
+        batches = batcher.flush()
+        self.assertGreater(len(batches), 1)
+        for batch in batches:
+            self.assertLessEqual(len(dumps_json(batch)), 200)
+
+        merged = [message for batch in batches for message in batch]
+        self.assertEqual(len(merged), 3)
+        for message in merged:
+            self.assertEqual([value["IntegerProperty"] for value in message["values"]], [0, 1])
+        self.assertEqual(batcher.flush(), [])
+
+    def test_values_accumulate_until_a_limit_is_reached(self):
+        batcher = DataBatcher(cycles=None, max_bytes=1000, value_count=50, max_values=40, latency_seconds=3600)
+        for i in range(45):
+            batcher.add({"containerid": 'FirstContainer', "values": [{"Timestamp": f'2025-01-01T00:00:{i:02}Z', "IntegerProperty": i}]})
+            self.assertFalse(batcher.end_cycle())
+
+        # the ring buffer keeps the newest values
+        self.assertEqual(batcher.dropped_values, 5)
+        batcher.add({"containerid": 'FirstContainer', "values": [{"Timestamp": '2025-01-01T00:01:00Z', "IntegerProperty": 45}]})
+        batcher.latency_seconds = 0
+        self.assertTrue(batcher.is_due())
+
+        batches = batcher.flush()
+        self.assertGreater(len(batches), 1)
+        values = [value["IntegerProperty"] for batch in batches for message in batch for value in message["values"]]
+        self.assertEqual(values, list(range(6, 46)))
+        for batch in batches:
+            self.assertLessEqual(len(dumps_json(batch)), 1000)
+
+    def test_values_longer_than_the_first_are_split_by_their_size(self):
+        import random
+        encoder = program.DataEncoder(get_json_file('OMF-Types.json'), get_json_file('OMF-Containers.json'))
+        values = [{"Timestamp": '2025-01-01T00:00:00Z', "NumberProperty1": 1.0, "NumberProperty2": 2.0}]
+        values += [{"Timestamp": '2025-01-01T00:00:00Z', "NumberProperty1": random.random(),
+                    "NumberProperty2": random.random()} for _ in range(2000)]
+        for use_fast_json in (True, False):
+            for batch_encoder in (None, encoder):
+                program.use_fast_json = use_fast_json
+                batcher = DataBatcher(max_bytes=4096, encoder=batch_encoder)
+                batcher.add({"containerid": 'ThirdContainer', "values": values})
+                try:
+                    batches = [batch.json_bytes() if batch_encoder else dumps_json(batch) for batch in batcher.flush()]
+                finally:
+                    program.use_fast_json = True
+
+                for batch in batches:
+                    self.assertLessEqual(len(batch), 4096)
+                sent = [value for batch in batches for message in json.loads(batch) for value in message["values"]]
+                self.assertEqual(sent, values)
+
+
+    def test_an_invalid_record_is_dropped_when_it_is_added(self):
+        encoder = program.TypeEncoder({"id": 'FlagType', "type": 'object', "classification": 'dynamic', "properties": {
+            "Timestamp": {"type": 'string', "format": 'date-time', "isindex": True},
+            "Flag": {"type": 'boolean'}}})
+        batcher = DataBatcher()
+        batcher.add(program.ContainerRecord('FlagContainer', encoder, 1735689600000000000, (68.7,)))
+        self.assertEqual(batcher.flush(), [])
+
+        batcher.add(program.ContainerRecord('FlagContainer', encoder, 1735689600000000000, (True,)))
+        self.assertEqual(batcher.flush(), [[{"containerid": 'FlagContainer', "values": [
+            {"Timestamp": '2025-01-01T00:00:00.000000Z', "Flag": True}]}]])
+
+
+class EncodingTestCase(unittest.TestCase):
+    def test_message_is_encoded_once(self):
+        message = OmfMessage([{"containerid": 'FirstContainer', "values": [
+                             {"Timestamp": '2025-01-01T00:00:00Z', "IntegerProperty": 1}]}])
+        json_bytes = message.json_bytes()
+        gzip_bytes = message.gzip_bytes()
+        self.assertIs(message.json_bytes(), json_bytes)
+        self.assertIs(message.gzip_bytes(), gzip_bytes)
+        self.assertEqual(gzip.decompress(gzip_bytes), json_bytes)
+        self.assertEqual(json.loads(json_bytes), message.message_omf_json)
+
+
+class TypeEncoderTestCase(unittest.TestCase):
+    def test_values_are_validated_and_encoded_in_type_order(self):
+        encoder = program.DataEncoder(get_json_file('OMF-Types.json'), get_json_file('OMF-Containers.json'))
+        data = [{"containerid": 'ThirdContainer', "values": [
+            {"StringEnum": 'True', "NumberProperty2": 2, "NumberProperty1": 1.5, "Timestamp": '2025-01-01T00:00:00Z'},
+            {"Timestamp": '2025-01-01T00:00:01Z', "NumberProperty1": 2.5}]}]
+        batches = encoder.encode_batches(data)
+        self.assertEqual(batches[0].json_bytes(),
+                         b'[{"containerid":"ThirdContainer","values":[{"Timestamp":"2025-01-01T00:00:00Z","NumberProperty1":1.5,'
+                         b'"NumberProperty2":2.0,"StringEnum":"True"},{"Timestamp":"2025-01-01T00:00:01Z","NumberProperty1":2.5}]}]')
+
+        for value in [{"Timestamp": '2025-01-01T00:00:00Z', "IntegerEnum": 2},
+                      {"Timestamp": '2025-01-01T00:00:00Z', "IntegerEnum": True},
+                      {"Timestamp": 'yesterday', "IntegerEnum": 0},
+                      {"IntegerEnum": 0},
+                      {"Timestamp": '2025-01-01T00:00:00Z', "Unknown": 0}]:
+            with self.assertRaises(program.OmfValueError):
+                encoder.encode({"containerid": 'FourthContainer', "values": [value]})
+
+        # an invalid value is dropped from the batch, and the other values are still encoded
+        batches = encoder.encode_batches([
+            {"containerid": 'FourthContainer', "values": [{"Timestamp": '2025-01-01T00:00:00Z', "IntegerEnum": 2},
+                                                          {"Timestamp": '2025-01-01T00:00:00Z', "IntegerEnum": 1}]},
+            {"containerid": 'UnknownContainer', "values": [{"Timestamp": '2025-01-01T00:00:00Z'}]},
+            {"containerid": 'ThirdContainer', "values": [{"Timestamp": '2025-01-01T00:00:00Z', "NumberProperty1": 10 ** 400}]},
+            {"containerid": 'FourthContainer', "values": [{"IntegerEnum": 0}]}])
+        self.assertEqual(json.loads(batches[0].json_bytes()), [
+            {"containerid": 'FourthContainer', "values": [{"Timestamp": '2025-01-01T00:00:00Z', "IntegerEnum": 1}]}])
+        self.assertEqual(batches[0].get_containerids(), {'FourthContainer'})
+
+
+class StreamingLoaderTestCase(unittest.TestCase):
+    def test_items_are_read_incrementally_from_each_format(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # a tiny chunk size splits items, strings and numbers across reads
+            for filename in ['OMF-Types.json', 'OMF-Containers.json', 'OMF-Data.json']:
+                self.assertEqual(list(program.iter_json_array_items(filename, chunk_size=3)), get_json_file(filename))
+
+            ndjson_file = os.path.join(directory, 'containers.ndjson')
+            with open(ndjson_file, 'w') as f:
+                f.write('{"id": "FirstContainer", "typeid": "FirstDynamicType"}\n\n{"id": "SecondContainer", "typeid": "FirstDynamicType"}\n')
+            csv_file = os.path.join(directory, 'containers.csv')
+            with open(csv_file, 'w') as f:
+                f.write('id,typeid,description\nFirstContainer,FirstDynamicType,\nSecondContainer,FirstDynamicType,"Second, container"\n')
+            self.assertEqual(list(program.iter_omf_items(ndjson_file)), get_json_file('OMF-Containers.json')[:2])
+            self.assertEqual(list(program.iter_omf_items(csv_file)),
+                             [{"id": 'FirstContainer', "typeid": 'FirstDynamicType'},
+                              {"id": 'SecondContainer', "typeid": 'FirstDynamicType', "description": 'Second, container'}])
+
+            invalid_file = os.path.join(directory, 'invalid.json')
+            with open(invalid_file, 'w') as f:
+                f.write('[{"id": 1}, {"id": 2]')
+            items = program.iter_omf_items(invalid_file)
+            self.assertEqual(next(items), {"id": 1})
+            with self.assertRaises(ValueError):
+                next(items)
+
+
+class ReplayTestCase(unittest.TestCase):
+    def test_replay_resumes_from_checkpoint(self):
+        import benchmark
+        omf_types = get_json_file('OMF-Types.json')
+        omf_containers = get_json_file('OMF-Containers.json')
+        server = benchmark.FakeOmfServer().start()
+        endpoints = program.configure_endpoints([server.get_endpoint_settings()])
+        settings = (program.replay_file, program.replay_batch_values, program.replay_checkpoint_file)
+        with tempfile.TemporaryDirectory() as directory:
+            replay_file = os.path.join(directory, 'history.csv')
+            with open(replay_file, 'w') as f:
+                f.write('containerid,Timestamp,IntegerProperty,NumberProperty1,NumberProperty2,StringEnum\n'
+                        'FirstContainer,2024-01-01T00:00:00Z,1,,,\n'
+                        'ThirdContainer,2024-01-01T00:00:00Z,,1.5,2.5,True\n'
+                        'FirstContainer,2024-01-01T00:00:10Z,2,,,\n'
+                        'FirstContainer,2024-01-01T00:01:00Z,3,,,\n')
+            program.replay_file = replay_file
+            program.replay_batch_values = 2
+            program.replay_checkpoint_file = os.path.join(directory, 'checkpoint.json')
+            try:
+                reader = program.ReplayReader(replay_file, omf_types, omf_containers)
+                data_messages, offset, _ = reader.read(reader.data_offset, 10, max_seconds=30)
+                reader.close()
+                self.assertEqual(data_messages, [
+                    {"containerid": 'FirstContainer', "values": [{"Timestamp": '2024-01-01T00:00:00Z', "IntegerProperty": 1},
+                                                                 {"Timestamp": '2024-01-01T00:00:10Z', "IntegerProperty": 2}]},
+                    {"containerid": 'ThirdContainer', "values": [{"Timestamp": '2024-01-01T00:00:00Z', "NumberProperty1": 1.5,
+                                                                  "NumberProperty2": 2.5, "StringEnum": 'True'}]}])
+
+                # rows grouped by container cannot be paced
+                pacer = program.ReplayPacer(60)
+                pacer.get_delay((0, 60))
+                self.assertRaises(program.OmfValueError, pacer.get_delay, (30, 90))
+                grouped_file = os.path.join(directory, 'grouped.csv')
+                with open(grouped_file, 'w') as f:
+                    f.write('containerid,Timestamp,IntegerProperty\n'
+                            'FirstContainer,2024-01-01T00:00:00Z,1\n'
+                            'FirstContainer,2024-01-01T00:00:10Z,2\n'
+                            'SecondContainer,2024-01-01T00:00:00Z,3\n')
+                reader = program.ReplayReader(grouped_file, omf_types, omf_containers)
+                try:
+                    self.assertEqual(len(reader.read(reader.data_offset, 10)[0]), 2)
+                    self.assertRaises(program.OmfValueError, reader.read, reader.data_offset, 10, 30)
+                finally:
+                    reader.close()
+
+                self.assertEqual(program.replay_data(endpoints, omf_types, omf_containers), 4)
+                self.assertEqual(server.values, 4)
+                # a finished replay sends nothing again, and rows appended later are sent from the checkpoint
+                self.assertEqual(program.replay_data(endpoints, omf_types, omf_containers), 0)
+                with open(replay_file, 'a') as f:
+                    f.write('SecondContainer,2024-01-01T00:02:00Z,4,,,\n')
+                self.assertEqual(program.replay_data(endpoints, omf_types, omf_containers), 1)
+                self.assertEqual(server.values, 5)
+            finally:
+                program.replay_file, program.replay_batch_values, program.replay_checkpoint_file = settings
+                program.close_session(endpoints[0])
+                server.stop()
+
+
+class ValueFilterTestCase(unittest.TestCase):
+    def filter_values(self, value_filter, containerid, values):
+        sent = []
+        for second, value in enumerate(values):
+            for data in value_filter.filter({"containerid": containerid, "values": [
+                    dict(value, Timestamp=f'2024-01-01T00:00:{second:02d}Z')]}):
+                sent.extend(data["values"])
+        return [(int(value["Timestamp"][17:19]), {k: v for k, v in value.items() if k != 'Timestamp'}) for value in sent]
+
+    def test_values_are_sent_on_change_deadband_and_swinging_door(self):
+        omf_types = get_json_file('OMF-Types.json')
+        omf_containers = get_json_file('OMF-Containers.json')
+        value_filter = program.ValueFilter(omf_types, omf_containers, {
+            "FirstDynamicType": {"Mode": 'deadband', "Deviation": 2, "MaxIntervalSeconds": 5},
+            "SecondContainer": {"Mode": 'change'},
+            "ThirdContainer": {"Mode": 'swinging_door', "Deviation": 0.5}})
+
+        # deadband with a heartbeat every 5 seconds
+        self.assertEqual(self.filter_values(value_filter, 'FirstContainer', [{"IntegerProperty": i} for i in [0, 1, 2, 3, 3, 3, 3, 3, 3, 10]]),
+                         [(0, {"IntegerProperty": 0}), (3, {"IntegerProperty": 3}), (8, {"IntegerProperty": 3}), (9, {"IntegerProperty": 10})])
+        # the container's own filter is used over the filter of its type
+        self.assertEqual([second for second, _ in self.filter_values(value_filter, 'SecondContainer', [{"IntegerProperty": i} for i in [0, 0, 1, 1, 0]])],
+                         [0, 2, 4])
+
+        # a ramp is held back until it turns, then its end is sent with its own timestamp
+        ramp = [{"NumberProperty1": float(i), "NumberProperty2": 1.0, "StringEnum": 'False'} for i in range(5)] + \
+               [{"NumberProperty1": 3.0, "NumberProperty2": 1.0, "StringEnum": 'False'},
+                {"NumberProperty1": 3.0, "NumberProperty2": 1.0, "StringEnum": 'True'}]
+        self.assertEqual([second for second, _ in self.filter_values(value_filter, 'ThirdContainer', ramp)], [0, 4, 5, 6])
+        self.assertEqual(value_filter.flush(), [])
+        self.filter_values(value_filter, 'ThirdContainer', ramp[:3])
+        self.assertEqual(value_filter.flush()[0]["values"][0]["NumberProperty1"], 2.0)
+
+        # container records are filtered the same way and stay records
+        encoder = program.TypeEncoder(omf_types[0])
+        records = [program.ContainerRecord('FirstContainer', encoder, second * 1000000000, (value,)) for second, value in enumerate([0, 1, 5])]
+        value_filter = program.ValueFilter(omf_types, omf_containers, {"FirstContainer": {"Mode": 'deadband', "Deviation": 2}})
+        self.assertEqual([record.to_row() for record in program.filter_cycle_data(value_filter, records)],
+                         [(0, 0), (2000000000, 5)])
+
+
+class StoreAndForwardTestCase(unittest.TestCase):
+    def test_queue_replays_in_order_across_restarts(self):
+        with tempfile.TemporaryDirectory() as directory:
+            queue = StoreAndForwardQueue(directory, max_bytes=1000, segment_bytes=100)
+            for i in range(10):
+                queue.append(dumps_json([{"containerid": 'FirstContainer', "values": [{"IntegerProperty": i}]}]))
+
+            records, position = queue.read(200)
+            self.assertGreater(len(records), 1)
+            queue.commit(position)
+
+            # reopen the queue as after a restart and read the rest of the backlog
+            queue = StoreAndForwardQueue(directory, max_bytes=1000, segment_bytes=100)
+            remaining, position = queue.read(10000)
+            queue.commit(position)
+            self.assertTrue(queue.is_empty())
+
+            merged = json.loads(merge_data_messages(records + remaining))
+            self.assertEqual([message["values"][0]["IntegerProperty"] for message in merged], list(range(10)))
+
+    def test_queue_evicts_oldest_segments(self):
+        with tempfile.TemporaryDirectory() as directory:
+            queue = StoreAndForwardQueue(directory, max_bytes=300, segment_bytes=100)
+            for i in range(20):
+                queue.append(dumps_json([{"containerid": 'FirstContainer', "values": [{"IntegerProperty": i}]}]))
+            self.assertLessEqual(queue.size(), 300)
+
+            records, _ = queue.read(10000)
+            values = [json.loads(record)[0]["values"][0]["IntegerProperty"] for record in records]
+            self.assertEqual(values, list(range(20 - len(values), 20)))
+
+
+class RetryTestCase(unittest.TestCase):
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('5'), 5.0)
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('soon'))
+        self.assertEqual(parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0.0)
+
+    def test_circuit_breaker_opens_and_lets_a_trial_through(self):
+        endpoint = {"OmfEndpoint": 'http://localhost:5590/omf'}
+        circuit_breaker = CircuitBreaker(threshold=2, reset_seconds=0)
+        circuit_breaker.record_failure(endpoint)
+        circuit_breaker.check(endpoint)
+        circuit_breaker.record_failure(endpoint)
+
+        # the reset time has passed, so a single trial request is let through
+        circuit_breaker.check(endpoint)
+        self.assertRaises(CircuitOpenError, circuit_breaker.check, endpoint)
+
+        circuit_breaker.record_success()
+        circuit_breaker.check(endpoint)
+
+    def test_circuit_breaker_closes_after_a_rejected_or_failed_trial(self):
+        endpoint = {"OmfEndpoint": 'http://localhost:5590/omf',
+                    "CircuitBreaker": CircuitBreaker(threshold=1, reset_seconds=0)}
+        endpoint["CircuitBreaker"].record_failure(endpoint)
+        post_message = program.post_message_to_omf_endpoint
+        try:
+            # the trial reaches the endpoint, which rejects the message, so the endpoint is no longer skipped
+            program.post_message_to_omf_endpoint = lambda *args: program.report_unsuccessful_response(
+                'data', OmfMessage([]), {}, 400, 'Bad Request')
+            self.assertRaises(program.OmfSendError, send_message_to_omf_endpoint, endpoint, 'data', [])
+            self.assertIsNone(endpoint["CircuitBreaker"].opened_at)
+
+            # a trial that fails with another error lets the next trial through
+            endpoint["CircuitBreaker"].record_failure(endpoint)
+            program.post_message_to_omf_endpoint = lambda *args: 1 / 0
+            self.assertRaises(ZeroDivisionError, send_message_to_omf_endpoint, endpoint, 'data', [])
+            self.assertRaises(ZeroDivisionError, send_message_to_omf_endpoint, endpoint, 'data', [])
+        finally:
+            program.post_message_to_omf_endpoint = post_message
+
+    def test_failed_token_requests_are_sendable_errors(self):
+        class Session:
+            def get(self, url, headers):
+                raise requests.exceptions.ConnectionError('refused')
+
+            def post(self, url, data):
+                return SimpleNamespace(status_code=503, text='Unavailable', headers={'Retry-After': '2'},
+                                       close=lambda: None)
+
+        endpoint = {"Resource": 'https://localhost', "ClientId": 'id', "ClientSecret": 'secret', "Session": Session()}
+        with self.assertRaises(program.OmfTokenError) as context:
+            program.refresh_token(endpoint)
+        self.assertTrue(context.exception.is_retriable())
+
+        # whatever the identity service answers, the message itself is not rejected
+        endpoint["TokenUrl"] = 'https://localhost/identity/connect/token'
+        with self.assertRaises(program.OmfTokenError) as context:
+            program.refresh_token(endpoint)
+        self.assertEqual(context.exception.retry_after, 2.0)
+        self.assertFalse(program.is_message_rejected(context.exception))
+
+
+class RegistrationCacheTestCase(unittest.TestCase):
+    def test_only_changed_definitions_are_registered(self):
+        endpoint = {"OmfEndpoint": 'http://localhost:5590/omf'}
+        omf_types = get_json_file('OMF-Types.json')
+        with tempfile.TemporaryDirectory() as directory:
+            program.registration_cache_file = os.path.join(directory, 'cache.json')
+            program.registration_cache = None
+            try:
+                pending = program.get_unregistered_definitions(endpoint, 'type', omf_types)
+                self.assertEqual(len(pending), len(omf_types))
+                program.record_registered_definitions(endpoint, 'type', pending)
+                program.save_registration_cache()
+
+                # reload the cache from disk as after a restart
+                program.registration_cache = None
+                changed_type = dict(omf_types[0], description='changed')
+                pending = program.get_unregistered_definitions(endpoint, 'type', [changed_type] + omf_types[1:])
+                self.assertEqual([definition for definition, _ in pending], [changed_type])
+
+                # data rejected as not found shows that the definitions may have been deleted from the endpoint
+                program.forget_definitions_of_rejected_data(endpoint, 'type', program.OmfSendError('', 404))
+                program.forget_definitions_of_rejected_data(endpoint, 'data', program.OmfSendError('', 503))
+                self.assertEqual(program.get_unregistered_definitions(endpoint, 'type', omf_types), [])
+                program.forget_definitions_of_rejected_data(endpoint, 'data', program.OmfSendError('', 404))
+                self.assertEqual(len(program.get_unregistered_definitions(endpoint, 'type', omf_types)), len(omf_types))
+            finally:
+                program.registration_cache_file = 'omf_registration_cache.json'
+                program.registration_cache = None
+
+    def test_a_worker_rejection_forgets_the_types_of_the_main_process(self):
+        endpoint = {"OmfEndpoint": 'http://localhost:5590/omf'}
+        omf_types = get_json_file('OMF-Types.json')
+        omf_containers = get_json_file('OMF-Containers.json')
+        with tempfile.TemporaryDirectory() as directory:
+            program.registration_cache_file = os.path.join(directory, 'cache.json')
+            program.registration_cache = None
+            try:
+                # the main process registers the types, and a worker the containers of its shard
+                program.record_registered_definitions(
+                    endpoint, 'type', program.get_unregistered_definitions(endpoint, 'type', omf_types))
+                program.save_registration_cache()
+                program.shard_index = 1
+                program.registration_cache = None
+                program.record_registered_definitions(
+                    endpoint, 'container', program.get_unregistered_definitions(endpoint, 'container', omf_containers))
+                program.save_registration_cache()
+
+                # containers rejected because their types were deleted also forget the types
+                program.forget_definitions_of_rejected_data(endpoint, 'container', program.OmfSendError('', 400))
+                self.assertEqual(len(program.get_unregistered_definitions(endpoint, 'container', omf_containers)),
+                                 len(omf_containers))
+                program.shard_index = None
+                program.registration_cache = None
+                self.assertEqual(len(program.get_unregistered_definitions(endpoint, 'type', omf_types)), len(omf_types))
+            finally:
+                program.shard_index = None
+                program.registration_cache_file = 'omf_registration_cache.json'
+                program.registration_cache = None
+
+
+class ColumnarDataTestCase(unittest.TestCase):
+    def test_generated_values_match_types(self):
+        numpy = program.import_numpy()
+        try:
+            # generate with numpy, if installed, and with the plain python fallback
+            for program.numpy in {numpy, None}:
+                generator = program.ColumnarDataGenerator(get_json_file('OMF-Types.json'), get_json_file('OMF-Containers.json'),
+                                                          get_json_file('OMF-Data.json'))
+                first_cycle = {message["containerid"]: message["values"][0] for message in generator.generate()}
+                second_cycle = {message["containerid"]: message["values"][0] for message in generator.generate()}
+
+                self.assertEqual(set(first_cycle), {'FirstContainer', 'SecondContainer', 'ThirdContainer', 'FourthContainer'})
+                self.assertIsInstance(first_cycle["FirstContainer"]["IntegerProperty"], int)
+                self.assertTrue(0 <= first_cycle["ThirdContainer"]["NumberProperty1"] < 100)
+                self.assertEqual([first_cycle["ThirdContainer"]["StringEnum"], second_cycle["ThirdContainer"]["StringEnum"]],
+                                 ['False', 'True'])
+                self.assertEqual([first_cycle["FourthContainer"]["IntegerEnum"], second_cycle["FourthContainer"]["IntegerEnum"]], [0, 1])
+                json.dumps(first_cycle)
+        finally:
+            program.numpy = numpy
+
+    def test_values_are_generated_for_every_property_type(self):
+        omf_type = {"id": 'AllTypes', "type": 'object', "classification": 'dynamic', "properties": {
+            "Timestamp": {"type": 'string', "format": 'date-time', "isindex": True},
+            "Flag": {"type": 'boolean'},
+            "Name": {"type": 'string'},
+            "Updated": {"type": 'string', "format": 'date-time'},
+            "Level": {"type": ['number', 'null'], "format": 'float32'},
+            "Count": {"type": 'integer', "format": 'uint16'}}}
+        encoder = program.TypeEncoder(omf_type)
+        numpy = program.import_numpy()
+        try:
+            for program.numpy in {numpy, None}:
+                group = program.ColumnGroup(omf_type)
+                group.containerids = ['First', 'Second']
+                group.create_columns()
+                group.fill()
+                for message in group.to_data_messages('2025-01-01T00:00:00Z'):
+                    encoder.encode(message["values"][0])
+                    self.assertIsInstance(message["values"][0]["Flag"], bool)
+        finally:
+            program.numpy = numpy
+
+        omf_type["properties"]["Tags"] = {"type": 'array', "items": {"type": 'string'}}
+        self.assertRaises(ValueError, program.ColumnGroup, omf_type)
+
+    def test_records_encode_like_data_messages(self):
+        omf_types = get_json_file('OMF-Types.json')
+        omf_containers = get_json_file('OMF-Containers.json')
+        generator = program.ColumnarDataGenerator(omf_types, omf_containers, get_json_file('OMF-Data.json'))
+        records = generator.generate_records(1735689600123456789)
+        self.assertEqual(records[0].to_row()[0], 1735689600123456789)
+
+        expected = [record.to_data_message() for record in records]
+        self.assertEqual(expected[0]["values"][0]["Timestamp"], '2025-01-01T00:00:00.123456Z')
+        for encoder in [None, program.DataEncoder(omf_types, omf_containers)]:
+            batcher = DataBatcher(encoder=encoder)
+            for record in records:
+                batcher.add(record)
+            batches = batcher.flush()
+            if encoder is not None:
+                batches = [json.loads(batch.json_bytes()) for batch in batches]
+            self.assertEqual(sorted(sum(batches, []), key=lambda data: data["containerid"]),
+                             sorted(expected, key=lambda data: data["containerid"]))
+
+
+class TimestampTestCase(unittest.TestCase):
+    def test_aligned_timestamps_share_the_cycle_instant(self):
+        service = program.TimestampService(aligned=True)
+        service.start_cycle()
+        first = service.now()
+        time.sleep(0.002)
+        self.assertEqual(service.now(), first)
+        self.assertEqual(service.format(service.now_ns()), first)
+        service.start_cycle()
+        self.assertNotEqual(service.now(), first)
+
+        unaligned = program.TimestampService(aligned=False)
+        self.assertEqual(unaligned.format(1735689600123456789), '2025-01-01T00:00:00.123456Z')
+        self.assertEqual(unaligned.format(1735689601000000000), '2025-01-01T00:00:01.000000Z')
+        self.assertEqual(unaligned.format_json(1735689601000000000), '"2025-01-01T00:00:01.000000Z"')
+
+
+class ShardingTestCase(unittest.TestCase):
+    def test_containers_are_spread_over_stable_shards(self):
+        containerids = [f'Container{i}' for i in range(1000)]
+        shards = [program.get_shard(containerid, 4) for containerid in containerids]
+        self.assertEqual(shards, [program.get_shard(containerid, 4) for containerid in containerids])
+        for shard in range(4):
+            self.assertGreater(shards.count(shard), 200)
+
+    def test_worker_reports_when_it_fails_to_start(self):
+        settings = program.get_settings()
+        load_startup_settings = program.load_startup_settings
+        loaded_sleep_times = []
+        results = queue.Queue()
+        try:
+            program.load_startup_settings = lambda: loaded_sleep_times.append(program.sleep_time) or 1 / 0
+            program.run_shard_worker(1, 2, True, results, dict(settings, sleep_time=0.25))
+        finally:
+            program.load_startup_settings = load_startup_settings
+            program.apply_settings(settings)
+            program.shard_index = None
+
+        # the settings of the coordinator are applied before the worker loads anything
+        self.assertEqual(loaded_sleep_times, [0.25])
+        self.assertEqual(results.get_nowait(), (1, False, {}))
+
+
+class StartupCacheTestCase(unittest.TestCase):
+    def test_settings_are_reused_until_a_file_changes(self):
+        settings = (program.startup_cache_file, program.omf_types_file, program.omf_data_file)
+        working_directory = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            program.omf_types_file = os.path.abspath('OMF-Types.json')
+            program.omf_data_file = os.path.join(directory, 'OMF-Data.json')
+            program.startup_cache_file = os.path.join(directory, 'startup_cache.json')
+            get_appsettings = program.get_appsettings
+            reads = []
+            program.get_appsettings = lambda: reads.append(True) or get_appsettings()
+            try:
+                os.chdir(directory)
+                with open('appsettings.json', 'w') as f:
+                    json.dump({"Endpoints": [{"Selected": True, "EndpointType": 'OCS', "Resource": 'https://example.com', "ApiVersion": 'v1',
+                                              "TenantId": 'tenant', "NamespaceId": 'namespace', "ClientSecret": 'secret'}]}, f)
+                with open(program.omf_data_file, 'w') as f:
+                    json.dump(get_json_file(os.path.join(working_directory, 'OMF-Data.json')), f)
+
+                for validation in ['mtime', 'hash']:
+                    program.startup_cache_validation = validation
+                    endpoints, omf_types, omf_data = program.load_startup_settings()
+                    endpoints[0]["Session"] = requests.Session()
+                    self.assertEqual(program.load_startup_settings(), (
+                        [{key: value for key, value in endpoints[0].items() if key != 'Session'}], omf_types, omf_data))
+                    self.assertEqual(len(reads), 1)
+                    self.assertEqual(endpoints[0]["EndpointType"], EndpointTypes.CDS)
+                    self.assertEqual(os.stat(program.startup_cache_file).st_mode & 0o777, 0o600)
+                    endpoints[0]["Session"].close()
+
+                    # changing any of the files builds the cache again
+                    with open(program.omf_data_file, 'w') as f:
+                        json.dump(omf_data[:1], f)
+                    self.assertEqual(program.load_startup_settings()[2], omf_data[:1])
+                    self.assertEqual(len(reads), 2)
+                    with open(program.omf_data_file, 'w') as f:
+                        json.dump(omf_data, f)
+                    reads.clear()
+            finally:
+                os.chdir(working_directory)
+                program.get_appsettings = get_appsettings
+                program.startup_cache_file, program.omf_types_file, program.omf_data_file = settings
+                program.startup_cache_validation = 'mtime'
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def test_benchmark_against_fake_endpoint(self):
+        import benchmark
+        omf_types = get_json_file('OMF-Types.json')
+        omf_containers, omf_data = benchmark.create_containers(20, omf_types)
+        server = benchmark.FakeOmfServer(throttle_every=3).start()
+        try:
+            result = benchmark.run_benchmark([server], 'EDS', omf_types, omf_containers, omf_data,
+                                             cycles=2, batch_cycles=0, use_compression=True, concurrent=False)
+        finally:
+            server.stop()
+
+        # the settings changed for the benchmark are restored afterwards
+        self.assertTrue(program.concurrent_fan_out)
+
+        # every value arrives once, even though some messages were throttled and retried
+        self.assertEqual(server.values, 40)
+        self.assertGreater(server.throttled, 0)
+        self.assertGreater(result["bytes_on_wire"], 0)
+        self.assertGreaterEqual(result["p99_latency_ms"], result["p50_latency_ms"])
+
+
+class RateControlTestCase(unittest.TestCase):
+    def test_concurrency_adapts_to_latency_and_throttling(self):
+        limiter = program.ConcurrencyLimiter(max_limit=4, target_seconds=0.5)
+        for _ in range(10):
+            limiter.record(0.01, False)
+        self.assertEqual(limiter.current(), 4)
+        # the requests in flight during one slowdown only halve the limit once
+        limiter.record(0.01, True)
+        limiter.record(1, False)
+        self.assertEqual(limiter.current(), 2)
+
+        import benchmark
+        server = benchmark.FakeOmfServer(latency_seconds=0.01).start()
+        endpoint = program.configure_endpoints([server.get_endpoint_settings()])[0]
+        try:
+            program.send_messages_to_endpoint(endpoint, 'data', [
+                {"containerid": f'Container{i}', "values": [{"IntegerProperty": i}]} for i in range(20)])
+        finally:
+            program.close_session(endpoint)
+            server.stop()
+        self.assertEqual(server.values, 20)
+        self.assertGreater(endpoint["ConcurrencyLimiter"].current(), 1)
+
+    def test_values_of_a_container_are_sent_in_order(self):
+        batcher = DataBatcher(max_bytes=200)
+        for i in range(30):
+            for containerid in ('FirstContainer', 'SecondContainer', 'ThirdContainer'):
+                batcher.add({"containerid": containerid, "values": [{"IntegerProperty": i}]})
+        messages = batcher.flush()
+
+        sent = []
+        in_flight = []
+        lock = threading.Lock()
+
+        def send_message(endpoint, message_type, message):
+            containerids = [data["containerid"] for data in message.get_json()]
+            with lock:
+                self.assertFalse(set(containerids) & set(sum(in_flight, [])))
+                in_flight.append(containerids)
+            time.sleep(0.01)
+            with lock:
+                in_flight.remove(containerids)
+                sent.extend(message.get_json())
+
+        endpoint = {"OmfEndpoint": 'http://localhost:5590/omf',
+                    "ConcurrencyLimiter": program.ConcurrencyLimiter(max_limit=4, target_seconds=1)}
+        endpoint["ConcurrencyLimiter"].limit = 4
+        send_message_to_endpoint = program.send_message_to_omf_endpoint
+        try:
+            program.send_message_to_omf_endpoint = send_message
+            program.send_data_concurrently(endpoint, messages)
+        finally:
+            program.send_message_to_omf_endpoint = send_message_to_endpoint
+            endpoint["RequestExecutor"].shutdown()
+
+        self.assertGreater(len(messages), 3)
+        for containerid in ('FirstContainer', 'SecondContainer', 'ThirdContainer'):
+            values = sum([data["values"] for data in sent if data["containerid"] == containerid], [])
+            self.assertEqual(values, [{"IntegerProperty": i} for i in range(30)])
+
+    def test_scheduler_keeps_a_fixed_rate(self):
+        now = [100.0]
+        scheduler = program.CycleScheduler(period=0.5, catch_up=False, clock=lambda: now[0])
+        # a cycle that takes less than the period waits for the rest of it
+        now[0] = 100.125
+        self.assertEqual(scheduler.advance(), 0.375)
+        self.assertEqual(scheduler.tick, 1)
+        # the ticks missed by a slow cycle are skipped, and the next tick is on the schedule
+        now[0] = 101.75
+        self.assertEqual(scheduler.advance(), 0.25)
+        self.assertEqual(scheduler.tick, 4)
+
+        now[0] = 100.0
+        scheduler = program.CycleScheduler(period=0.5, catch_up=True, clock=lambda: now[0])
+        now[0] = 101.25
+        self.assertEqual([scheduler.advance() for _ in range(2)], [0, 0])
+        self.assertEqual(scheduler.advance(), 0.25)
+        self.assertEqual(scheduler.tick, 3)
+
+
+class MetricsTestCase(unittest.TestCase):
+    def test_send_path_is_measured(self):
+        import benchmark
+        server = benchmark.FakeOmfServer(throttle_every=2).start()
+        endpoint = program.configure_endpoints([server.get_endpoint_settings()])[0]
+        snapshots = []
+        program.metrics_sink = snapshots.append
+        try:
+            program.start_metrics()
+            for _ in range(2):
+                send_message_to_omf_endpoint(endpoint, 'data', [{"containerid": 'FirstContainer', "values": [{"IntegerProperty": 1}]}])
+            text = program.metrics.to_prometheus_text()
+            program.stop_metrics()
+        finally:
+            program.metrics_sink = None
+            program.stop_metrics()
+            program.close_session(endpoint)
+            server.stop()
+
+        labels = f'endpoint="{endpoint["OmfEndpoint"]}",message_type="data"'
+        self.assertIn(f'omf_requests_total{{{labels},status="202"}} 2', text)
+        self.assertIn(f'omf_requests_total{{{labels},status="429"}} 1', text)
+        self.assertIn(f'omf_retries_total{{{labels}}} 1', text)
+        self.assertIn(f'omf_request_seconds_count{{{labels}}} 3', text)
+        self.assertIn('omf_compression_ratio_bucket{le="+Inf"} 2', text)
+        # the sink receives a last snapshot when the metrics are stopped
+        self.assertEqual(len(snapshots), 1)
+        self.assertIsNone(program.metrics)
+
+
+class VerificationTestCase(unittest.TestCase):
+    def test_returned_data_is_compared_in_bulk(self):
+        sent = {"containerid": 'ThirdContainer', "values": [
+            {"Timestamp": '2024-01-01T00:00:00Z', "NumberProperty1": 1.5, "NumberProperty2": 2, "StringEnum": 'True'}]}
+        comparisons = [
+            ('SDS', {"NumberProperty1": 1.5, "NumberProperty2": 2.0, "StringEnum": 'True'}, sent),
+            ('SDS', {"NumberProperty1": 1.5, "NumberProperty2": 3, "StringEnum": 'True'}, sent),
+            ('SDS', {"NumberProperty1": 1.5, "NumberProperty2": 2}, sent),
+            ('ThirdContainer.NumberProperty1', 1.5, sent),
+            ('ThirdContainer.NumberProperty2', 2 ** 60, sent)]
+        self.assertEqual(find_mismatches(comparisons), [1, 2, 4])
+        self.assertTrue(compare_data(*comparisons[0]))
+        self.assertFalse(compare_data(*comparisons[1]))
+
+    def test_pi_points_and_values_are_read_in_one_batch(self):
+        omf_containers = get_json_file('OMF-Containers.json')[:2]
+        batch = get_pi_value_batch('https://pi/piwebapi/dataservers/S0/points', omf_containers)
+        self.assertEqual(batch["Points1"]["Resource"], 'https://pi/piwebapi/dataservers/S0/points?nameFilter=SecondContainer*')
+        self.assertEqual(batch["Values1"]["ParentIds"], ['Points1'])
+
+        point = {"Name": 'FirstContainer.IntegerProperty', "Links": {"Value": 'https://pi/piwebapi/streams/P1/value'}}
+        results = {
+            "Points0": {"Status": 200, "Content": {"Items": [point]}},
+            "Values0": {"Status": 207, "Content": {"Items": [{"Status": 200, "Content": {"Value": 5}}]}},
+            "Points1": {"Status": 200, "Content": {"Items": []}},
+            "Values1": {"Status": 409, "Content": {}}}
+        self.assertEqual(read_pi_value_batch(results, omf_containers),
+                         [(omf_containers[0], point, 200, 5), (omf_containers[1], None, None, None)])
+
+
 def check_creations(self, sent_data):
     global endpoints
 
@@ -32,66 +762,10 @@ def check_creations(self, sent_data):
     success = True
     for endpoint in endpoints:
         try:
-            endpoint_type = endpoint["EndpointType"]
-
-            if endpoint_type == EndpointTypes.PI:
-                # get point URLs
-                response = send_get_request_to_endpoint(
-                    endpoint, path=f'/dataservers?name={endpoint["DataArchiveName"]}')
-                points_url = response.json()["Links"]["Points"]
-                
-                # get point data and check response
-                for omf_container in omf_containers:
-                    response = send_get_request_to_endpoint(
-                        endpoint, base=points_url, path=f'?nameFilter={omf_container["id"]}*')
-                    # get end value URLs
-                    for item in response.json()["Items"]:
-                        end_value_url = item["Links"]["Value"]
-                        # retrieve data
-                        response = send_get_request_to_endpoint(
-                            endpoint, base=end_value_url)
-                        end_value = response.json()["Value"]
-                        # check that the response was good and that data was written to the point
-                        if response.status_code < 200 or response.status_code >= 300:
-                            print(f'Unable to find item {item}')
-                            success = False
-                        elif isinstance(end_value, dict) and "Name" in end_value and end_value["Name"] == 'Pt Created':
-                            print(f'Item {item} has no recorded data')
-                            success = False
-                        # compare the returned data to what was sent
-                        if not compare_data(item["Name"], end_value, sent_data[omf_container["id"]]):
-                            print(
-                                f'Data in item {item} does match what was sent')
-                            success = False
-
+            if endpoint["EndpointType"] == EndpointTypes.PI:
+                success = check_pi_creations(endpoint, omf_containers, sent_data) and success
             else:
-                # retrieve types and check response
-                for omf_type in omf_types:
-                    response = send_get_request_to_endpoint(
-                        endpoint, path=f'/Types/{omf_type["id"]}')
-                    if response.status_code < 200 or response.status_code >= 300:
-                        print(f'Unable to find type {omf_type}')
-                        success = False
-
-                # retrieve containers and check response
-                for omf_container in omf_containers:
-                    response = send_get_request_to_endpoint(
-                        endpoint, path=f'/Streams/{omf_container["id"]}')
-                    if response.status_code < 200 or response.status_code >= 300:
-                        print(f'Unable to find continer {omf_container}')
-                        success = False
-
-                # retrieve the most recent data, check the response, and compare the data to what was sent
-                for omf_datum in omf_data:
-                    response = send_get_request_to_endpoint(
-                        endpoint, path=f'/Streams/{omf_datum["containerid"]}/Data/last')
-                    if response.text == '' or (response.status_code < 200 or response.status_code >= 300):
-                        print(f'Unable to find data {omf_datum}')
-                        success = False
-                    elif not compare_data('SDS', response.json(), sent_data[omf_datum["containerid"]]):
-                        print(
-                            f'Data in {omf_datum} does not match what was sent')
-                        success = False
+                success = check_sds_creations(endpoint, omf_types, omf_containers, omf_data, sent_data) and success
 
         except Exception as ex:
             print(f'Encountered Error: {ex}')
@@ -104,6 +778,149 @@ def check_creations(self, sent_data):
     return success
 
 
+def check_pi_creations(endpoint, omf_containers, sent_data):
+    '''Checks the points of the containers and their end values in PI Web API batch requests, sent concurrently'''
+
+    # get point URLs
+    response = send_get_request_to_endpoint(
+        endpoint, path=f'/dataservers?name={endpoint["DataArchiveName"]}')
+    points_url = response.json()["Links"]["Points"]
+
+    # find the points of each container and get their end values, a batch of containers per request
+    batches = [omf_containers[i:i + verification_batch_size]
+               for i in range(0, len(omf_containers), verification_batch_size)]
+    results = run_concurrently(endpoint, lambda batch: read_pi_value_batch(
+        send_batch_request_to_endpoint(endpoint, get_pi_value_batch(points_url, batch)), batch), batches)
+
+    success = True
+    comparisons = []
+    for omf_container, item, status, end_value in (row for rows in results for row in rows):
+        # check that the points were found, that the response was good and that data was written to the point
+        if item is None:
+            print(f'Unable to find the points of container {omf_container}')
+            success = False
+        elif status < 200 or status >= 300:
+            print(f'Unable to find item {item}')
+            success = False
+        elif isinstance(end_value, dict) and "Name" in end_value and end_value["Name"] == 'Pt Created':
+            print(f'Item {item} has no recorded data')
+            success = False
+        else:
+            comparisons.append((item["Name"], end_value, sent_data[omf_container["id"]]))
+
+    # compare the returned data to what was sent
+    for index in find_mismatches(comparisons):
+        print(f'Data in item {comparisons[index][0]} does match what was sent')
+        success = False
+
+    return success
+
+
+def get_pi_value_batch(points_url, omf_containers):
+    '''Returns a PI Web API batch request that finds the points of each container and then gets their end values'''
+
+    batch = {}
+    for i, omf_container in enumerate(omf_containers):
+        batch[f'Points{i}'] = {
+            "Method": 'GET',
+            "Resource": f'{points_url}?nameFilter={quote(omf_container["id"])}*'
+        }
+        batch[f'Values{i}'] = {
+            "Method": 'GET',
+            "ParentIds": [f'Points{i}'],
+            "Parameters": [f'$.Points{i}.Content.Items[*].Links.Value'],
+            "RequestTemplate": {"Resource": '{0}'}
+        }
+
+    return batch
+
+
+def read_pi_value_batch(results, omf_containers):
+    '''Returns (container, point item, status, end value) for every point found by a batch from get_pi_value_batch
+
+    A container without points is returned once with None for its point.'''
+
+    rows = []
+    for i, omf_container in enumerate(omf_containers):
+        items = (results[f'Points{i}'].get('Content') or {}).get('Items') or []
+        if not items:
+            rows.append((omf_container, None, None, None))
+            continue
+
+        values = (results[f'Values{i}'].get('Content') or {}).get('Items') or []
+        for item, value in zip(items, values):
+            rows.append((omf_container, item, value["Status"], (value.get('Content') or {}).get('Value')))
+        for item in items[len(values):]:
+            rows.append((omf_container, item, results[f'Values{i}']["Status"], None))
+
+    return rows
+
+
+def check_sds_creations(endpoint, omf_types, omf_containers, omf_data, sent_data):
+    '''Checks the types and streams in paged listings, and the last value of every stream over concurrent pooled requests'''
+
+    success = True
+
+    # retrieve types and check response
+    type_ids = get_sds_ids(endpoint, '/Types')
+    for omf_type in omf_types:
+        if omf_type["id"] not in type_ids:
+            print(f'Unable to find type {omf_type}')
+            success = False
+
+    # retrieve containers and check response
+    stream_ids = get_sds_ids(endpoint, '/Streams')
+    for omf_container in omf_containers:
+        if omf_container["id"] not in stream_ids:
+            print(f'Unable to find continer {omf_container}')
+            success = False
+
+    # retrieve the most recent data, check the response, and compare the data to what was sent
+    responses = run_concurrently(endpoint, lambda omf_datum: send_get_request_to_endpoint(
+        endpoint, path=f'/Streams/{quote(omf_datum["containerid"])}/Data/last'), omf_data)
+    comparisons = []
+    compared_data = []
+    for omf_datum, response in zip(omf_data, responses):
+        if response.text == '' or (response.status_code < 200 or response.status_code >= 300):
+            print(f'Unable to find data {omf_datum}')
+            success = False
+        else:
+            comparisons.append(('SDS', response.json(), sent_data[omf_datum["containerid"]]))
+            compared_data.append(omf_datum)
+
+    for index in find_mismatches(comparisons):
+        print(f'Data in {compared_data[index]} does not match what was sent')
+        success = False
+
+    return success
+
+
+def get_sds_ids(endpoint, path):
+    '''Returns the ids of all the types or streams of the namespace, listed a page at a time'''
+
+    ids = set()
+    skip = 0
+    while True:
+        response = send_get_request_to_endpoint(
+            endpoint, path=f'{path}?skip={skip}&count={verification_batch_size}')
+        response.raise_for_status()
+        page = response.json()
+        ids.update(item["Id"] for item in page)
+        if len(page) < verification_batch_size:
+            return ids
+        skip += verification_batch_size
+
+
+def run_concurrently(endpoint, function, items):
+    '''Calls function(item) for every item over as many threads as the endpoint has pooled connections, and returns the results in order'''
+
+    if len(items) < 2:
+        return [function(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=min(len(items), endpoint["PoolSize"])) as executor:
+        return list(executor.map(function, items))
+
+
 def cleanup(self):
     global endpoints
 
@@ -126,6 +943,9 @@ def cleanup(self):
                 send_message_to_omf_endpoint(
                     endpoint, 'type', [omf_type], action='delete')
 
+            # the next run has to register the types and containers again
+            forget_registered_definitions(endpoint)
+
         except Exception as ex:
             print(f'Encountered Error: {ex}')
             print
@@ -137,73 +957,100 @@ def cleanup(self):
     return success
 
 
-def send_get_request_to_endpoint(endpoint, path='', base=''):
-    '''Sends the get request to the path relative to the base base and returns the response'''
-
-    if base == '':
-        base = endpoint["BaseEndpoint"]
+def get_request_headers(endpoint):
+    '''Returns the headers of requests that read back from the endpoint'''
 
     # Collect the message headers
     msg_headers = get_headers(endpoint)
     msg_headers.pop('omfversion')
     msg_headers["Accept-Verbosity"] = 'verbose'
 
+    return msg_headers
+
+
+def get_request_url(endpoint, path='', base=''):
+    '''Returns the validated url of the path relative to the base, which is the base endpoint by default'''
+
+    if base == '':
+        base = endpoint["BaseEndpoint"]
+
     # construct and validate url
     url = urlparse(base + path)
     assert url.scheme == 'https' or url.scheme == 'http'
     assert url.geturl().startswith(endpoint["Resource"])
 
-    # Send message to base base
-    endpoints_type = endpoint["EndpointType"]
-    response = {}
-    # If the endpoint is CDS
-    if endpoints_type == EndpointTypes.CDS:
-        response = requests.get(
-            url.geturl(),
-            headers=msg_headers,
-            verify=endpoint["VerifySSL"],
-            timeout=endpoint["WebRequestTimeoutSeconds"]
-        )
-    # If the endpoint is EDS
-    elif endpoints_type == EndpointTypes.EDS:
-        response = requests.get(
-            url.geturl(),
-            headers=msg_headers,
-            timeout=endpoint["WebRequestTimeoutSeconds"]
-        )
-    # If the endpoint is PI
-    elif endpoints_type == EndpointTypes.PI:
-        response = requests.get(
-            url.geturl(),
-            headers=msg_headers,
-            verify=endpoint["VerifySSL"],
-            timeout=endpoint["WebRequestTimeoutSeconds"],
-            auth=(endpoint["Username"], endpoint["Password"])
-        )
+    return url.geturl()
+
+
+def send_get_request_to_endpoint(endpoint, path='', base=''):
+    '''Sends the get request to the path relative to the base base and returns the response'''
+
+    # Send message to base base over the endpoint's pooled session
+    response = get_session(endpoint).get(
+        get_request_url(endpoint, path, base),
+        headers=get_request_headers(endpoint)
+    )
 
     return(response)
 
 
+def send_batch_request_to_endpoint(endpoint, batch):
+    '''Sends a PI Web API batch request and returns the result of each of its requests by name'''
+
+    response = get_session(endpoint).post(
+        get_request_url(endpoint, path='/batch'),
+        headers=get_request_headers(endpoint),
+        json=batch
+    )
+    response.raise_for_status()
+
+    return response.json()
+
+
 def compare_data(data_format, response, sent_data):
     '''A helper function for comparing the data returned by either the PI Web API or the SDS'''
-    success = True
+    return not find_mismatches([(data_format, response, sent_data)])
+
+
+def get_compared_values(data_format, response, sent_data):
+    '''Returns the pairs of sent and returned values to compare, for data returned by either the PI Web API or the SDS'''
+    sent_value = sent_data["values"][0]
     if data_format == 'SDS':
-        for key in sent_data["values"][0]:
-            if key != "Timestamp" and sent_data["values"][0][key] != response[key]:
-                success = False
+        return [(value, response.get(key)) for key, value in sent_value.items() if key != "Timestamp"]
+
+    split = data_format.split('.')
+    if len(split) == 2:
+        return [(value, response) for key, value in sent_value.items() if key == split[1]]
+
+    return [(value, response) for key, value in sent_value.items() if key != "Timestamp"]
+
+
+def find_mismatches(comparisons):
+    '''Returns the sorted indexes of the (data_format, response, sent_data) comparisons whose data does not match
+
+    The numeric values of all comparisons are compared at once with numpy when it is installed,
+    and the other values one by one.'''
+    mismatches = set()
+    numeric_owners, sent_numbers, returned_numbers = [], [], []
+    for index, comparison in enumerate(comparisons):
+        for sent, returned in get_compared_values(*comparison):
+            # integers beyond the precision of doubles are compared exactly, one by one
+            if type(sent) in (int, float) and type(returned) in (int, float) and abs(sent) < 2 ** 53 and abs(returned) < 2 ** 53:
+                numeric_owners.append(index)
+                sent_numbers.append(sent)
+                returned_numbers.append(returned)
+            elif sent != returned:
+                mismatches.add(index)
+
+    numpy = program.import_numpy()
+    if numpy is not None and numeric_owners:
+        differs = numpy.array(sent_numbers, dtype=numpy.float64) != numpy.array(returned_numbers, dtype=numpy.float64)
+        mismatches.update(numpy.array(numeric_owners)[differs].tolist())
     else:
-        split = data_format.split('.')
-        if len(split) == 2:
-            prop = split[1]
-            for key in sent_data["values"][0]:
-                if key == prop and sent_data["values"][0][key] != response:
-                    success = False
-        else:
-            for key in sent_data["values"][0]:
-                if key != "Timestamp" and sent_data["values"][0][key] != response:
-                    success = False
+        mismatches.update(owner for owner, sent, returned in zip(numeric_owners, sent_numbers, returned_numbers)
+                          if sent != returned)
 
-    return success
+    return sorted(mismatches)
 
 
 if __name__ == '__main__':